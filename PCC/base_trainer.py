@@ -1,115 +1,97 @@
 ## Copyright (c) Microsoft Corporation.
 ## Licensed under the MIT license.
 
+import json
 import logging
 import os
 import time
 from typing import Dict, List, Optional
 
-import evaluate
 import numpy as np
 import torch
+import transformers.trainer as hf_trainer
 
+from accelerate.utils import DeepSpeedSchedulerWrapper
 from huggingface_hub import HfApi
 from model.model import PCC
-from torch.utils.data import DataLoader
+from peft import PeftModel, get_peft_model_state_dict, set_peft_model_state_dict
+from safetensors.torch import load_file
+from torch.utils.data import DataLoader, Subset
 from transformers import Trainer,TrainerCallback
+from transformers.modeling_utils import load_sharded_checkpoint
+from transformers.trainer import SCHEDULER_NAME, TRAINING_ARGS_NAME
+from utils.checkpoint import AsyncCheckpointWriter, build_sink
+from utils.metrics import MetricWorkerPool, TextStats, loss_stats, teacher_forced_pairs, text_stats_from_pairs
+from utils.sampler import TokenBudgetBatchSampler, example_lengths, loss_token_counts, stratified_subset
+from utils.streaming import StreamingDataset
+from utils.telemetry import TelemetryCallBack
 from utils.utils import DataCollator
 
 logger = logging.getLogger(__name__)
 hf_token = os.environ.get('HF_TOKEN', '')
 
-def compute_rag_metrics(metrics,tokenizer, eval_pred):
-    with torch.no_grad():
-        loss_rag, logits,labels, _ = eval_pred
-        predictions = torch.argmax(logits, axis=-1)
-        rag_val_loss = loss_rag.mean().item()
-        
-        mask = labels!=-100
-        labels = labels[mask]
-        predictions = predictions[mask]
-        
-        pred_texts = tokenizer.decode(predictions, skip_special_tokens=True)
-        label_texts = tokenizer.decode(labels, skip_special_tokens=True)
+DECODER_REFERENCE_NAME = "decoder_reference.json"
+COMPRESSOR_REFERENCE_NAME = "compressor_reference.json"
+STREAM_STATE_NAME = "stream_state_{}.json"
+CONVERTER_NAME = "memory_converter.bin"
 
-        bleu_score_all = metrics["bleu"].compute(
-            predictions=[pred_texts], references=[[label_texts]]
-        )
-        rouge = metrics["rouge"].compute(
-            predictions=[pred_texts], references=[[label_texts]]
-        )
-        
-        bleu_score = bleu_score_all["bleu"]
-        bleu_score_1gram = bleu_score_all["precisions"][0]
-        bleu_score_2gram = bleu_score_all["precisions"][1]
-        bleu_score_3gram = bleu_score_all["precisions"][2]
-        bleu_score_4gram = bleu_score_all["precisions"][3]
 
-        rouge1 = rouge["rouge1"]
-        rouge2 = rouge["rouge2"]
-        rougeL = rouge["rougeL"]
+def load_decoder_reference(checkpoint_dir: str):
+    path = os.path.join(checkpoint_dir, DECODER_REFERENCE_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
 
-    return {
-        "eval_rag_val_loss": rag_val_loss,
-        "eval_bleu": bleu_score,
-        "eval_bleu_1gram": bleu_score_1gram,
-        "eval_bleu_2gram": bleu_score_2gram,
-        "eval_bleu_3gram": bleu_score_3gram,
-        "eval_bleu_4gram": bleu_score_4gram,
-        "eval_rouge1": rouge1,
-        "eval_rouge2": rouge2,
-        "eval_rougeL": rougeL
-    }
 
-def compute_metrics(metrics, tokenizer, eval_pred):
-    with torch.no_grad():
-        loss_nt,loss_ae, logits, labels, _ = eval_pred
-        predictions = torch.argmax(logits, axis=-1)
-        ae_val_loss = loss_ae.mean().item()
-        nt_val_loss = loss_nt.mean().item()
+def _load_state_file(checkpoint_dir: str, names: List[str]):
+    for name in names:
+        path = os.path.join(checkpoint_dir, name)
+        if os.path.exists(path):
+            return load_file(path) if name.endswith(".safetensors") else torch.load(path, map_location="cpu")
+    raise FileNotFoundError(f"none of {names} found in {checkpoint_dir}")
 
-        mask = labels != -100
-        labels = labels[mask]
-        predictions = predictions[mask]
 
-        ae_perplexity = np.exp(ae_val_loss)
-        nt_perplexity = np.exp(nt_val_loss)
-        
-        pred_texts = tokenizer.decode(predictions, skip_special_tokens=True)
-        label_texts = tokenizer.decode(labels, skip_special_tokens=True)
+def compressor_reference(compressor) -> dict:
+    """Identify a frozen compressor by model id and hub revision, like `Decoder.reference`."""
+    return {
+        "model_name_or_path": compressor.config._name_or_path,
+        "revision": getattr(compressor.config, "_commit_hash", None),
+    }
 
-        bleu_score_all = metrics["bleu"].compute(
-            predictions=[pred_texts], references=[[label_texts]]
-        )
-        rouge = metrics["rouge"].compute(
-            predictions=[pred_texts], references=[[label_texts]]
-        )
-        
-        bleu_score = bleu_score_all["bleu"]
-        bleu_score_1gram = bleu_score_all["precisions"][0]
-        bleu_score_2gram = bleu_score_all["precisions"][1]
-        bleu_score_3gram = bleu_score_all["precisions"][2]
-        bleu_score_4gram = bleu_score_all["precisions"][3]
 
-        rouge1 = rouge["rouge1"]
-        rouge2 = rouge["rouge2"]
-        rougeL = rouge["rougeL"]
+def is_trainable(module) -> bool:
+    return any(param.requires_grad for param in module.parameters())
 
-    return {
-        "eval_ae_val_loss": ae_val_loss,
-        "eval_next_val_loss": nt_val_loss,
-        "eval_bleu": bleu_score,
-        "eval_bleu_1gram": bleu_score_1gram,
-        "eval_bleu_2gram": bleu_score_2gram,
-        "eval_bleu_3gram": bleu_score_3gram,
-        "eval_bleu_4gram": bleu_score_4gram,
-        "eval_rouge1": rouge1,
-        "eval_rouge2": rouge2,
-        "eval_rougeL": rougeL,
-        "eval_ae_ppl": ae_perplexity,
-        "eval_next_ppl": nt_perplexity,
-    }
 
+def load_trainable_state(model: PCC, checkpoint_dir: str):
+    """Restore compressor (or its LoRA adapter) and converter weights written by `BaseTrainer._save`."""
+    compressor = model.compressor.model
+    reference_path = os.path.join(checkpoint_dir, COMPRESSOR_REFERENCE_NAME)
+    if os.path.exists(reference_path):
+        # the compressor was frozen and is rebuilt from its base checkpoint
+        with open(reference_path) as f:
+            reference = json.load(f)
+        if reference != compressor_reference(compressor):
+            logger.warning(f"Compressor {compressor_reference(compressor)} differs from the checkpoint's {reference}.")
+    elif isinstance(compressor, PeftModel):
+        state_dict = _load_state_file(checkpoint_dir, ["adapter_model.safetensors", "adapter_model.bin"])
+        set_peft_model_state_dict(compressor, state_dict)
+    elif any(os.path.exists(os.path.join(checkpoint_dir, name))
+             for name in ["model.safetensors.index.json", "pytorch_model.bin.index.json"]):
+        load_sharded_checkpoint(compressor, checkpoint_dir, strict=False)
+    else:
+        state_dict = _load_state_file(checkpoint_dir, ["model.safetensors", "pytorch_model.bin"])
+        # tied weights (e.g. gpt2's lm_head) are not serialized
+        compressor.load_state_dict(state_dict, strict=False)
+    model.converter.load_state_dict(torch.load(os.path.join(checkpoint_dir, CONVERTER_NAME), map_location="cpu"))
+
+def supervised_tokens(output: Dict, next_token_ratio: float):
+    """Decoder tokens that enter the loss of `output` (labels != -100), weighted like the joint stage-1 loss."""
+    if "ae" in output:
+        return ((1 - next_token_ratio) * supervised_tokens(output["ae"], next_token_ratio)
+                + next_token_ratio * supervised_tokens(output["next_token"], next_token_ratio))
+    return (output["target"][:, 1:] != -100).sum()
 
 def speed_metrics(split, start_time, num_samples=None, num_steps=None, num_tokens=None):
     """
@@ -150,13 +132,88 @@ class LogCallBack(TrainerCallback):
                 f"Grad Norm: {logs.get('grad_norm', 0):.4f} | "
                 f"Learning Rate: {logs.get('learning_rate', 0):.2e} | "  # Using scientific notation
             )
+            if "padding_ratio" in logs:
+                log_msg += (
+                    f"Padding: {logs['padding_ratio']:.2%} | "
+                    f"Tokens/s: {logs.get('train_tokens_per_second', 0):.1f} | "
+                )
+            if "packing_ratio" in logs:
+                log_msg += (
+                    f"Packed: {logs['packing_ratio']:.2%} | "
+                    f"Positions/s: {logs['decoder_positions_per_second']:.1f} "
+                    f"(unpacked {logs['unpacked_decoder_positions_per_second']:.1f}) | "
+                )
             print(log_msg)
-            
+
+
+class SamplerEpochCallBack(TrainerCallback):
+    """Reshuffles the token-budget batches every epoch, also when resuming mid-epoch."""
+    def __init__(self, trainer):
+        self.trainer = trainer
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        if self.trainer.token_budget_sampler is not None:
+            self.trainer.token_budget_sampler.set_epoch(int(state.epoch))
+
+
 class BaseTrainer(Trainer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.metrics = self.load_metrics()
         self.stage = self.args.stage
+        self.checkpoint_writer = AsyncCheckpointWriter(sink=build_sink(self.args.checkpoint_sink))
+        self.token_budget_sampler = None
+        self.add_callback(SamplerEpochCallBack(self))
+        # real / padded tokens seen since the last log
+        self._token_stats = [0, 0]
+        self._token_stats_start = None
+        # stage-2 packing: decoder positions computed / positions the padded batches would have had
+        self._packing_stats = [0, 0]
+        # streaming: dataloader worker -> position of its last consumed example
+        self.stream_state = {}
+        # text metrics of the last evaluation that are still computed in the background
+        self.metric_pool = None
+        self._pending_eval = None
+        self._eval_subset = None
+        self._final_eval = False
+        self.telemetry = None
+        if self.args.telemetry_dir is not None:
+            self.telemetry = TelemetryCallBack(self.model, self.args.telemetry_dir, self.args.process_index, self.args.device)
+            self.add_callback(self.telemetry)
+
+    def get_train_dataloader(self) -> DataLoader:
+        if isinstance(self.train_dataset, StreamingDataset):
+            # the dataset shards itself per rank, so accelerate must not re-shard or dispatch it
+            return DataLoader(
+                self.train_dataset,
+                batch_size=self._train_batch_size,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+        if self.args.max_tokens_per_batch <= 0:
+            return super().get_train_dataloader()
+        compress_lengths, decoder_lengths = example_lengths(
+            self.train_dataset, self.stage, self.args.compressor_type
+        )
+        self.token_budget_sampler = TokenBudgetBatchSampler(
+            compress_lengths, decoder_lengths, self.args.max_tokens_per_batch, seed=self.args.random_seed,
+            loss_tokens=loss_token_counts(self.train_dataset, self.stage, self.args.next_token_ratio),
+            num_replicas=self.args.world_size, rank=self.args.process_index,
+        )
+        logger.info(
+            f"Token-budget batching: {len(self.token_budget_sampler)} batches of <= {self.args.max_tokens_per_batch} tokens, "
+            f"padding ratio {self.token_budget_sampler.padding_ratio():.2%}"
+        )
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=self.token_budget_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers and self.args.dataloader_num_workers > 0,
+        )
+        # the sampler shards itself; accelerate would pad the last round with duplicated batches
+        return dataloader
         
     def compute_loss(
         self,
@@ -172,129 +229,315 @@ class BaseTrainer(Trainer):
             next_ids = inputs["next_ids"]
             prompt_text = inputs["prompt_text"]
             labels_ids = None
+            llm_attention_mask = inputs.get("llm_attention_mask")
+            next_attention_mask = inputs.get("next_attention_mask")
         else:
             # fine-tuning
             llm_ids = inputs["query_answer_ids"]
             labels_ids = inputs["label_ids"]
             prompt_text = None
             next_ids = None
+            llm_attention_mask = inputs.get("query_answer_attention_mask")
+            next_attention_mask = None
         
         loss = model(compress_ids=compress_ids,llm_ids=llm_ids,labels_ids=labels_ids,
-                         prompt_text=prompt_text, next_ids=next_ids,task_type=None)
-        
+                         prompt_text=prompt_text, next_ids=next_ids,task_type=None,
+                         compressor_features=inputs.get("compressor_features"),
+                         llm_attention_mask=llm_attention_mask, next_attention_mask=next_attention_mask)
+
+        if "stream_state" in inputs:
+            self.stream_state[str(inputs["stream_state"]["worker"])] = inputs["stream_state"]
+        if self._token_stats_start is None:
+            self._token_stats_start = time.time()
+        self._token_stats[0] += inputs["num_tokens"]
+        self._token_stats[1] += inputs["num_padded_tokens"]
+        if "num_positions" in loss:
+            self._packing_stats[0] += loss["num_positions"]
+            self._packing_stats[1] += loss["num_unpacked_positions"]
+        if self.token_budget_sampler is not None:
+            # batches differ in size: weight each by the tokens in its loss against a constant
+            # normalizer, so every update averages over (about) the same number of tokens
+            num_loss_tokens = supervised_tokens(loss, self.args.next_token_ratio)
+            return loss["loss"] * num_loss_tokens / self.token_budget_sampler.mean_loss_tokens
         return loss["loss"]
 
-    def load_metrics(self):
-        metrics = {
-            "bleu": evaluate.load("bleu"),
-            "rouge": evaluate.load("rouge"),
-        }
-        return metrics
+    def training_step(self, model, inputs):
+        if self.telemetry is None:
+            return super().training_step(model, inputs)
+        self.telemetry.batch_ready()
+        loss = super().training_step(model, inputs)
+        self.telemetry.batch_done(inputs)
+        return loss
+
+    def _prepare_input(self, data):
+        # collated tensors arrive pinned (dataloader_pin_memory), so the copy can overlap compute
+        if isinstance(data, torch.Tensor) and data.is_pinned():
+            return data.to(self.args.device, non_blocking=True)
+        return super()._prepare_input(data)
+
+    def log(self, logs: Dict[str, float], *args, **kwargs) -> None:
+        if "loss" in logs and self._pending_eval is not None:
+            # training logs happen on every rank at the same step, so all ranks agree here
+            done = all(future.done() for future in self._pending_eval["futures"])
+            done = torch.tensor([float(done)], device=self.args.device)
+            if self.accelerator.reduce(done, reduction="sum").item() == self.args.world_size:
+                self._log_pending_eval()
+        if "loss" in logs and self._token_stats_start is not None:
+            stats = torch.tensor(self._token_stats, dtype=torch.float64, device=self.args.device)
+            num_tokens, num_padded_tokens = self.accelerator.reduce(stats, reduction="sum").tolist()
+            if num_padded_tokens > 0:
+                logs["padding_ratio"] = round(1 - num_tokens / num_padded_tokens, 4)
+                logs["train_tokens_per_second"] = speed_metrics(
+                    "train", self._token_stats_start, num_tokens=num_tokens
+                ).get("train_tokens_per_second", 0.0)
+            if self.args.pack_sequences and self.stage == 2:
+                stats = torch.tensor(self._packing_stats, dtype=torch.float64, device=self.args.device)
+                num_positions, num_unpacked_positions = self.accelerator.reduce(stats, reduction="sum").tolist()
+                if num_unpacked_positions > 0:
+                    # the same steps measured in packed rows and in the padded rows they replace
+                    elapsed = time.time() - self._token_stats_start
+                    logs["packing_ratio"] = round(1 - num_positions / num_unpacked_positions, 4)
+                    logs["decoder_positions_per_second"] = round(num_positions / elapsed, 3)
+                    logs["unpacked_decoder_positions_per_second"] = round(num_unpacked_positions / elapsed, 3)
+                self._packing_stats = [0, 0]
+            if self.args.compile_compressor:
+                logs["compile_seconds"] = round(self.model.compile_seconds(), 3)
+            self._token_stats = [0, 0]
+            self._token_stats_start = time.time()
+        super().log(logs, *args, **kwargs)
+
+    def get_sharded_eval_dataloader(self, eval_dataset) -> DataLoader:
+        """Every rank evaluates examples rank::world_size, without the padding accelerate adds for even batches."""
+        indices = list(range(self.args.process_index, len(eval_dataset), self.args.world_size))
+        return DataLoader(
+            Subset(eval_dataset, indices),
+            batch_size=self.args.per_device_eval_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def _intermediate_eval_dataset(self, eval_dataset):
+        if self._eval_subset is None:
+            compress_lengths, decoder_lengths = example_lengths(eval_dataset, self.stage, self.args.compressor_type)
+            lengths = [c + d for c, d in zip(compress_lengths, decoder_lengths)]
+            self._eval_subset = stratified_subset(lengths, self.args.eval_token_budget, seed=self.args.random_seed)
+            logger.info(f"Intermediate evaluations use {len(self._eval_subset)} of {len(eval_dataset)} examples.")
+        return Subset(eval_dataset, self._eval_subset)
+
+    def _log_pending_eval(self):
+        """Wait for the background text metrics of the last evaluation, combine them over ranks and log them."""
+        pending, self._pending_eval = self._pending_eval, None
+        text_stats = TextStats()
+        for future in pending["futures"]:
+            text_stats.merge(TextStats(future.result()))
+        stats = torch.tensor(text_stats.to_list(), dtype=torch.float64, device=self.args.device)
+        stats = self.accelerator.reduce(stats, reduction="sum").tolist()
+        prefix = pending["prefix"]
+        metrics = {f"{prefix}_{name}": value for name, value in TextStats(stats).compute().items()}
+        metrics[f"{prefix}_step"] = pending["step"]
+        self.log(metrics)
 
     def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix="eval"):
-        eval_dataloader = self.get_eval_dataloader(eval_dataset)
+        eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        if self.args.eval_token_budget > 0 and not self._final_eval:
+            eval_dataset = self._intermediate_eval_dataset(eval_dataset)
+        eval_dataloader = self.get_sharded_eval_dataloader(eval_dataset)
+        tokenizer = self.model.decoder.tokenizer
+        if self.args.eval_metric_workers > 0:
+            if self._pending_eval is not None:
+                self._log_pending_eval()
+            if self.metric_pool is None:
+                self.metric_pool = MetricWorkerPool(tokenizer, self.args.eval_metric_workers)
+        futures = []
 
-        total_metrics = {}
-        num_batches = 0
+        # sufficient statistics, summed over batches and then over ranks
+        tasks = ["rag"] if self.stage == 2 else ["ae", "next"]
+        losses = {task: [0.0, 0] for task in tasks}
+        text_stats = TextStats()
         self.model.eval()
         with torch.no_grad():
             for batch in eval_dataloader:
                 compress_ids = batch["compress_ids"]
+                compressor_features = batch.get("compressor_features")
                 if self.stage == 2:
-                    llm_ids = batch["query_answer_ids"]
-                    labels_ids = batch["label_ids"]
-                    next_ids = None
-                    prompt_text = None
-                    with torch.no_grad():
-                        outputs_rag = self.model(
-                            compress_ids=compress_ids,
-                            llm_ids=llm_ids,
-                            labels_ids=labels_ids,
-                            prompt_text=prompt_text, 
-                            next_ids=None,
-                            task_type="rag")
-                    loss_rag = outputs_rag["loss"]
-                    logits_rag = outputs_rag[
-                        "logits"
-                    ]
-                    labels_rag = outputs_rag["target"]
-                    ppl_loss_rag = outputs_rag["ppl_loss"]
-                    batch_metrics = compute_rag_metrics(
-                        self.metrics,
-                        self.model.decoder.tokenizer,
-                        (loss_rag, logits_rag, labels_rag, ppl_loss_rag),
-                    )
-                    for k, v in batch_metrics.items():
-                        if k in total_metrics:
-                            total_metrics[k] += v
-                        else:
-                            total_metrics[k] = v
-                    num_batches += 1
-                    
+                    outputs_rag = self.model(
+                        compress_ids=compress_ids,
+                        llm_ids=batch["query_answer_ids"],
+                        labels_ids=batch["label_ids"],
+                        prompt_text=None,
+                        next_ids=None,
+                        task_type="rag",
+                        compressor_features=compressor_features,
+                        llm_attention_mask=batch.get("query_answer_attention_mask"))
+                    outputs = {"rag": outputs_rag}
                 elif self.stage == 1:
-                    prompt_text = batch["prompt_text"]
-                    llm_ids = batch["llm_ids"]
-                    next_ids = batch["next_ids"]
-                   
-                    with torch.no_grad():
-                        outputs_ae = self.model(compress_ids=compress_ids,llm_ids=llm_ids,labels_ids=None,
-                            prompt_text=prompt_text, next_ids=next_ids,task_type="ae")
-                        outputs_nt = self.model(compress_ids=compress_ids,llm_ids=llm_ids,labels_ids=None,
-                            prompt_text=prompt_text, next_ids=next_ids,task_type="next_token")
-
-                    loss_ae = outputs_ae["loss"]
-                    loss_nt = outputs_nt["loss"]
-                    logits_ae = outputs_ae[
-                        "logits"
-                    ]
-                    labels_ae = outputs_ae["target"]
-                    ppl_loss_ae = outputs_ae["ppl_loss"]
-                    batch_metrics = self.compute_metrics(
-                        self.metrics,
-                        self.model.decoder.tokenizer,
-                        (loss_nt, loss_ae, logits_ae, labels_ae, ppl_loss_ae),
-                    )
-                    for k, v in batch_metrics.items():
-                        if k in total_metrics:
-                            total_metrics[k] += v
-                        else:
-                            total_metrics[k] = v
-                    num_batches += 1
-
-
-        average_metrics = {k: v / num_batches for k, v in total_metrics.items()}
+                    outputs_multi = self.model(compress_ids=compress_ids,llm_ids=batch["llm_ids"],labels_ids=None,
+                        prompt_text=batch["prompt_text"], next_ids=batch["next_ids"],task_type="multi",
+                        compressor_features=compressor_features,
+                        llm_attention_mask=batch.get("llm_attention_mask"),
+                        next_attention_mask=batch.get("next_attention_mask"))
+                    outputs = {"ae": outputs_multi["ae"], "next": outputs_multi["next_token"]}
+
+                for task, output in outputs.items():
+                    loss_sum, num_tokens = loss_stats(output)
+                    losses[task][0] += loss_sum
+                    losses[task][1] += num_tokens
+                # text metrics on the reconstruction (stage 1) or the answer (stage 2)
+                text_output = outputs[tasks[0]]
+                pairs = teacher_forced_pairs(text_output["logits"], text_output["target"])
+                if self.metric_pool is not None:
+                    futures.append(self.metric_pool.submit(pairs))
+                else:
+                    text_stats.merge(TextStats(text_stats_from_pairs(tokenizer, pairs)))
+
+        stats = [value for task in tasks for value in losses[task]] + text_stats.to_list()
+        stats = torch.tensor(stats, dtype=torch.float64, device=self.args.device)
+        stats = self.accelerator.reduce(stats, reduction="sum").tolist()
+
+        metrics = {}
+        for i, task in enumerate(tasks):
+            loss_sum, num_tokens = stats[2 * i], stats[2 * i + 1]
+            val_loss = loss_sum / max(num_tokens, 1)
+            metrics[f"{metric_key_prefix}_{task}_val_loss"] = val_loss
+            if task != "rag":
+                metrics[f"{metric_key_prefix}_{task}_ppl"] = float(np.exp(val_loss))
+        if self.metric_pool is not None:
+            # losses are ready now (and usable for metric_for_best_model), text metrics follow in a later log
+            self._pending_eval = {"futures": futures, "prefix": metric_key_prefix, "step": self.state.global_step}
+        else:
+            for name, value in TextStats(stats[2 * len(tasks):]).compute().items():
+                metrics[f"{metric_key_prefix}_{name}"] = value
 
         self.model.train()
-        self.log(average_metrics)
-        return average_metrics
+        self.log(metrics)
+        return metrics
+
+    def _save_rng_state(self, output_dir):
+        super()._save_rng_state(output_dir)
+        # saved next to the per-rank rng state, so it is part of every checkpoint
+        if isinstance(self.train_dataset, StreamingDataset):
+            state = {
+                "world_size": self.args.world_size,
+                "num_workers": max(1, self.args.dataloader_num_workers),
+                "workers": self.stream_state,
+            }
+            with open(os.path.join(output_dir, STREAM_STATE_NAME.format(self.args.process_index)), "w") as f:
+                json.dump(state, f)
+
+    def _load_stream_state(self, checkpoint_dir):
+        path = os.path.join(checkpoint_dir, STREAM_STATE_NAME.format(self.args.process_index))
+        if not os.path.exists(path):
+            logger.warning(f"No stream state in {checkpoint_dir}, the stream restarts from the beginning.")
+            return
+        with open(path) as f:
+            state = json.load(f)
+        self.train_dataset.load_state_dict(state, num_workers=max(1, self.args.dataloader_num_workers))
+        self.stream_state = dict(state["workers"])
+
+    def train(self, *args, **kwargs):
+        resume_from_checkpoint = kwargs.get("resume_from_checkpoint", args[0] if args else None)
+        if isinstance(self.train_dataset, StreamingDataset) and isinstance(resume_from_checkpoint, str):
+            self._load_stream_state(resume_from_checkpoint)
+        try:
+            if not self.is_deepspeed_enabled or not resume_from_checkpoint:
+                output = super().train(*args, **kwargs)
+            else:
+                # engine checkpoints exclude the frozen decoder, so its module state must load non-strictly.
+                # transformers calls this module function directly; the patch covers only the one resume load
+                deepspeed_load_checkpoint = hf_trainer.deepspeed_load_checkpoint
+
+                def load_non_strict(engine, path, load_module_strict=True):
+                    hf_trainer.deepspeed_load_checkpoint = deepspeed_load_checkpoint
+                    return deepspeed_load_checkpoint(engine, path, load_module_strict=False)
+
+                hf_trainer.deepspeed_load_checkpoint = load_non_strict
+                try:
+                    output = super().train(*args, **kwargs)
+                finally:
+                    hf_trainer.deepspeed_load_checkpoint = deepspeed_load_checkpoint
+            # intermediate evaluations saw a subset, the final one sees the full set
+            if self.args.eval_token_budget > 0 and self.eval_dataset is not None:
+                self._final_eval = True
+                self.evaluate()
+            if self._pending_eval is not None:
+                self._log_pending_eval()
+            return output
+        finally:
+            # make the last checkpoint durable before returning
+            self.checkpoint_writer.wait()
+            if self.metric_pool is not None:
+                self.metric_pool.shutdown()
+                self.metric_pool = None
+
+    def _load_from_checkpoint(self, resume_from_checkpoint, model=None):
+        model = self.model if model is None else model
+        logger.info(f"Loading trainable weights from {resume_from_checkpoint}.")
+        load_trainable_state(self.accelerator.unwrap_model(model), resume_from_checkpoint)
+
+    def _save_optimizer_and_scheduler(self, output_dir):
+        if not self.is_deepspeed_enabled:
+            return super()._save_optimizer_and_scheduler(output_dir)
+        self.model_wrapped.save_checkpoint(output_dir, exclude_frozen_parameters=True)
+        if self.args.should_save and not isinstance(self.lr_scheduler, DeepSpeedSchedulerWrapper):
+            torch.save(self.lr_scheduler.state_dict(), os.path.join(output_dir, SCHEDULER_NAME))
+
+    def save_model(self, output_dir: Optional[str] = None, _internal_call: bool = False):
+        # under ZeRO-1/2 every rank holds the full weights, and `_save` writes only the trainable ones;
+        # transformers' `get_state_dict` would first copy the whole model, frozen decoder included, to CPU
+        if not self.is_deepspeed_enabled or self.accelerator.state.deepspeed_plugin.zero_stage == 3:
+            return super().save_model(output_dir, _internal_call)
+        output_dir = output_dir if output_dir is not None else self.args.output_dir
+        if self.args.should_save:
+            self._save(output_dir)
+        if self.args.push_to_hub and not _internal_call:
+            self.push_to_hub(commit_message="Model save")
 
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
+        # Only trainable state is written: compressor (or LoRA adapter) and converter.
+        # The frozen decoder, and a frozen compressor, are recorded by reference and rebuilt from it on resume.
         output_dir = output_dir if output_dir is not None else self.args.output_dir
         os.makedirs(output_dir, exist_ok=True)
- 
-        self.model.compressor.model.save_pretrained(output_dir)
+        compressor = self.model.compressor.model
+
+        # small metadata is written synchronously, weights are snapshotted and written in background;
+        # only these files reach the sink, the Trainer keeps writing optimizer state into output_dir
+        files = {}
+        metadata_files = [DECODER_REFERENCE_NAME, TRAINING_ARGS_NAME]
+        if isinstance(compressor, PeftModel):
+            compressor.peft_config[compressor.active_adapter].save_pretrained(output_dir)
+            metadata_files.append("adapter_config.json")
+            files["adapter_model.safetensors"] = self.checkpoint_writer.snapshot(
+                get_peft_model_state_dict(compressor), prefix="compressor."
+            )
+        elif getattr(compressor, "_hf_peft_config_loaded", False):
+            # adapter attached through transformers' `load_adapter`, rare enough to save synchronously
+            self.checkpoint_writer.wait()
+            compressor.save_pretrained(output_dir)
+            metadata_files += ["adapter_config.json", "adapter_model.safetensors"]
+        elif not is_trainable(compressor):
+            # a frozen compressor is recorded by reference, like the decoder
+            with open(os.path.join(output_dir, COMPRESSOR_REFERENCE_NAME), "w") as f:
+                json.dump(compressor_reference(compressor), f, indent=2)
+            metadata_files.append(COMPRESSOR_REFERENCE_NAME)
+        else:
+            compressor.config.save_pretrained(output_dir)
+            metadata_files.append("config.json")
+            files["model.safetensors"] = self.checkpoint_writer.snapshot(
+                compressor.state_dict(), prefix="compressor."
+            )
         
         if self.model.compressor.tokenizer is not None:
-            self.model.compressor.tokenizer.save_pretrained(output_dir)
+            saved = self.model.compressor.tokenizer.save_pretrained(output_dir)
+            metadata_files += [os.path.basename(path) for path in saved if os.path.exists(path)]
         
-        torch.save(
-            self.model.converter.state_dict(),
-            os.path.join(output_dir, "memory_converter.bin")
+        files[CONVERTER_NAME] = self.checkpoint_writer.snapshot(
+            self.model.converter.state_dict(), prefix="converter."
         )
-        # Optionally push to HuggingFace if token is available
-        hf_token = os.environ.get('HF_TOKEN', '')
-        if hf_token:
-            try:
-                # Determine repository names based on current timestamp or run configuration
-                compress_name = f"memory-compressor-{int(time.time())}"
-                
-                # Push models and tokenizers to HuggingFace
-                self.model.compressor.model.push_to_hub(compress_name, use_auth_token=hf_token)
-                self.model.compressor.tokenizer.push_to_hub(compress_name, use_auth_token=hf_token)
-                
-            except Exception as e:
-                logger.warning(f"Failed to push models to HuggingFace: {e}")
-        
-        # Save state dict and other model components
-        super()._save(output_dir, state_dict)
- 
\ No newline at end of file
+        with open(os.path.join(output_dir, DECODER_REFERENCE_NAME), "w") as f:
+            json.dump(self.model.decoder.reference(), f, indent=2)
+        torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+
+        # the sink (hub when HF_TOKEN is set) receives the checkpoint once it is durable
+        self.checkpoint_writer.submit(output_dir, files, name=f"memory-compressor-{int(time.time())}",
+                                      metadata_files=metadata_files)
@@ -21,6 +21,20 @@ class Config:
     adapter_model: str = None
     compressor_gradient_checkpoint: bool = False
     decoder_gradient_checkpoint: bool = False
+    memory_codec: str = None
+    pq_subspaces: int = 64
+    pq_codebook: str = None
+    fit_codebook_only: bool = False
+    no_compression: bool = False
+    num_examples: int = 0
+    summary_file: str = None
+    batch_size: int = 8
+    memory_budget_gb: float = 0
+    restart: bool = False
+    num_shards: int = 1
+    shard_index: int = 0
+    shard_output: str = None
+    cache_dir: str = "./cache/qa"
 
     def __str__(self):
         return (
@@ -0,0 +1,97 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import argparse
+import statistics
+import time
+
+import torch
+from model.compiled_forward import CompiledForward
+from model.model import Converter, compress_segment
+
+from .tiny_models import tiny_llama
+
+
+def _sync(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def training_step(compressor_fn, converter, input_ids, segment_length, device):
+    """Compressor per segment, converter on the concatenated memory and backward, as in `PCC.compress`."""
+    _sync(device)
+    begin = time.perf_counter()
+    with torch.autocast(torch.device(device).type, dtype=torch.bfloat16):
+        memories = [
+            compressor_fn(input_ids[:, i:i + segment_length]) for i in range(0, input_ids.size(1), segment_length)
+        ]
+        memory = converter(torch.cat(memories, dim=1))
+    loss = memory.float().pow(2).mean()
+    loss.backward()
+    _sync(device)
+    return loss.item(), time.perf_counter() - begin
+
+
+def run(args):
+    device = args.device
+    compressor = tiny_llama(hidden_size=args.hidden_size, num_layers=args.num_layers).to(device).train()
+    # the last vocabulary entries stand in for the <mem_i> tokens
+    vocab_size = compressor.config.vocab_size
+    mem_ids = list(range(vocab_size - args.embed_len, vocab_size))
+    converter = Converter(
+        embed_dim=compressor.config.hidden_size, embed_len=args.embed_len, llm_dim=args.llm_dim
+    ).to(device)
+    input_length = args.num_segments * args.segment_length + args.ragged_length
+    input_ids = torch.randint(0, vocab_size - args.embed_len, (args.batch_size, input_length), device=device)
+
+    def eager_compressor(ids):
+        return compress_segment(compressor, ids, mem_ids, args.embed_len)
+
+    compiled_compressor = CompiledForward(
+        eager_compressor, guard=lambda ids: ids.size(1) == args.segment_length, name="compressor"
+    )
+    modes = {"eager": (eager_compressor, False), "compiled": (compiled_compressor, True)}
+
+    losses = {}
+    for name, (compressor_fn, compile_converter) in modes.items():
+        converter.compiled_forward = None
+        if compile_converter:
+            converter.compile_forward()
+        _, first_step = training_step(compressor_fn, converter, input_ids, args.segment_length, device)
+        for _ in range(args.warmup):
+            training_step(compressor_fn, converter, input_ids, args.segment_length, device)
+        step_times = []
+        for _ in range(args.repeats):
+            losses[name], seconds = training_step(compressor_fn, converter, input_ids, args.segment_length, device)
+            step_times.append(seconds)
+        compile_seconds = 0.0
+        if name == "compiled":
+            compile_seconds = compiled_compressor.compile_seconds + converter.compiled_forward.compile_seconds
+        print(
+            f"{name:>9} | first step: {first_step * 1000:9.2f} ms (compile {compile_seconds * 1000:9.2f} ms) | "
+            f"steady-state p50: {statistics.median(step_times) * 1000:8.3f} ms | "
+            f"mean: {statistics.mean(step_times) * 1000:8.3f} ms"
+        )
+    print(
+        f"compiled compressor calls: {compiled_compressor.compiled_calls} compiled / "
+        f"{compiled_compressor.eager_calls} eager (ragged segments) | "
+        f"loss eager {losses['eager']:.6f} vs compiled {losses['compiled']:.6f}"
+    )
+
+
+if __name__ == "__main__":
+    # python -m experience.efficiency.benchmark_compile --device cpu
+    parser = argparse.ArgumentParser(description="Benchmark eager vs torch.compile compressor + converter training steps")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--segment_length", type=int, default=256)
+    parser.add_argument("--num_segments", type=int, default=2, help="full segments per example")
+    parser.add_argument("--ragged_length", type=int, default=100, help="length of the last, partial segment")
+    parser.add_argument("--embed_len", type=int, default=16)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--llm_dim", type=int, default=128)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,106 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import argparse
+import statistics
+import time
+
+import torch
+from model.static_decode import StaticDecodeRunner
+
+from .tiny_models import tiny_llama
+
+
+def _sync(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def dynamic_decode(model, prefix_embeds, max_new_token, device):
+    """Mirror of the `Decoder.generate` loop: growing cache and an embedding lookup per step."""
+    step_times = []
+    out = model(inputs_embeds=prefix_embeds, use_cache=True)
+    past_key_values = out.past_key_values
+    next_tokens = torch.argmax(out.logits[:, -1, :], dim=-1)
+    tokens = [next_tokens]
+    for _ in range(1, max_new_token):
+        _sync(device)
+        begin = time.perf_counter()
+        token_embeds = model.get_input_embeddings()(next_tokens.unsqueeze(1))
+        out = model(inputs_embeds=token_embeds, past_key_values=past_key_values, use_cache=True)
+        past_key_values = out.past_key_values
+        next_tokens = torch.argmax(out.logits[:, -1, :], dim=-1)
+        _sync(device)
+        step_times.append(time.perf_counter() - begin)
+        tokens.append(next_tokens)
+    return torch.stack(tokens, dim=1), step_times
+
+
+def static_decode(runner, prefix_embeds, max_new_token, device):
+    step_times = []
+    logits = runner.prefill(prefix_embeds)
+    next_tokens = torch.argmax(logits, dim=-1)
+    tokens = [next_tokens]
+    for _ in range(1, max_new_token):
+        _sync(device)
+        begin = time.perf_counter()
+        logits = runner.step(next_tokens.unsqueeze(1))
+        next_tokens = torch.argmax(logits, dim=-1)
+        _sync(device)
+        step_times.append(time.perf_counter() - begin)
+        tokens.append(next_tokens)
+    return torch.stack(tokens, dim=1), step_times
+
+
+def run(args):
+    device = args.device
+    model = tiny_llama(hidden_size=args.hidden_size, num_layers=args.num_layers).to(device)
+    prefix_embeds = torch.randn(args.batch_size, args.prefix_length, model.config.hidden_size, device=device)
+    cache_len = args.prefix_length + args.max_new_token
+
+    modes = {
+        "dynamic": lambda: dynamic_decode(model, prefix_embeds, args.max_new_token, device),
+    }
+    static_runner = StaticDecodeRunner(model, args.batch_size, cache_len, compile=False)
+    modes["static"] = lambda: static_decode(static_runner, prefix_embeds, args.max_new_token, device)
+    if not args.no_compile:
+        compiled_runner = StaticDecodeRunner(model, args.batch_size, cache_len, compile=True)
+        modes["static_compiled"] = lambda: static_decode(compiled_runner, prefix_embeds, args.max_new_token, device)
+
+    reference = None
+    with torch.no_grad():
+        for name, fn in modes.items():
+            begin = time.perf_counter()
+            tokens, _ = fn()
+            first_run = time.perf_counter() - begin
+            for _ in range(args.warmup - 1):
+                fn()
+            per_token = []
+            for _ in range(args.repeats):
+                tokens, step_times = fn()
+                per_token.extend(step_times)
+            if reference is None:
+                reference = tokens
+            match = (tokens == reference).float().mean().item()
+            print(
+                f"{name:>16} | first run (incl. compile): {first_run * 1000:9.2f} ms | "
+                f"per-token p50: {statistics.median(per_token) * 1000:7.3f} ms | "
+                f"mean: {statistics.mean(per_token) * 1000:7.3f} ms | "
+                f"token match vs dynamic: {match:.3f}"
+            )
+
+
+if __name__ == "__main__":
+    # python -m experience.efficiency.benchmark_decode --device cpu
+    parser = argparse.ArgumentParser(description="Benchmark dynamic vs static (compiled) decode steps")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--prefix_length", type=int, default=256)
+    parser.add_argument("--max_new_token", type=int, default=32)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--no_compile", action="store_true", help="skip the torch.compile variant")
+    args = parser.parse_args()
+    run(args)
@@ -1,194 +1,466 @@
 ## Copyright (c) Microsoft Corporation.
 ## Licensed under the MIT license.
 
-import time
+import argparse
+import json
+import math
+import os
+import platform
 import sys
+import time
+from typing import Dict, List
+
 import torch
-import argparse
-from torch.cuda.amp import autocast
-from model.model import PCC
-from datasets import load_dataset
+from model.kv_cache import QuantizedKVCache, kv_cache_nbytes
+from model.model import PCC, Converter, compress_segment
+from utils.batch_probe import PROBE_MODES, PeakMemoryMonitor, find_max_batch_size
 
+from .tiny_models import tiny_llama
 
+SCHEMA_VERSION = 1
 
-def run(args):
-    data_path = "BroAlanTaps/efficiency_samples_8k"
-    ds = load_dataset(data_path)['train']
-    device = 'cuda:0'
+LATENCY_STATS = {
+    "type": "object",
+    "required": ["p50", "p95", "p99", "mean", "min", "n"],
+    "properties": {
+        "p50": {"type": "number"},
+        "p95": {"type": "number"},
+        "p99": {"type": "number"},
+        "mean": {"type": "number"},
+        "min": {"type": "number"},
+        "n": {"type": "integer"},
+    },
+}
 
-    ratio = args.ratio
-    batch_size = args.batch_size
-    num_batches = 0  
-
-    input_length = args.input_length
-    generate_length = args.generate_length
-
-    normal_prefilling_total_time = 0
-    nornal_decode_total_time = 0
-
-    comp_prefilling_total_time = 0
-    comp_decode_total_time = 0
-    compress_total_time = 0 
-    
-    args = argparse.Namespace(
-        device=device,
-        compress_model='BroAlanTaps/Stage1-PCC-Lite-4x',
-        converter_model='BroAlanTaps/Stage1-PCC-Lite-4x',
-        decoder_model='meta-llama/Meta-Llama-3-8B-Instruct',
-        stage=2,
-        segment_length=256,
-        embed_len=256 // ratio,
-        drop_out=0,
-        use_lora=False,
-        compressor_gradient_checkpoint=False,
-        decoder_gradient_checkpoint=False
-    )
-    print(args)
-    model = PCC(args).to(device).eval()
-
-    tokenizer = model.compressor.tokenizer
-
-
-
-    for idx, i in enumerate(range(0, len(ds), batch_size)):
-        if idx >= 5:
+# JSON Schema (draft-07) of the result file; `validate` checks the subset used here
+RESULT_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "title": "PCC efficiency benchmark result",
+    "type": "object",
+    "required": ["schema_version", "config", "environment", "latency_ms", "memory_bytes", "kv_cache_bytes"],
+    "properties": {
+        "schema_version": {"type": "integer"},
+        "config": {"type": "object"},
+        "environment": {
+            "type": "object",
+            "required": ["torch", "python", "device", "device_name", "num_threads"],
+        },
+        # compress: whole input, prefill: per batch, *decode*: per generated token
+        "latency_ms": {
+            "type": "object",
+            "required": ["compress", "prefill", "decode", "uncompressed_prefill", "uncompressed_decode"],
+            "additionalProperties": LATENCY_STATS,
+        },
+        # peak of a full compress + prefill + decode run; allocator peak on accelerators, RSS on CPU
+        "memory_bytes": {
+            "type": "object",
+            "required": ["compressed_peak", "uncompressed_peak"],
+            "additionalProperties": {"type": "integer"},
+        },
+        # kv cache after prefill + decode of one batch
+        "kv_cache_bytes": {
+            "type": "object",
+            "required": ["compressed", "uncompressed"],
+            "additionalProperties": {"type": "integer"},
+        },
+        "max_batch_size": {"type": "object", "additionalProperties": {"type": "integer"}},
+        # --kv_cache_bits only: quantized vs full-precision kv cache, teacher-forced on the greedy tokens
+        # of the full-precision cache; untimed, once per timed batch
+        "kv_cache_accuracy": {
+            "type": "object",
+            "required": ["token_agreement", "logits_max_abs_delta", "logits_mean_abs_delta"],
+            "additionalProperties": {"type": "number"},
+        },
+    },
+}
+
+_TYPES = {"object": dict, "number": (int, float), "integer": int, "string": str, "array": list}
+
+
+def validate(value, schema=RESULT_SCHEMA, path="result") -> List[str]:
+    """Errors of `value` against `schema` (type, required, properties, additionalProperties)."""
+    expected = schema.get("type")
+    if expected is not None and (not isinstance(value, _TYPES[expected]) or isinstance(value, bool)):
+        return [f"{path}: expected {expected}, got {type(value).__name__}"]
+    errors = []
+    if isinstance(value, dict):
+        errors += [f"{path}: missing {key}" for key in schema.get("required", []) if key not in value]
+        properties = schema.get("properties", {})
+        for key, item in value.items():
+            item_schema = properties.get(key, schema.get("additionalProperties"))
+            if isinstance(item_schema, dict):
+                errors += validate(item, item_schema, f"{path}.{key}")
+    return errors
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linear interpolation between the closest ranks, as numpy's default."""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    low, high = math.floor(position), math.ceil(position)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    ms = [s * 1000 for s in seconds]
+    return {
+        "p50": percentile(ms, 50),
+        "p95": percentile(ms, 95),
+        "p99": percentile(ms, 99),
+        "mean": sum(ms) / len(ms),
+        "min": min(ms),
+        "n": len(ms),
+    }
+
+
+def _sync(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+class PCCPipeline:
+    """A PCC checkpoint; decoder inputs are framed by <mem> / </mem> as in `Decoder.generate`."""
+    def __init__(self, args, device):
+        model_args = argparse.Namespace(
+            device=str(device),
+            compress_model=args.compress_model,
+            converter_model=args.converter_model,
+            decoder_model=args.decoder_model,
+            stage=2,
+            segment_length=args.segment_length,
+            embed_len=args.segment_length // args.ratio,
+            drop_out=0,
+            use_lora=False,
+            compressor_gradient_checkpoint=False,
+            decoder_gradient_checkpoint=False,
+        )
+        self.model = PCC(model_args).to(device).eval()
+        self.decoder = self.model.decoder.model
+        self.compress_vocab_size = min(self.model.compressor.mem_ids)
+        self.decoder_vocab_size = self.decoder.config.vocab_size
+        self.compress_tokenizer = self.model.compressor.tokenizer
+        self.decoder_tokenizer = self.model.decoder.tokenizer
+
+    def compress(self, input_ids):
+        return self.model.compress(input_ids)
+
+    def prefix(self, memory):
+        return self.model.decoder._get_segment_mem(memory)
+
+
+class TinyPipeline:
+    """Randomly initialized tiny compressor, converter and decoder with the PCC segment logic, for CPU runs."""
+    def __init__(self, args, device):
+        self.segment_length = args.segment_length
+        self.embed_len = args.segment_length // args.ratio
+        self.compressor = tiny_llama(hidden_size=args.tiny_hidden_size, num_layers=args.tiny_layers).to(device)
+        self.decoder = tiny_llama(hidden_size=args.tiny_llm_hidden_size, num_layers=args.tiny_layers, seed=1).to(device)
+        vocab_size = self.compressor.config.vocab_size
+        # the last vocabulary entries stand in for the <mem_i> tokens
+        self.mem_ids = list(range(vocab_size - self.embed_len, vocab_size))
+        self.compress_vocab_size = vocab_size - self.embed_len
+        self.decoder_vocab_size = self.decoder.config.vocab_size
+        # Converter computes in bf16
+        self.converter = Converter(
+            embed_dim=args.tiny_hidden_size, embed_len=self.embed_len, llm_dim=args.tiny_llm_hidden_size
+        ).to(device=device, dtype=torch.bfloat16).eval()
+
+    def compress(self, input_ids):
+        memories = [
+            compress_segment(self.compressor, input_ids[:, i:i + self.segment_length], self.mem_ids, self.embed_len)
+            for i in range(0, input_ids.size(1), self.segment_length)
+        ]
+        return self.converter(torch.cat(memories, dim=1))
+
+    def prefix(self, memory):
+        return memory
+
+
+def timed_decode(decoder, prefix_embeds, max_new_token, device, past_key_values=None):
+    """Prefill `prefix_embeds`, then greedy-decode; returns prefill seconds, per-token seconds and the cache."""
+    _sync(device)
+    begin = time.perf_counter()
+    out = decoder(inputs_embeds=prefix_embeds.to(decoder.dtype), past_key_values=past_key_values, use_cache=True)
+    _sync(device)
+    prefill_seconds = time.perf_counter() - begin
+
+    past_key_values = out.past_key_values
+    next_tokens = torch.argmax(out.logits[:, -1, :], dim=-1)
+    step_seconds = []
+    for _ in range(1, max_new_token):
+        begin = time.perf_counter()
+        token_embeds = decoder.get_input_embeddings()(next_tokens.unsqueeze(1))
+        out = decoder(inputs_embeds=token_embeds, past_key_values=past_key_values, use_cache=True)
+        past_key_values = out.past_key_values
+        next_tokens = torch.argmax(out.logits[:, -1, :], dim=-1)
+        _sync(device)
+        step_seconds.append(time.perf_counter() - begin)
+    return prefill_seconds, step_seconds, past_key_values
+
+
+def kv_cache_accuracy(decoder, prefix_embeds, max_new_token, bits) -> Dict[str, float]:
+    """
+    Greedy decoding with the full-precision kv cache, with the quantized cache fed the same tokens
+    in lockstep: share of equal argmax tokens and the logits delta over all steps.
+    """
+    prefix_embeds = prefix_embeds.to(decoder.dtype)
+    out = decoder(inputs_embeds=prefix_embeds, use_cache=True)
+    quant_out = decoder(inputs_embeds=prefix_embeds, past_key_values=QuantizedKVCache(bits), use_cache=True)
+    agree, total, max_delta, delta_sum = 0, 0, 0.0, 0.0
+    for step in range(max_new_token):
+        logits, quant_logits = out.logits[:, -1, :].float(), quant_out.logits[:, -1, :].float()
+        next_tokens = torch.argmax(logits, dim=-1)
+        agree += (torch.argmax(quant_logits, dim=-1) == next_tokens).sum().item()
+        total += next_tokens.numel()
+        delta = (quant_logits - logits).abs()
+        max_delta = max(max_delta, delta.max().item())
+        delta_sum += delta.mean().item()
+        if step == max_new_token - 1:
             break
-        
-        # Collect data
-        data = ds[i:i + batch_size]
-        batch_texts = [item for item in data['text']]
-        compress_ids = tokenizer(batch_texts, max_length=input_length, truncation=True, padding=True, return_tensors='pt')['input_ids'].to(device)
-        llm_ids = model.decoder.tokenizer(batch_texts, max_length=input_length, truncation=True, padding=True, return_tensors='pt')['input_ids'].to(device)
-        print(compress_ids.shape)
-        print("-" * 25 + "Begin Test" + "-" * 25)
-        # break
-        with torch.no_grad():
-            with torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16):
-                # Normal Mode(Only LLM):
-                # Normal Prefilling
-                past_key_values = None
-                torch.cuda.synchronize()
-                normal_prefilling_begin_time = time.time()
-                llm_embedding = model.decoder.model.get_input_embeddings()(llm_ids)
-                outputs = model.decoder.model(inputs_embeds=llm_embedding,past_key_values=past_key_values,use_cache=True)
-                past_key_values = outputs.past_key_values
-                torch.cuda.synchronize()
-                normal_prefilling_end_time = time.time()
-                print(f"Normal Prefilling time: {(normal_prefilling_end_time - normal_prefilling_begin_time) * 1000:.3f} ms")
-
-                # Normal Decoding
-                torch.cuda.synchronize()
-                start_normal_decode_time = time.time()
-                next_token_logits = outputs.logits[:, -1, :]
-                next_tokens = torch.argmax(next_token_logits, dim=-1)
-            
-                for _ in range(1, generate_length):
-                    current_token_embeds = model.decoder.model.get_input_embeddings()(next_tokens.unsqueeze(1))
-                    with autocast(dtype=torch.bfloat16):
-                        outputs = model.decoder.model(
-                            inputs_embeds=current_token_embeds,
-                            past_key_values=past_key_values,
-                            use_cache=True
-                        )
-                    past_key_values = outputs.past_key_values
-                    next_token_logits = outputs.logits[:, -1, :]
-                    next_tokens = torch.argmax(next_token_logits, dim=-1)
-                
-                
-                # torch.cuda.synchronize()
-                end_normal_decode_time = time.time()
-
-                # Compressed Mode(With Compression):
-                torch.cuda.synchronize()
-                start_comp_time = time.time()
-                compress_embedding = model(compress_ids=compress_ids, llm_ids=None, get_embedding=True).to(device)
-                torch.cuda.synchronize()
-                end_comp_time = time.time()            
-
-                # Compression Prefilling:
-                pcc_past_key_values = None
-                torch.cuda.synchronize()
-                com_prefilling_begin_time = time.time()
-                print(f"Compression Prefilling begin, input shape: {compress_embedding.shape}")
-                pcc_outputs = model.decoder.model(inputs_embeds=compress_embedding,past_key_values=pcc_past_key_values,use_cache=True)
-                pcc_past_key_values = pcc_outputs.past_key_values
-                torch.cuda.synchronize()
-                comp_prefilling_end_time = time.time()
-                print(f"Comp Prefilling time: {(comp_prefilling_end_time - com_prefilling_begin_time) * 1000:.3f} ms")
-                
-                
-                # Compression Decoding:
-                torch.cuda.synchronize()
-                start_com_decode_time = time.time()
-                next_token_logits = pcc_outputs.logits[:, -1, :]
-                next_tokens = torch.argmax(next_token_logits, dim=-1)
-
-                for _ in range(1, generate_length):
-                    current_token_embeds = model.decoder.model.get_input_embeddings()(next_tokens.unsqueeze(1))
-                    with torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16):
-                        pcc_outputs = model.decoder.model(
-                            inputs_embeds=current_token_embeds,
-                            past_key_values=pcc_past_key_values,
-                            use_cache=True
-                        )
-                    pcc_past_key_values = pcc_outputs.past_key_values
-                    next_token_logits = pcc_outputs.logits[:, -1, :]
-                    next_tokens = torch.argmax(next_token_logits, dim=-1)
-                
-                torch.cuda.synchronize()
-                end_com_decode_time = time.time()
-    
-                
-                
-        if idx == 0:
+        token_embeds = decoder.get_input_embeddings()(next_tokens.unsqueeze(1))
+        out = decoder(inputs_embeds=token_embeds, past_key_values=out.past_key_values, use_cache=True)
+        quant_out = decoder(inputs_embeds=token_embeds, past_key_values=quant_out.past_key_values, use_cache=True)
+    return {
+        "token_agreement": agree / total,
+        "logits_max_abs_delta": max_delta,
+        "logits_mean_abs_delta": delta_sum / max_new_token,
+    }
+
+
+class BatchSource:
+    """Synthetic random ids, or texts of `--dataset` tokenized with both tokenizers (PCC models only)."""
+    def __init__(self, args, pipeline, device):
+        self.args = args
+        self.pipeline = pipeline
+        self.device = device
+        self.generator = torch.Generator().manual_seed(args.seed)
+        self.texts = None
+        if args.dataset is not None:
+            if not isinstance(pipeline, PCCPipeline):
+                raise ValueError("--dataset needs the tokenizers of --model pcc")
+            from datasets import load_dataset
+            self.texts = load_dataset(args.dataset)["train"]["text"]
+        self.offset = 0
+
+    def next(self, batch_size):
+        length = self.args.input_length
+        if self.texts is None:
+            compress_ids = torch.randint(0, self.pipeline.compress_vocab_size, (batch_size, length), generator=self.generator)
+            llm_ids = torch.randint(0, self.pipeline.decoder_vocab_size, (batch_size, length), generator=self.generator)
+            return compress_ids.to(self.device), llm_ids.to(self.device)
+        texts = [self.texts[(self.offset + i) % len(self.texts)] for i in range(batch_size)]
+        self.offset += batch_size
+        kwargs = dict(max_length=length, truncation=True, padding=True, return_tensors="pt")
+        compress_ids = self.pipeline.compress_tokenizer(texts, **kwargs)["input_ids"]
+        llm_ids = self.pipeline.decoder_tokenizer(texts, **kwargs)["input_ids"]
+        return compress_ids.to(self.device), llm_ids.to(self.device)
+
+
+def run_trial(pipeline, compress_ids, llm_ids, args, device):
+    """
+    One batch through compression, compressed and uncompressed prefill + decode, and with
+    --kv_cache_bits the quantized kv cache, timed, plus its untimed `kv_cache_accuracy`.
+    """
+    timings, kv_bytes, accuracy = {}, {}, None
+    _sync(device)
+    begin = time.perf_counter()
+    memory = pipeline.compress(compress_ids)
+    _sync(device)
+    timings["compress"] = [time.perf_counter() - begin]
+
+    prefix = pipeline.prefix(memory)
+    prefill, steps, cache = timed_decode(pipeline.decoder, prefix, args.generate_length, device)
+    timings["prefill"], timings["decode"] = [prefill], steps
+    kv_bytes["compressed"] = kv_cache_nbytes(cache)
+
+    embeds = pipeline.decoder.get_input_embeddings()(llm_ids)
+    prefill, steps, cache = timed_decode(pipeline.decoder, embeds, args.generate_length, device)
+    timings["uncompressed_prefill"], timings["uncompressed_decode"] = [prefill], steps
+    kv_bytes["uncompressed"] = kv_cache_nbytes(cache)
+
+    if args.kv_cache_bits:
+        name = f"int{args.kv_cache_bits}"
+        prefill, steps, cache = timed_decode(
+            pipeline.decoder, prefix, args.generate_length, device, past_key_values=QuantizedKVCache(args.kv_cache_bits)
+        )
+        timings[f"prefill_{name}_kv"], timings[f"decode_{name}_kv"] = [prefill], steps
+        kv_bytes[f"compressed_{name}"] = kv_cache_nbytes(cache)
+        accuracy = kv_cache_accuracy(pipeline.decoder, prefix, args.generate_length, args.kv_cache_bits)
+    return timings, kv_bytes, accuracy
+
+
+def peak_memory(pipeline, compress_ids, llm_ids, args, device) -> Dict[str, int]:
+    """Peak of one untimed compressed and one uncompressed run, outside the timed trials."""
+    peaks = {}
+    with PeakMemoryMonitor(str(device)) as monitor:
+        timed_decode(pipeline.decoder, pipeline.prefix(pipeline.compress(compress_ids)), args.generate_length, device)
+    peaks["compressed_peak"] = int(monitor.peak_bytes)
+    with PeakMemoryMonitor(str(device)) as monitor:
+        embeds = pipeline.decoder.get_input_embeddings()(llm_ids)
+        timed_decode(pipeline.decoder, embeds, args.generate_length, device)
+    peaks["uncompressed_peak"] = int(monitor.peak_bytes)
+    return peaks
+
+
+def compare(result: dict, baseline: dict, tolerance: float, accuracy_tolerance: float) -> List[dict]:
+    """
+    Metrics of `result` against `baseline`: latencies, memory, kv bytes and logits deltas regress when
+    more than `tolerance` (relative) above it, token agreement when more than `accuracy_tolerance` below.
+    """
+    rows = []
+    for name, stats in result["latency_ms"].items():
+        if name not in baseline.get("latency_ms", {}):
             continue
-        
-        compress_batch_time = end_comp_time - start_comp_time
-        compress_total_time += compress_batch_time
-        
-        comp_prefilling_batch_time = comp_prefilling_end_time - com_prefilling_begin_time
-        comp_prefilling_total_time += comp_prefilling_batch_time
-        
-        comp_decode_batch_time = end_com_decode_time - start_com_decode_time
-        comp_decode_total_time += comp_decode_batch_time
-        
-        normal_prefilling_batch_time = normal_prefilling_end_time - normal_prefilling_begin_time
-        normal_prefilling_total_time += normal_prefilling_batch_time
-        
-        normal_decode_batch_time = end_normal_decode_time - start_normal_decode_time
-        nornal_decode_total_time += normal_decode_batch_time
-        
-        num_batches += 1
-        
-        
-    compress_average_time = compress_total_time / num_batches if num_batches > 0 else 0
-    compress_prefilling_average_time = comp_prefilling_total_time / num_batches if num_batches > 0 else 0
-    compress_decode_average_time = comp_decode_total_time / num_batches if num_batches > 0 else 0
-
-    normal_prefilling_average_time = normal_prefilling_total_time / num_batches if num_batches > 0 else 0
-    normal_decode_average_time = nornal_decode_total_time / num_batches if num_batches > 0 else 0
-
-
-    log_file = open(f"./experience/efficiency/input{input_length}_generate{generate_length}_batch{batch_size}.log", "w")
-    original_stdout = sys.stdout
-    sys.stdout = log_file
-
-    print(f"-"*20 + "Final Result" + "-"*20)
-    print(f"Setting: \ninput_length {input_length} \ngenerate_length {generate_length} \nbatch_size {batch_size} \nratio {ratio}")
-
-    print(f"Average compression time: {compress_average_time * 1000:.2f} ms")
-    print(f"Average comp. prefilling time : {compress_prefilling_average_time * 1000:.2f} ms")
-    print(f"Average comp. decoding time: {compress_decode_average_time * 1000:.2f} ms")
-
-    print(f"Average normal prefilling time: {normal_prefilling_average_time * 1000:.2f} ms")
-    print(f"Average normal decoding time: {normal_decode_average_time * 1000:.2f} ms")
+        for stat in ("p50", "p95", "p99"):
+            rows.append((f"latency_ms.{name}.{stat}", stats[stat], baseline["latency_ms"][name][stat]))
+    for section in ("memory_bytes", "kv_cache_bytes", "kv_cache_accuracy"):
+        for name, value in result.get(section, {}).items():
+            if name == "token_agreement":
+                continue
+            if name in baseline.get(section, {}):
+                rows.append((f"{section}.{name}", value, baseline[section][name]))
+    comparison = []
+    for metric, current, base in rows:
+        ratio = current / base if base else float("inf") if current else 1.0
+        comparison.append({
+            "metric": metric, "current": current, "baseline": base, "ratio": ratio,
+            "regression": ratio > 1 + tolerance,
+        })
+    if "kv_cache_accuracy" in result and "kv_cache_accuracy" in baseline:
+        current, base = result["kv_cache_accuracy"]["token_agreement"], baseline["kv_cache_accuracy"]["token_agreement"]
+        comparison.append({
+            "metric": "kv_cache_accuracy.token_agreement", "current": current, "baseline": base,
+            "ratio": current / base if base else 1.0, "regression": current < base - accuracy_tolerance,
+        })
+    return comparison
+
+
+def run(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    pipeline = PCCPipeline(args, device) if args.model == "pcc" else TinyPipeline(args, device)
+
+    batch_size = args.batch_size
+    if batch_size <= 0:
+        if not isinstance(pipeline, PCCPipeline) or args.memory_budget_gb <= 0:
+            raise ValueError("probing the batch size needs --model pcc and --memory_budget_gb")
+        # largest batch that fits the budget for compression, compressed and normal decoding
+        batch_size = min(
+            find_max_batch_size(pipeline.model, [args.input_length], args.memory_budget_gb * 1024 ** 3, mode=mode,
+                                max_new_token=args.generate_length)["batch_size"]
+            for mode in PROBE_MODES
+        )
+        print(f"Probed batch size under {args.memory_budget_gb} GB: {batch_size}")
+
+    source = BatchSource(args, pipeline, device)
+    timings: Dict[str, List[float]] = {}
+    kv_bytes: Dict[str, int] = {}
+    accuracies: List[Dict[str, float]] = []
+    autocast = torch.autocast(device.type, dtype=torch.bfloat16, enabled=device.type == "cuda")
+    with torch.no_grad(), autocast:
+        for trial in range(args.warmup + args.trials):
+            compress_ids, llm_ids = source.next(batch_size)
+            trial_timings, kv_bytes, accuracy = run_trial(pipeline, compress_ids, llm_ids, args, device)
+            if trial < args.warmup:
+                continue
+            for name, seconds in trial_timings.items():
+                timings.setdefault(name, []).extend(seconds)
+            if accuracy is not None:
+                accuracies.append(accuracy)
+        memory_bytes = peak_memory(pipeline, compress_ids, llm_ids, args, device)
+
+    result = {
+        "schema_version": SCHEMA_VERSION,
+        "config": {**vars(args), "batch_size": batch_size},
+        "environment": {
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "device": str(device),
+            "device_name": torch.cuda.get_device_name(device) if device.type == "cuda" else platform.processor(),
+            "num_threads": torch.get_num_threads(),
+        },
+        "latency_ms": {name: summarize(seconds) for name, seconds in timings.items()},
+        "memory_bytes": memory_bytes,
+        "kv_cache_bytes": kv_bytes,
+    }
+    if accuracies:
+        result["kv_cache_accuracy"] = {
+            "token_agreement": sum(a["token_agreement"] for a in accuracies) / len(accuracies),
+            "logits_max_abs_delta": max(a["logits_max_abs_delta"] for a in accuracies),
+            "logits_mean_abs_delta": sum(a["logits_mean_abs_delta"] for a in accuracies) / len(accuracies),
+        }
+    if args.memory_budget_gb > 0:
+        # rough kv-bound capacity: weights are resident once, every sequence adds its own kv cache
+        modules = [pipeline.model] if isinstance(pipeline, PCCPipeline) else [pipeline.compressor, pipeline.converter, pipeline.decoder]
+        weight_bytes = sum(p.numel() * p.element_size() for module in modules for p in module.parameters())
+        free_bytes = max(args.memory_budget_gb * 1024 ** 3 - weight_bytes, 0)
+        result["max_batch_size"] = {
+            name: int(free_bytes // (value / batch_size)) for name, value in kv_bytes.items() if value > 0
+        }
+    errors = validate(result)
+    if errors:
+        raise ValueError("benchmark result does not match its schema:\n" + "\n".join(errors))
+
+    print(f"{'latency (ms)':<28}{'p50':>10}{'p95':>10}{'p99':>10}{'n':>6}")
+    for name, stats in result["latency_ms"].items():
+        print(f"{name:<28}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}{stats['n']:>6}")
+    for section in ("memory_bytes", "kv_cache_bytes", "max_batch_size", "kv_cache_accuracy"):
+        for name, value in result.get(section, {}).items():
+            print(f"{section}.{name}: {value}")
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key in ("model", "batch_size", "input_length", "generate_length", "ratio", "device", "kv_cache_bits"):
+            if baseline["config"].get(key) != result["config"].get(key):
+                print(f"warning: {key} differs from the baseline ({baseline['config'].get(key)} vs {result['config'].get(key)})")
+        result["comparison"] = compare(result, baseline, args.tolerance, args.accuracy_tolerance)
+        regressions = [row for row in result["comparison"] if row["regression"]]
+        for row in regressions:
+            print(f"REGRESSION {row['metric']}: {row['current']:.3f} vs baseline {row['baseline']:.3f} ({row['ratio']:.2f}x)")
+        print(f"{len(regressions)} regressions over {args.tolerance:.0%} against {args.baseline}")
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if regressions:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
+    # python -m experience.efficiency.evaluate_efficiency --model tiny --device cpu --output bench.json
     parser = argparse.ArgumentParser(description="Evaluate PCC Efficiency")
+    parser.add_argument("--model", type=str, default="pcc", choices=["pcc", "tiny"],
+                        help="a PCC checkpoint, or randomly initialized tiny models that run on CPU")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--compress_model", type=str, default="BroAlanTaps/Stage1-PCC-Lite-4x")
+    parser.add_argument("--converter_model", type=str, default="BroAlanTaps/Stage1-PCC-Lite-4x")
+    parser.add_argument("--decoder_model", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct")
+    parser.add_argument("--dataset", type=str, default=None,
+                        help="e.g. BroAlanTaps/efficiency_samples_8k (its `text` column); synthetic ids if not set")
     parser.add_argument("--ratio", type=int, default=4, help="Compression ratio")
-    parser.add_argument("--batch_size", type=int, default=8, help="Batch size for evaluation")
+    parser.add_argument("--segment_length", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=8, help="Batch size for evaluation, <= 0 probes the largest batch under --memory_budget_gb")
     parser.add_argument("--input_length", type=int, default=1024, help="Input length for the model")
     parser.add_argument("--generate_length", type=int, default=32, help="Length of the generated sequence")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed batches before the trials")
+    parser.add_argument("--trials", type=int, default=10, help="timed batches")
+    parser.add_argument("--kv_cache_bits", type=int, default=None, choices=[4, 8], help="Also benchmark a quantized kv cache")
+    parser.add_argument("--memory_budget_gb", type=float, default=0, help="Device memory budget used to estimate (or probe) the max batch size")
+    parser.add_argument("--tiny_hidden_size", type=int, default=64)
+    parser.add_argument("--tiny_llm_hidden_size", type=int, default=128)
+    parser.add_argument("--tiny_layers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="write the result JSON (see RESULT_SCHEMA) here")
+    parser.add_argument("--baseline", type=str, default=None, help="result JSON to compare against; exits 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown / growth counted as a regression")
+    parser.add_argument("--accuracy_tolerance", type=float, default=0.01,
+                        help="drop in quantized-kv token agreement (absolute) counted as a regression")
+    parser.add_argument("--print_schema", action="store_true", help="print the result JSON schema and exit")
     args = parser.parse_args()
-    run(args)
\ No newline at end of file
+    if args.print_schema:
+        print(json.dumps(RESULT_SCHEMA, indent=2))
+    else:
+        run(args)
@@ -0,0 +1,29 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+
+def tiny_llama(
+    vocab_size: int = 512,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    num_heads: int = 4,
+    num_kv_heads: int = 2,
+    max_positions: int = 4096,
+    dtype: torch.dtype = torch.float32,
+    seed: int = 0,
+):
+    """Randomly initialized Llama-architecture decoder small enough for CPU benchmarks."""
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        num_key_value_heads=num_kv_heads,
+        max_position_embeddings=max_positions,
+    )
+    return LlamaForCausalLM(config).to(dtype).eval()
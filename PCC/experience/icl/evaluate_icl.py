@@ -4,6 +4,7 @@
 import argparse
 import copy
 import itertools
+import json
 import os
 import random
 import sys
@@ -19,6 +20,7 @@ from tqdm import tqdm
 
 from .icl_dataset_loading import get_dataset
 from ..dataclass import Config
+from ..parallel import shard_range
 
 
 def read_args():
@@ -42,6 +44,10 @@ def read_args():
     parser.add_argument('--segment_length',type=int,default=256)
     parser.add_argument('--compressor_gradient_checkpoint', type=bool, default=False)
     parser.add_argument('--decoder_gradient_checkpoint', type=bool, default=False)
+    parser.add_argument('--device', type=str, default="cuda:0")
+    parser.add_argument('--num_shards', type=int, default=1, help="set by experience/parallel.py")
+    parser.add_argument('--shard_index', type=int, default=0)
+    parser.add_argument('--shard_output', type=str, default=None, help="JSONL rows of this shard")
     
     args = parser.parse_args()
     return args
@@ -299,7 +305,7 @@ def main(args):
     use_plaintext_demonstrations = (args.num_plaintext_demonstrations > 0)
     
     config = Config(
-        device="cuda:0",
+        device=args.device,
         dataset=args.dataset,
         compress_model=args.compress_model,
         adapter_model=args.adapter_model,
@@ -317,7 +323,7 @@ def main(args):
     )
     
     is_ac = True
-    device = 'cuda:0'
+    device = args.device
     all_model = PCC(config).to(device).eval()
     all_model.compressor.eval()
     all_model.converter.eval()
@@ -362,8 +368,11 @@ def main(args):
     num_total = 0
     skip = False # flag for skipping examples that are too long
 
-    progress_bar = tqdm(prompt_generator, mininterval=0)
-    for example in progress_bar:
+    # every worker of experience/parallel.py samples the same demonstrations and scores its slice of the test set
+    indices = shard_range(len(prompt_generator), args.num_shards, args.shard_index)
+    shard_file = open(args.shard_output, "w", encoding="utf-8") if args.shard_output is not None else None
+    progress_bar = tqdm((prompt_generator[i] for i in indices), total=len(indices), mininterval=0)
+    for index, example in zip(indices, progress_bar):
         if args.use_calibration and dataset["recalibrate_every"]:
             calibration_nlls = prompt_generator.get_calibration_nlls(
                 example["test_example"], 
@@ -406,7 +415,17 @@ def main(args):
         num_correct += int(nll_answer == example["answer_idx"])
         num_total += 1
         progress_bar.set_postfix({"accuracy": num_correct / num_total}, refresh=False)
+        if shard_file is not None:
+            shard_file.write(json.dumps({
+                "index": index,
+                "prediction": nll_answer,
+                "answer_idx": example["answer_idx"],
+                "correct": int(nll_answer == example["answer_idx"]),
+            }) + "\n")
+            shard_file.flush()
             
+    if shard_file is not None:
+        shard_file.close()
     print("Accuracy:", num_correct / num_total)
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+TASKS = {
+    "qa": "experience.qa.evaluate_qa",
+    "reconstruction": "experience.reconstruction.evaluate_ae",
+    "icl": "experience.icl.evaluate_icl",
+}
+
+
+def shard_range(num_examples: int, num_shards: int, shard_index: int) -> range:
+    """Contiguous slice of `num_examples` for one of `num_shards` workers; sizes differ by at most one."""
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard_index {shard_index} is out of [0, {num_shards - 1}]")
+    size, rest = divmod(num_examples, num_shards)
+    begin = shard_index * size + min(shard_index, rest)
+    return range(begin, begin + size + (shard_index < rest))
+
+
+def read_shards(files):
+    rows = []
+    for file in files:
+        with open(file, encoding="utf-8") as f:
+            rows.extend(json.loads(line) for line in f if line.strip())
+    return rows
+
+
+def merge_qa(rows, eval_args):
+    from .qa.evaluate_qa import score
+
+    dataset = _arg_value(eval_args, "--dataset")
+    scores = [score(row["generate"], row["label"], dataset) for row in rows]
+    num_examples = len(rows)
+    decode_ms = sum(row["decode_ms"] for row in rows)
+    return {
+        "dataset": dataset,
+        "num_examples": num_examples,
+        "f1": sum(f1 for f1, _ in scores) / num_examples,
+        "em": sum(em for _, em in scores) / num_examples,
+        "compress_ms": sum(row["compress_ms"] for row in rows) / num_examples,
+        "prefill_ms": sum(row["prefill_ms"] for row in rows) / num_examples,
+        "decode_ms": decode_ms / num_examples,
+        "decode_ms_per_token": decode_ms / max(sum(row["new_tokens"] for row in rows) - num_examples, 1),
+        "prefix_tokens": sum(row["prefix_tokens"] for row in rows) / num_examples,
+    }
+
+
+def merge_reconstruction(rows, eval_args):
+    # sentence-level scores, so the corpus average is the mean over all examples
+    keys = ["bleu", "bleu-1", "bleu-2", "bleu-3", "bleu-4", "rougeL"]
+    summary = {"num_examples": len(rows)}
+    summary.update({key: sum(row[key] for row in rows) / len(rows) for key in keys})
+    return summary
+
+
+def merge_icl(rows, eval_args):
+    num_correct = sum(row["correct"] for row in rows)
+    return {"num_examples": len(rows), "num_correct": num_correct, "accuracy": num_correct / len(rows)}
+
+
+MERGE = {"qa": merge_qa, "reconstruction": merge_reconstruction, "icl": merge_icl}
+
+
+def _arg_value(argv, name):
+    return argv[argv.index(name) + 1] if name in argv else None
+
+
+def _cpu_groups(num_workers):
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    size = max(len(cpus) // num_workers, 1)
+    return [cpus[i * size:(i + 1) * size] or cpus for i in range(num_workers)]
+
+
+def fit_pq_codebook(args, eval_args, devices, cpu):
+    """
+    qa with --memory_codec pq: fit the codebook once, before the workers start, so that every shard
+    encodes with the same one. Without --pq_codebook it is fitted for this launch in `output_dir`.
+    """
+    codebook = _arg_value(eval_args, "--pq_codebook")
+    if codebook is None:
+        codebook = os.path.join(args.output_dir, "pq_codebook.pt")
+        if os.path.exists(codebook):
+            os.remove(codebook)
+        eval_args = [*eval_args, "--pq_codebook", codebook]
+    if os.path.exists(codebook):
+        return eval_args
+
+    env = dict(os.environ)
+    env["CUDA_VISIBLE_DEVICES"] = "" if cpu else devices[0]
+    cmd = [sys.executable, "-m", TASKS[args.task], *eval_args, "--device", "cpu" if cpu else "cuda:0", "--fit_codebook_only"]
+    print(f"fitting {codebook}: {' '.join(cmd)}")
+    with open(os.path.join(args.output_dir, "fit_codebook.log"), "w") as log:
+        if subprocess.call(cmd, env=env, stdout=log, stderr=subprocess.STDOUT) != 0:
+            raise RuntimeError(f"fitting the PQ codebook failed, see {log.name}")
+    return eval_args
+
+
+def launch(args, eval_args):
+    """One evaluator process per shard, each on its own GPU or group of CPU cores; returns the shard files."""
+    os.makedirs(args.output_dir, exist_ok=True)
+    devices = args.devices.split(",")
+    cpu = devices == ["cpu"]
+    num_workers = args.num_workers or (1 if cpu else len(devices))
+    cpu_groups = _cpu_groups(num_workers) if cpu else None
+    if args.task == "qa" and _arg_value(eval_args, "--memory_codec") == "pq":
+        eval_args = fit_pq_codebook(args, eval_args, devices, cpu)
+
+    workers = []
+    for index in range(num_workers):
+        shard_file = os.path.join(args.output_dir, f"shard_{index}-of-{num_workers}.jsonl")
+        env = dict(os.environ)
+        preexec_fn = None
+        if cpu:
+            threads = str(len(cpu_groups[index]))
+            env.update(OMP_NUM_THREADS=threads, MKL_NUM_THREADS=threads, CUDA_VISIBLE_DEVICES="")
+            if hasattr(os, "sched_setaffinity"):
+                preexec_fn = lambda group=cpu_groups[index]: os.sched_setaffinity(0, group)
+            device = "cpu"
+        else:
+            # every worker sees only its own GPU
+            env["CUDA_VISIBLE_DEVICES"] = devices[index % len(devices)]
+            device = "cuda:0"
+        cmd = [
+            sys.executable, "-m", TASKS[args.task], *eval_args,
+            "--device", device,
+            "--num_shards", str(num_workers),
+            "--shard_index", str(index),
+            "--shard_output", shard_file,
+        ]
+        log = open(os.path.join(args.output_dir, f"worker_{index}.log"), "w")
+        print(f"worker {index}: {' '.join(cmd)}")
+        process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT, preexec_fn=preexec_fn)
+        workers.append((process, log, shard_file))
+
+    failed = []
+    for index, (process, log, _) in enumerate(workers):
+        if process.wait() != 0:
+            failed.append(log.name)
+        log.close()
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {num_workers} workers failed, see {', '.join(failed)}")
+    return [shard_file for _, _, shard_file in workers]
+
+
+def main():
+    # python -m experience.parallel --task qa --devices 0,1,2,3 -- --dataset nq --compress_model_path ...
+    parser = argparse.ArgumentParser(description="Data-parallel evaluation: shard, run one evaluator per worker, merge",
+                                     allow_abbrev=False)
+    parser.add_argument("--task", type=str, required=True, choices=list(TASKS))
+    parser.add_argument("--devices", type=str, default="0", help="comma-separated GPU ids, or 'cpu'")
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="default: one per GPU; on CPU the cores are split evenly between the workers")
+    parser.add_argument("--output_dir", type=str, default="./result/parallel")
+    parser.add_argument("--merge_only", action="store_true", help="merge the shards of an earlier launch")
+    args, eval_args = parser.parse_known_args()
+    if eval_args and eval_args[0] == "--":
+        eval_args = eval_args[1:]
+
+    if args.merge_only:
+        shard_files = sorted(
+            os.path.join(args.output_dir, file) for file in os.listdir(args.output_dir)
+            if file.startswith("shard_") and file.endswith(".jsonl")
+        )
+    else:
+        shard_files = launch(args, eval_args)
+    rows = read_shards(shard_files)
+    summary = MERGE[args.task](rows, eval_args)
+    with open(os.path.join(args.output_dir, "merged.jsonl"), "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    with open(os.path.join(args.output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    print('-'*50 + "result" + '-'*50)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,44 +2,170 @@
 ## Licensed under the MIT license.
 
 import argparse
+import hashlib
 import json
+import math
 import os
+import time
 
 import torch
 from datasets import load_dataset, load_from_disk
-from model.model import PCC
+from datasets.fingerprint import Hasher
+from model.memory_codec import MemoryCodec
+from model.model import PCC, Decoder
 from torch.cuda.amp import autocast
 from tqdm import tqdm
 from transformers import AutoTokenizer
+from utils.batch_probe import find_max_batch_size
+from utils.checkpoint import atomic_write
 
 from ..dataclass import Config
+from ..parallel import shard_range
 from .utils import exact_match_score, qa_f1_score
 
 
-def cal_avg_token(example: dict,
-                  lm_tokenizer: AutoTokenizer,
-                  dataset: str):
-    context = None
+# bump when the cached columns change, so that old caches are rebuilt
+TOKENIZE_VERSION = 2
 
+def tokenize_qa(batch: dict, dataset: str, lm_tokenizer, compress_tokenizer=None):
+    """
+    Build every context once and tokenize it with the decoder and (if given) the compressor
+    tokenizer. `sum_token` counts the decoder tokens with special tokens, as used by the filter.
+    """
     if dataset == "nq":
-        context = [text['text'] for text in example['positive_passages']]
-        context = "\n\n".join(context)
+        contexts = ["\n\n".join([text['text'] for text in passages]) for passages in batch['positive_passages']]
     elif dataset in ["hotpotqa", "squad", "adqa"]:
-        context = example['context']
+        contexts = batch['context']
     else:
         raise NotImplementedError(f"dataset {dataset} not supported!")
-    return {"sum_token": len(lm_tokenizer(context)['input_ids'])} 
+    llm_ids = lm_tokenizer(contexts, add_special_tokens=False)['input_ids']
+    num_special = lm_tokenizer.num_special_tokens_to_add()
+    columns = {
+        "context": contexts,
+        "llm_ids": llm_ids,
+        "sum_token": [len(ids) + num_special for ids in llm_ids],
+    }
+    if compress_tokenizer is not None:
+        compress_ids = compress_tokenizer(contexts, truncation=False)['input_ids']
+        columns.update(compress_ids=compress_ids, compress_len=[len(ids) for ids in compress_ids])
+    return columns
+
+def tokenize_fingerprint(dataset, config: Config, lm_tokenizer, compress_tokenizer=None) -> str:
+    """Hash of the raw dataset and everything that changes the tokenized columns."""
+    settings = {
+        "version": TOKENIZE_VERSION,
+        "dataset": [config.dataset, dataset._fingerprint],
+        # the whole tokenizer (vocab, merges, normalizer, special tokens, chat template), not only its name
+        "decoder_tokenizer": Hasher.hash(lm_tokenizer),
+        "compress_tokenizer": None if compress_tokenizer is None else Hasher.hash(compress_tokenizer),
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+def preprocess(dataset, config: Config, lm_tokenizer, compress_tokenizer=None, num_proc: int = 64):
+    """
+    Tokenized dataset (see `tokenize_qa`), kept in an Arrow file under `config.cache_dir` keyed by
+    `tokenize_fingerprint`; later runs with the same dataset and tokenizers load it instead.
+    """
+    fingerprint = tokenize_fingerprint(dataset, config, lm_tokenizer, compress_tokenizer)
+    os.makedirs(config.cache_dir, exist_ok=True)
+    return dataset.map(
+        tokenize_qa,
+        batched=True,
+        num_proc=num_proc,
+        fn_kwargs={"dataset": config.dataset, "lm_tokenizer": lm_tokenizer, "compress_tokenizer": compress_tokenizer},
+        cache_file_name=os.path.join(config.cache_dir, f"{config.dataset}-{fingerprint}.arrow"),
+        load_from_cache_file=True,
+        new_fingerprint=fingerprint,
+        desc="Tokenizing contexts",
+    )
+
+def build_codec(config: Config, model: PCC, dataset, fit_examples: int = 32):
+    codec = MemoryCodec(config.memory_codec, num_subspaces=config.pq_subspaces)
+    if config.memory_codec != "pq":
+        return codec
+    if config.pq_codebook is not None and os.path.exists(config.pq_codebook):
+        return codec.load_codebook(config.pq_codebook)
+    memories = []
+    for data in dataset.select(range(min(fit_examples, len(dataset)))):
+        compress_ids = torch.tensor([data['compress_ids']], device=config.device)
+        with torch.no_grad():
+            with autocast(dtype=torch.bfloat16):
+                memories.append(model(compress_ids=compress_ids,llm_ids=None,get_embedding=True).float().squeeze(0))
+    codec.fit(torch.cat(memories, dim=0))
+    if config.pq_codebook is not None:
+        # parallel workers may load it while it is written
+        atomic_write(config.pq_codebook, codec.save_codebook)
+    return codec
+
+def example_id(example: dict, idx: int) -> str:
+    for key in ("query_id", "id", "_id"):
+        if key in example:
+            return str(example[key])
+    return str(idx)
+
+def make_batches(lengths: list, batch_size: int, segment_length: int = None):
+    """
+    Length buckets: indices sorted by length and cut into batches of `batch_size`. With
+    `segment_length`, a batch only holds contexts of the same number of segments, so they
+    can be compressed together (see `PCC.compress_batch`).
+    """
+    batches, batch, key = [], [], None
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        i_key = math.ceil(lengths[i] / segment_length) if segment_length else None
+        if batch and (len(batch) == batch_size or i_key != key):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+        key = i_key
+    if batch:
+        batches.append(batch)
+    return batches
+
+def load_results(results_file: str) -> dict:
+    """Finished rows of an interrupted run by question id; a truncated last line is dropped."""
+    results = {}
+    if not os.path.exists(results_file):
+        return results
+    with open(results_file, encoding="utf-8") as f:
+        lines = f.readlines()
+    for i, line in enumerate(lines):
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            # cut the partial line off, later rows are appended after the last complete one
+            with open(results_file, "w", encoding="utf-8") as f:
+                f.writelines(lines[:i])
+            break
+        results[row["id"]] = row
+    return results
+
+def score(predict: str, labels, dataset: str):
+    if dataset == "nq":
+        return max([qa_f1_score(predict, label) for label in labels]), max([exact_match_score(predict,label) for label in labels])
+    return qa_f1_score(predict,labels), exact_match_score(predict,labels)
+
+def probe_batch_size(config: Config, model: PCC, lengths: list) -> int:
+    """Largest batch of the longest contexts whose compression and decoding fit `config.memory_budget_gb`."""
+    if model is None or config.memory_budget_gb <= 0:
+        raise ValueError("--batch_size 0 probes the batch size and needs --memory_budget_gb, without --no_compression")
+    batch_size = min(
+        find_max_batch_size(model, lengths, config.memory_budget_gb * 1024 ** 3, mode=mode, max_new_token=30)["batch_size"]
+        for mode in ("compress", "decode")
+    )
+    print(f"Probed batch size under {config.memory_budget_gb} GB: {batch_size}")
+    return batch_size
 
 def run(config: Config):
     dataset = config.dataset
     decoder_model = config.decoder_model
     lm_tokenizer = AutoTokenizer.from_pretrained(decoder_model)
     filter_token = 0
-    results = []
+    max_token = None
     
     if dataset == "nq":
         dataset = load_dataset("Tevatron/wikipedia-nq")['dev']
         filter_token = 512
+        max_token = 8000
     elif dataset == "hotpotqa":
         dataset = load_dataset("BroAlanTaps/Stage2-PCC-SFT-HotpotQA")['test']
         filter_token = 256
@@ -51,42 +177,20 @@ def run(config: Config):
     else:
         raise NotImplementedError(f"dataset {dataset} not supported!")
 
-    dataset = dataset.map(cal_avg_token, num_proc=64, fn_kwargs={"lm_tokenizer": lm_tokenizer, "dataset": config.dataset})
-    dataset = dataset.filter(lambda x: x['sum_token'] > filter_token)
-    
-    model = PCC(config).to(config.device).eval()
-    tokenizer = model.compressor.tokenizer
-    for idx,data in tqdm(enumerate(dataset), total=len(dataset)):
-        if config.dataset == "nq" and data['sum_token'] > 8000:
-            continue
-        
-        context = None
-        
-        if config.dataset == "nq":
-            context = [text['text'] for text in data['positive_passages']]
-            context = "\n\n".join(context)
-        else:
-            context = data['context']
-            
-        compress_ids = tokenizer(context,return_tensors="pt",truncation=False)['input_ids'].to(config.device)
-        
-        question = data["query"] if config.dataset == "nq" else data["question"]
-        prompt = f"Question: {question}\n\nAnswer: "
-        
-        with torch.no_grad():
-            with autocast(dtype=torch.bfloat16):
-                embedding = model(compress_ids=compress_ids,llm_ids=None,get_embedding=True).to(config.device)
-                output = model.decoder.generate(input_embedding=embedding,prompt_text=prompt,max_new_token=30)
-        output = output.strip()
-
-        if idx%100==0:
-            print(f"{idx}/{len(dataset)}")
-            
-        results.append({
-            "question": question,
-            "generate": output,
-            'label':data['answers']
-        })
+    compress_tokenizer = None if config.no_compression else AutoTokenizer.from_pretrained(config.compress_model)
+    dataset = preprocess(dataset, config, lm_tokenizer, compress_tokenizer)
+    dataset = dataset.filter(lambda x: x['sum_token'] > filter_token and (max_token is None or x['sum_token'] <= max_token))
+    if config.num_examples > 0:
+        # a fixed subset, the same for every ratio of a sweep
+        dataset = dataset.select(range(min(config.num_examples, len(dataset))))
+    full_dataset = dataset
+    if config.fit_codebook_only:
+        # experience/parallel.py fits the PQ codebook once, before its workers load it
+        build_codec(config, PCC(config).to(config.device).eval(), full_dataset)
+        return None
+    if config.num_shards > 1:
+        # one worker of experience/parallel.py
+        dataset = dataset.select(shard_range(len(dataset), config.num_shards, config.shard_index))
 
     if not os.path.exists("./result/"):
         os.makedirs("./result/")
@@ -97,29 +201,134 @@ def run(config: Config):
     else:
         model_type = "PCC-Large"
     output_file = f"./result/{config.dataset}-{model_type}-{256//config.embed_len}x.json"
-    
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=4)
+    if config.no_compression:
+        output_file = f"./result/{config.dataset}-uncompressed.json"
+    # rows are appended as batches finish, a restart skips the question ids already there
+    results_file = config.shard_output or output_file + "l"
+    if config.restart and os.path.exists(results_file):
+        os.remove(results_file)
+    done = load_results(results_file)
+
+    ids = [example_id(data, idx) for idx, data in enumerate(dataset)]
+    pending = [idx for idx, id_ in enumerate(ids) if id_ not in done]
+    print(f"{len(ids) - len(pending)}/{len(ids)} examples already in {results_file}")
+
+    batch_size = config.batch_size
+    if pending:
+        if config.no_compression:
+            model, codec = None, None
+            decoder = Decoder(model_name_or_path=decoder_model, device=config.device, max_length=8192, stage=2,
+                              embed_len=config.embed_len)
+            sum_token = dataset['sum_token']
+            lengths = [sum_token[idx] for idx in pending]
+        else:
+            model = PCC(config).to(config.device).eval()
+            decoder = model.decoder
+            codec = build_codec(config, model, full_dataset) if config.memory_codec else None
+            compress_len = dataset['compress_len']
+            lengths = [compress_len[idx] for idx in pending]
+        if batch_size <= 0:
+            batch_size = probe_batch_size(config, model, lengths)
+        batches = make_batches(lengths, batch_size, None if config.no_compression else config.segment_length)
+
+        progress = tqdm(total=len(pending), unit="ex")
+        begin = time.perf_counter()
+        with open(results_file, "a", encoding="utf-8") as f:
+            for batch in batches:
+                examples = [dataset[pending[i]] for i in batch]
+                questions = [data["query"] if config.dataset == "nq" else data["question"] for data in examples]
+                prompts = [f"Question: {question}\n\nAnswer: " for question in questions]
+                # seconds / token counts of the batch, see Decoder.generate
+                timings = {"compress": 0.0}
+                batch_bytes = None
+
+                if config.no_compression:
+                    contexts = [data['llm_ids'] for data in examples]
+                    outputs = decoder.generate_uncompressed_batch(contexts, prompts, max_new_token=30, timings=timings)
+                else:
+                    batch_ids = [data['compress_ids'] for data in examples]
+                    with torch.no_grad():
+                        with autocast(dtype=torch.bfloat16):
+                            if torch.device(config.device).type == "cuda":
+                                torch.cuda.synchronize(config.device)
+                            compress_begin = time.perf_counter()
+                            embedding = model.compress_batch(batch_ids).to(config.device)
+                            if torch.device(config.device).type == "cuda":
+                                torch.cuda.synchronize(config.device)
+                            timings["compress"] += time.perf_counter() - compress_begin
+                            num_tokens = sum(len(ids_) for ids_ in batch_ids)
+                            if codec is not None:
+                                encoded = codec.encode(embedding)
+                                batch_bytes = encoded.nbytes() / num_tokens
+                                embedding = codec.decode(encoded, dtype=model.decoder.model.dtype, device=config.device)
+                            else:
+                                batch_bytes = embedding.numel() * embedding.element_size() / num_tokens
+                            outputs = decoder.generate_batch(embedding, prompts, max_new_token=30, timings=timings)
+
+                for i, data, question, output in zip(batch, examples, questions, outputs):
+                    row = {
+                        "id": ids[pending[i]],
+                        "question": question,
+                        "generate": output.strip(),
+                        'label': data['answers'],
+                        # the batch's time, shared evenly by its examples
+                        "compress_ms": timings["compress"] / len(batch) * 1000,
+                        "prefill_ms": timings["prefill"] / len(batch) * 1000,
+                        "decode_ms": timings["decode"] / len(batch) * 1000,
+                        "new_tokens": timings["new_tokens"] / len(batch),
+                        "prefix_tokens": timings["prefix_tokens"] / len(batch),
+                        "bytes_per_token": batch_bytes,
+                    }
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                    done[row["id"]] = row
+                f.flush()
+                progress.update(len(batch))
+                progress.set_postfix(examples_per_sec=f"{progress.n / (time.perf_counter() - begin):.2f}")
+        progress.close()
+
+    results = [done[id_] for id_ in ids]
+    if config.shard_output is None:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump([{"question": row["question"], "generate": row["generate"], "label": row["label"]} for row in results],
+                      f, ensure_ascii=False, indent=4)
     
     avg_f1_score = []
     avg_em_score = []
     for item in results:
-        f1_score, em_score = 0, 0
-        predict, labels = item['generate'], item['label']
-        if config.dataset == "nq":
-            f1_score = max([qa_f1_score(predict, label) for label in labels])
-            em_score = max([exact_match_score(predict,label) for label in labels])
-        else:
-            f1_score = qa_f1_score(predict,labels) 
-            em_score = exact_match_score(predict,labels)
+        f1_score, em_score = score(item['generate'], item['label'], config.dataset)
         avg_f1_score.append(f1_score)
         avg_em_score.append(em_score)
+    bytes_per_token = [row["bytes_per_token"] for row in results if row["bytes_per_token"] is not None]
         
     print('-'*50 + "result" + '-'*50)
     print(f"avg_f1_score:{sum(avg_f1_score)/len(avg_f1_score)}")
     print(f"avg_em_score:{sum(avg_em_score)/len(avg_em_score)}")    
+    if bytes_per_token:
+        print(f"memory_codec:{config.memory_codec or 'float32'} avg_bytes_per_token:{sum(bytes_per_token)/len(bytes_per_token):.2f}")
     print('-'*100)
 
+    num_examples = len(results)
+    decode_ms = sum(row["decode_ms"] for row in results)
+    summary = {
+        "dataset": config.dataset,
+        "ratio": None if config.no_compression else 256 // config.embed_len,
+        "num_examples": num_examples,
+        "batch_size": batch_size,
+        "f1": sum(avg_f1_score) / num_examples,
+        "em": sum(avg_em_score) / num_examples,
+        # per example means
+        "compress_ms": sum(row["compress_ms"] for row in results) / num_examples,
+        "prefill_ms": sum(row["prefill_ms"] for row in results) / num_examples,
+        "decode_ms": decode_ms / num_examples,
+        "decode_ms_per_token": decode_ms / max(sum(row["new_tokens"] for row in results) - num_examples, 1),
+        "prefix_tokens": sum(row["prefix_tokens"] for row in results) / num_examples,
+        "bytes_per_token": sum(bytes_per_token) / len(bytes_per_token) if bytes_per_token else None,
+    }
+    if config.summary_file is not None:
+        with open(config.summary_file, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
 
 
 if __name__ == '__main__':
@@ -127,18 +336,36 @@ if __name__ == '__main__':
     parser.add_argument('--dataset', type=str, required=True)
     parser.add_argument('--use_lora', type=bool, required=False)
     parser.add_argument('--adapter_model', type=str, required=False)
-    parser.add_argument('--compress_model_path', type=str,required=True)
-    parser.add_argument('--converter_model_path', type=str,required=True)
+    parser.add_argument('--compress_model_path', type=str,required=False)
+    parser.add_argument('--converter_model_path', type=str,required=False)
     parser.add_argument('--decoder_model', type=str,required=True)
-    parser.add_argument('--compress_ratio',type=int,required=True)
+    parser.add_argument('--compress_ratio',type=int,default=4)
+    parser.add_argument('--no_compression', action='store_true', help="baseline: the decoder reads the raw context")
+    parser.add_argument('--num_examples', type=int, default=0, help="evaluate only the first N filtered examples, 0 for all")
+    parser.add_argument('--summary_file', type=str, default=None, help="write F1/EM, latencies and prefix length as JSON")
+    parser.add_argument('--batch_size', type=int, default=8, help="examples compressed and decoded together, 0 to probe")
+    parser.add_argument('--memory_budget_gb', type=float, default=0, help="memory budget of the --batch_size 0 probe")
+    parser.add_argument('--restart', action='store_true', help="discard the results of an earlier, interrupted run")
+    parser.add_argument('--device', type=str, default="cuda:0")
+    parser.add_argument('--cache_dir', type=str, default="./cache/qa", help="tokenized datasets, reused across runs")
+    parser.add_argument('--num_shards', type=int, default=1, help="set by experience/parallel.py")
+    parser.add_argument('--shard_index', type=int, default=0)
+    parser.add_argument('--shard_output', type=str, default=None, help="JSONL rows of this shard")
     parser.add_argument('--write',type=bool,default=True)
     parser.add_argument('--segment_length',type=int,default=256)
     parser.add_argument('--compressor_gradient_checkpoint', type=bool, default=False)
     parser.add_argument('--decoder_gradient_checkpoint', type=bool, default=False)
+    parser.add_argument('--memory_codec', type=str, default=None, choices=["int8", "fp8", "pq"],
+                        help="round-trip memories through a compact codec to measure accuracy vs bytes per token")
+    parser.add_argument('--pq_subspaces', type=int, default=64)
+    parser.add_argument('--pq_codebook', type=str, default=None, help="PQ codebook path, fitted and saved here if missing")
+    parser.add_argument('--fit_codebook_only', action='store_true', help="fit and save --pq_codebook, then exit")
     
     args = parser.parse_args()
+    if not args.no_compression and (args.compress_model_path is None or args.converter_model_path is None):
+        parser.error("--compress_model_path and --converter_model_path are required unless --no_compression")
     config = Config(
-            device="cuda:0",
+            device=args.device,
             dataset=args.dataset,
             compress_model=args.compress_model_path,
             adapter_model=args.adapter_model,
@@ -149,7 +376,21 @@ if __name__ == '__main__':
             segment_length=args.segment_length,
             use_lora=args.use_lora,
             compressor_gradient_checkpoint=args.compressor_gradient_checkpoint,
-            decoder_gradient_checkpoint=args.decoder_gradient_checkpoint
+            decoder_gradient_checkpoint=args.decoder_gradient_checkpoint,
+            memory_codec=args.memory_codec,
+            pq_subspaces=args.pq_subspaces,
+            pq_codebook=args.pq_codebook,
+            fit_codebook_only=args.fit_codebook_only,
+            no_compression=args.no_compression,
+            num_examples=args.num_examples,
+            summary_file=args.summary_file,
+            batch_size=args.batch_size,
+            memory_budget_gb=args.memory_budget_gb,
+            restart=args.restart,
+            num_shards=args.num_shards,
+            shard_index=args.shard_index,
+            shard_output=args.shard_output,
+            cache_dir=args.cache_dir,
     )
     print(config)
 
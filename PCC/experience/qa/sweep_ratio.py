@@ -0,0 +1,119 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+
+FIELDS = ["name", "ratio", "f1", "em", "compress_ms", "prefill_ms", "decode_ms", "total_ms", "prefix_tokens", "pareto"]
+
+
+def sweep_configs(args):
+    """(name, evaluate_qa arguments) for every point of the sweep."""
+    common = ["--dataset", args.dataset, "--decoder_model", args.decoder_model,
+              "--num_examples", str(args.num_examples), "--segment_length", str(args.segment_length),
+              "--batch_size", str(args.batch_size)]
+    configs = []
+    if args.include_uncompressed:
+        configs.append(("uncompressed", common + ["--no_compression"]))
+    for ratio in args.ratios:
+        argv = common + [
+            "--compress_ratio", str(ratio),
+            "--compress_model_path", args.compress_model_path.format(ratio=ratio),
+            "--converter_model_path", args.converter_model_path.format(ratio=ratio),
+        ]
+        if args.adapter_model is not None:
+            argv += ["--use_lora", "True", "--adapter_model", args.adapter_model.format(ratio=ratio)]
+        configs.append((f"ratio_{ratio}", argv))
+    return configs
+
+
+def evaluate(name, argv, output_dir):
+    """Run evaluate_qa once, or reuse the cached result of an earlier, possibly interrupted sweep."""
+    result_file = os.path.join(output_dir, f"{name}.json")
+    if os.path.exists(result_file):
+        with open(result_file) as f:
+            cached = json.load(f)
+        if cached["argv"] == argv:
+            print(f"{name}: cached in {result_file}")
+            return cached["summary"]
+        print(f"{name}: configuration changed, evaluating again")
+
+    summary_file = result_file + ".partial"
+    cmd = [sys.executable, "-m", "experience.qa.evaluate_qa", *argv, "--summary_file", summary_file]
+    print(f"{name}: {' '.join(cmd)}")
+    subprocess.run(cmd, check=True)
+    with open(summary_file) as f:
+        summary = json.load(f)
+    # written only once the run finished, so an interrupted point is evaluated again
+    with open(result_file, "w") as f:
+        json.dump({"argv": argv, "summary": summary}, f, indent=2)
+    os.remove(summary_file)
+    return summary
+
+
+def pareto_front(rows):
+    """Mark the rows no other row beats on both end-to-end latency and F1."""
+    best_f1 = None
+    for row in sorted(rows, key=lambda r: (r["total_ms"], -r["f1"])):
+        row["pareto"] = best_f1 is None or row["f1"] > best_f1
+        if row["pareto"]:
+            best_f1 = row["f1"]
+    return rows
+
+
+def write_report(rows, output_dir):
+    rows = sorted(rows, key=lambda r: r["total_ms"])
+    with open(os.path.join(output_dir, "pareto.json"), "w") as f:
+        json.dump(rows, f, indent=2)
+    with open(os.path.join(output_dir, "plot_data.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows({k: row[k] for k in FIELDS} for row in rows)
+
+    lines = [
+        "| config | ratio | F1 | EM | compress ms | prefill ms | decode ms | total ms | prefix tokens | pareto |",
+        "|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    for row in rows:
+        lines.append(
+            f"| {row['name']} | {row['ratio'] or '-'} | {row['f1']:.4f} | {row['em']:.4f} | "
+            f"{row['compress_ms']:.1f} | {row['prefill_ms']:.1f} | {row['decode_ms']:.1f} | "
+            f"{row['total_ms']:.1f} | {row['prefix_tokens']:.1f} | {'*' if row['pareto'] else ''} |"
+        )
+    table = "\n".join(lines)
+    with open(os.path.join(output_dir, "pareto.md"), "w") as f:
+        f.write(table + "\n")
+    return table
+
+
+def run(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    rows = []
+    for name, argv in sweep_configs(args):
+        summary = evaluate(name, argv, args.output_dir)
+        total_ms = summary["compress_ms"] + summary["prefill_ms"] + summary["decode_ms"]
+        rows.append({"name": name, **summary, "total_ms": total_ms})
+    print(write_report(pareto_front(rows), args.output_dir))
+
+
+if __name__ == "__main__":
+    # python -m experience.qa.sweep_ratio --ratios 4 8 16 --include_uncompressed \
+    #     --compress_model_path Stage2-PCC-Lite-{ratio}x --converter_model_path Stage2-PCC-Lite-{ratio}x
+    parser = argparse.ArgumentParser(description="Accuracy / latency sweep over compression ratios on a fixed QA subset")
+    parser.add_argument("--dataset", type=str, default="nq")
+    parser.add_argument("--ratios", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--include_uncompressed", action="store_true", help="add the no-compression baseline")
+    parser.add_argument("--compress_model_path", type=str, required=True, help="path template, {ratio} is filled in")
+    parser.add_argument("--converter_model_path", type=str, required=True, help="path template, {ratio} is filled in")
+    parser.add_argument("--adapter_model", type=str, default=None, help="path template for PCC Large adapters")
+    parser.add_argument("--decoder_model", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct")
+    parser.add_argument("--num_examples", type=int, default=500)
+    parser.add_argument("--segment_length", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--output_dir", type=str, default="./result/sweep")
+    args = parser.parse_args()
+    run(args)
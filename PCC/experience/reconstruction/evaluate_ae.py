@@ -13,6 +13,7 @@ from torch.cuda.amp import autocast
 from tqdm import tqdm
 
 from ..dataclass import Config
+from ..parallel import shard_range
 from .utils import metrics
 
 nltk.download('punkt_tab')
@@ -37,12 +38,18 @@ def run(config: Config):
     
     # load_data
     dataset = _load_data(config.dataset)
+    if config.num_shards > 1:
+        # one worker of experience/parallel.py
+        dataset = dataset.select(shard_range(len(dataset), config.num_shards, config.shard_index))
     
     bleu_list,bleu1_list,bleu2_list,bleu3_list,bleu4_list,rougeL_list = [],[],[],[],[],[]
     ori_text_list = []
     cons_text_list = []
     data_list = []
     file_name = f"{256 // config.embed_len}x_large" + f"generated_text.json"
+    # a shard writes one JSON row per example, merged by experience/parallel.py
+    if config.shard_output is not None:
+        file_name = config.shard_output
     with open(file_name, "w") as file:
         with tqdm(range(len(dataset))) as pbar:
             for i in pbar:
@@ -98,8 +105,12 @@ def run(config: Config):
                     "bleu-4": bleu4,
                     "rougeL": rougeL
                 })
+                if config.shard_output is not None:
+                    file.write(json.dumps(data_list[-1], ensure_ascii=False) + "\n")
+                    file.flush()
                 
-        json.dump(data_list, file, ensure_ascii=False, indent=2)
+        if config.shard_output is None:
+            json.dump(data_list, file, ensure_ascii=False, indent=2)
         print("-"*25+"Result"+"-"*25)
         print(f"""
               Avg BLEU": {avg_bleu:.6f}\n
@@ -126,11 +137,15 @@ if __name__ == '__main__':
     parser.add_argument('--segment_length',type=int,default=256)
     parser.add_argument('--compressor_gradient_checkpoint', type=bool, default=False)
     parser.add_argument('--decoder_gradient_checkpoint', type=bool, default=False)
+    parser.add_argument('--device', type=str, default="cuda:0")
+    parser.add_argument('--num_shards', type=int, default=1, help="set by experience/parallel.py")
+    parser.add_argument('--shard_index', type=int, default=0)
+    parser.add_argument('--shard_output', type=str, default=None, help="JSONL rows of this shard")
     
     args = parser.parse_args()
     
     config = Config(
-        device="cuda:0",
+        device=args.device,
         dataset=args.data_path,
         compress_model=args.compress_model_path,
         adapter_model=args.adapter_model,
@@ -141,7 +156,10 @@ if __name__ == '__main__':
         segment_length=args.segment_length,
         use_lora=args.use_lora,
         compressor_gradient_checkpoint=args.compressor_gradient_checkpoint,
-        decoder_gradient_checkpoint=args.decoder_gradient_checkpoint
+        decoder_gradient_checkpoint=args.decoder_gradient_checkpoint,
+        num_shards=args.num_shards,
+        shard_index=args.shard_index,
+        shard_output=args.shard_output,
     )
     print(config)
 
@@ -0,0 +1,79 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import logging
+import time
+from typing import Callable, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledForward:
+    """
+    `torch.compile`d `fn` for inputs accepted by `guard`, e.g. full compressor segments;
+    other inputs (the ragged last segment) run `fn` eagerly. Without `dynamic` every input
+    shape is a separate graph, so at most `max_shapes` are compiled and later shapes run
+    eagerly as well. If compilation fails, `fn` runs eagerly from then on.
+
+    The first call of a shape includes compilation and is timed into `compile_seconds`, so
+    it can be told apart from steady-state step time.
+    """
+    def __init__(
+        self,
+        fn: Callable,
+        guard: Optional[Callable[[torch.Tensor], bool]] = None,
+        dynamic: bool = False,
+        max_shapes: int = 4,
+        name: str = "forward",
+    ):
+        self.fn = fn
+        self.guard = guard
+        self.dynamic = dynamic
+        self.max_shapes = max_shapes
+        self.name = name
+        self.compiled_fn = torch.compile(fn, dynamic=dynamic) if hasattr(torch, "compile") else None
+        if self.compiled_fn is None:
+            logger.warning(f"torch.compile is not available, {name} runs eagerly.")
+        self.shapes = set()
+        self.compile_seconds = 0.0
+        self.compiled_calls = 0
+        self.eager_calls = 0
+
+    def _shape_key(self, x: torch.Tensor):
+        if self.dynamic:
+            # dynamic graphs still specialize sizes 0 and 1
+            return tuple(min(size, 2) for size in x.shape)
+        return tuple(x.shape)
+
+    def _eager(self, x):
+        self.eager_calls += 1
+        return self.fn(x)
+
+    def __call__(self, x: torch.Tensor):
+        if self.compiled_fn is None or (self.guard is not None and not self.guard(x)):
+            return self._eager(x)
+        key = self._shape_key(x)
+        if key in self.shapes:
+            self.compiled_calls += 1
+            return self.compiled_fn(x)
+        if len(self.shapes) >= self.max_shapes:
+            return self._eager(x)
+
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        begin = time.perf_counter()
+        try:
+            out = self.compiled_fn(x)
+        except Exception as e:
+            logger.warning(f"Compiling {self.name} failed ({e}), falling back to eager.")
+            self.compiled_fn = None
+            return self._eager(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        self.compile_seconds += time.perf_counter() - begin
+        self.shapes.add(key)
+        self.compiled_calls += 1
+        logger.info(f"Compiled {self.name} for input shape {tuple(x.shape)}.")
+        return out
@@ -0,0 +1,105 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers.cache_utils import Cache
+
+
+def quantize_per_head(states: torch.Tensor, bits: int):
+    """
+    Symmetric quantization of a [bsz, num_heads, seq_len, head_dim] key/value tensor
+    with one scale per head and position. 4-bit values are packed two per byte.
+    """
+    qmax = 2 ** (bits - 1) - 1
+    scale = states.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / qmax
+    q = torch.round(states.float() / scale).clamp(-qmax - 1, qmax)
+    if bits == 8:
+        q = q.to(torch.int8)
+    else:
+        q = (q + qmax + 1).to(torch.uint8)
+        q = q[..., 0::2] | (q[..., 1::2] << 4)
+    return q, scale.to(states.dtype)
+
+
+def dequantize_per_head(q: torch.Tensor, scale: torch.Tensor, bits: int):
+    if bits == 8:
+        values = q.to(scale.dtype)
+    else:
+        qmax = 2 ** (bits - 1) - 1
+        low = (q & 0x0F).to(scale.dtype)
+        high = (q >> 4).to(scale.dtype)
+        values = torch.stack((low, high), dim=-1).flatten(-2) - (qmax + 1)
+    return values * scale
+
+
+class QuantizedKVCache(Cache):
+    """
+    KV cache that stores keys and values as int8 or packed int4 with per-head scales.
+    Tensors are dequantized to the attention dtype when a layer reads its cache.
+    """
+    def __init__(self, bits: int = 8) -> None:
+        super().__init__()
+        if bits not in (4, 8):
+            raise ValueError(f"kv cache bits must be 4 or 8, but got {bits}")
+        self.bits = bits
+        self.key_cache: List[Tuple[torch.Tensor, torch.Tensor]] = []
+        self.value_cache: List[Tuple[torch.Tensor, torch.Tensor]] = []
+        self._seen_tokens = 0
+
+    def __len__(self):
+        return len(self.key_cache)
+
+    def _append(self, cache, states, layer_idx):
+        q, scale = quantize_per_head(states, self.bits)
+        if len(cache) <= layer_idx:
+            cache.append((q, scale))
+        else:
+            old_q, old_scale = cache[layer_idx]
+            cache[layer_idx] = (torch.cat((old_q, q), dim=-2), torch.cat((old_scale, scale), dim=-2))
+        return dequantize_per_head(*cache[layer_idx], self.bits)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.bits == 4 and key_states.size(-1) % 2 != 0:
+            raise ValueError("4-bit kv cache requires an even head_dim")
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        keys = self._append(self.key_cache, key_states, layer_idx)
+        values = self._append(self.value_cache, value_states, layer_idx)
+        return keys, values
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        if len(self.key_cache) <= layer_idx:
+            return 0
+        return self.key_cache[layer_idx][1].shape[-2]
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    def nbytes(self) -> int:
+        return sum(
+            t.numel() * t.element_size()
+            for cache in (self.key_cache, self.value_cache)
+            for layer in cache
+            for t in layer
+        )
+
+
+def kv_cache_nbytes(past_key_values) -> int:
+    """Bytes held by a legacy tuple cache, a `DynamicCache` or a `QuantizedKVCache`."""
+    if past_key_values is None:
+        return 0
+    if isinstance(past_key_values, QuantizedKVCache):
+        return past_key_values.nbytes()
+    if hasattr(past_key_values, "key_cache"):
+        layers = zip(past_key_values.key_cache, past_key_values.value_cache)
+    else:
+        layers = past_key_values
+    return sum(t.numel() * t.element_size() for layer in layers for t in layer)
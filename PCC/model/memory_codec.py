@@ -0,0 +1,122 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import io
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import torch
+
+FP8_MAX = 448.0  # largest finite value of float8_e4m3fn
+
+
+@dataclass
+class EncodedMemory:
+    """Compact memory payload; `codes` holds int8 / fp8 values or uint8 PQ codes."""
+    format: str
+    shape: Tuple[int, ...]
+    codes: torch.Tensor
+    scales: torch.Tensor
+
+    def nbytes(self) -> int:
+        return self.codes.numel() * self.codes.element_size() + self.scales.numel() * self.scales.element_size()
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        codes = self.codes.view(torch.uint8) if self.format == "fp8" else self.codes
+        torch.save({"format": self.format, "shape": list(self.shape), "codes": codes.cpu(), "scales": self.scales.cpu()}, buffer)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, payload: bytes):
+        state = torch.load(io.BytesIO(payload))
+        codes = state["codes"].view(torch.float8_e4m3fn) if state["format"] == "fp8" else state["codes"]
+        return cls(format=state["format"], shape=tuple(state["shape"]), codes=codes, scales=state["scales"])
+
+
+class MemoryCodec:
+    """
+    Codec for memory embeddings [..., num_slots, dim] as emitted by `Converter`.
+
+    - "int8": symmetric int8 with one scale per slot (dim + 2 bytes per slot)
+    - "fp8":  float8_e4m3fn with one scale per slot (dim + 2 bytes per slot)
+    - "pq":   product quantization of the scale-normalized slot, one uint8 code per
+              subspace (num_subspaces + 2 bytes per slot); needs `fit` or `load_codebook`
+    """
+    def __init__(self, format: str = "int8", num_subspaces: int = 64, codebook: Optional[torch.Tensor] = None):
+        if format not in ["int8", "fp8", "pq"]:
+            raise ValueError(f"format must be 'int8', 'fp8' or 'pq', but got {format}")
+        self.format = format
+        self.num_subspaces = num_subspaces
+        # codebook: [num_subspaces, num_centroids, sub_dim]
+        self.codebook = codebook
+
+    def _slot_scale(self, memory: torch.Tensor, qmax: float):
+        return memory.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / qmax
+
+    def fit(self, memories: torch.Tensor, num_centroids: int = 256, iters: int = 20, seed: int = 0):
+        """Train the PQ codebook with k-means on sample memories [..., dim]."""
+        assert self.format == "pq", "only the 'pq' format needs a codebook"
+        assert num_centroids <= 256, "PQ codes are stored as uint8"
+        vectors = memories.reshape(-1, memories.size(-1)).float()
+        vectors = vectors / self._slot_scale(vectors, 1.0)
+        dim = vectors.size(-1)
+        if dim % self.num_subspaces != 0:
+            raise ValueError(f"dim {dim} is not divisible by num_subspaces {self.num_subspaces}")
+        sub_vectors = vectors.view(vectors.size(0), self.num_subspaces, -1).transpose(0, 1)
+
+        generator = torch.Generator(device="cpu").manual_seed(seed)
+        init = torch.randperm(vectors.size(0), generator=generator)[:num_centroids].to(vectors.device)
+        centroids = sub_vectors[:, init, :].clone()
+        for _ in range(iters):
+            assign = torch.cdist(sub_vectors, centroids).argmin(dim=-1)
+            for m in range(self.num_subspaces):
+                sums = torch.zeros_like(centroids[m]).index_add_(0, assign[m], sub_vectors[m])
+                counts = torch.bincount(assign[m], minlength=centroids.size(1)).unsqueeze(-1)
+                centroids[m] = torch.where(counts > 0, sums / counts.clamp(min=1), centroids[m])
+        self.codebook = centroids.cpu()
+        return self
+
+    def save_codebook(self, path: str):
+        torch.save({"num_subspaces": self.num_subspaces, "codebook": self.codebook}, path)
+
+    def load_codebook(self, path: str):
+        state = torch.load(path)
+        self.num_subspaces = state["num_subspaces"]
+        self.codebook = state["codebook"]
+        return self
+
+    @torch.no_grad()
+    def encode(self, memory: torch.Tensor) -> EncodedMemory:
+        memory = memory.float()
+        if self.format == "int8":
+            scales = self._slot_scale(memory, 127.0)
+            codes = torch.round(memory / scales).clamp(-127, 127).to(torch.int8)
+        elif self.format == "fp8":
+            scales = self._slot_scale(memory, FP8_MAX)
+            codes = (memory / scales).to(torch.float8_e4m3fn)
+        else:
+            if self.codebook is None:
+                raise ValueError("PQ codec needs a codebook, call `fit` or `load_codebook` first")
+            scales = self._slot_scale(memory, 1.0)
+            sub_vectors = (memory / scales).reshape(-1, self.num_subspaces, memory.size(-1) // self.num_subspaces)
+            codebook = self.codebook.to(memory.device)
+            codes = torch.cdist(sub_vectors.transpose(0, 1), codebook).argmin(dim=-1).transpose(0, 1)
+            codes = codes.to(torch.uint8).reshape(*memory.shape[:-1], self.num_subspaces)
+        return EncodedMemory(format=self.format, shape=tuple(memory.shape), codes=codes, scales=scales.to(torch.float16))
+
+    @torch.no_grad()
+    def decode(self, encoded: EncodedMemory, dtype: torch.dtype = torch.bfloat16, device="cpu") -> torch.Tensor:
+        codes = encoded.codes.to(device)
+        scales = encoded.scales.to(device=device, dtype=torch.float32)
+        if encoded.format == "pq":
+            codebook = self.codebook.to(device)
+            flat = codes.reshape(-1, self.num_subspaces).long()
+            values = codebook[torch.arange(self.num_subspaces, device=device), flat]
+            values = values.reshape(encoded.shape)
+        else:
+            values = codes.to(torch.float32)
+        return (values * scales).to(dtype)
+
+    def bytes_per_token(self, encoded: EncodedMemory, num_tokens: int) -> float:
+        return encoded.nbytes() / num_tokens
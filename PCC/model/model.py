@@ -1,10 +1,12 @@
 ## Copyright (c) Microsoft Corporation.
 ## Licensed under the MIT license.
 
+import hashlib
 import logging
 import math
 import os
 import random
+import time
 from typing import Any, List, Optional, Union
 
 import torch
@@ -17,6 +19,14 @@ from torch.nn import functional as F
 from torch.nn.functional import gelu
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
+from .compiled_forward import CompiledForward
+from .kv_cache import QuantizedKVCache
+from .onnx_export import OnnxCompressor
+from .packing import pack_sequences
+from .recompute import (apply_recompute_policy, estimate_activation_bytes, format_policy, parse_policy,
+                        plan_recompute, recompute_overhead)
+from .static_decode import StaticDecodeRunner
+
 logger = logging.getLogger(__name__)
 console = Console()
 
@@ -91,6 +101,7 @@ class Compressor(nn.Module):
         # self.model.enable_input_require_grads()
         if gradient_checkpoint:
             self.model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        self.compiled_forward = None
 
 
     def _set_grad_mode(self, is_train) -> None:
@@ -102,20 +113,53 @@ class Compressor(nn.Module):
         for param in self.model.parameters():
             param.requires_grad = is_train
                 
+    def compile_forward(self, segment_length: int, max_shapes: int = 4):
+        """torch.compile the training forward for full [bsz, segment_length] segments, see `CompiledForward`."""
+        self.compiled_forward = CompiledForward(
+            self._forward,
+            guard=lambda input_ids: input_ids.size(1) == segment_length,
+            max_shapes=max_shapes,
+            name="compressor",
+        )
+
     def forward(
         self, 
         input_ids: torch.tensor,
+        attention_mask: Optional[torch.Tensor] = None,
     ):
-        with torch.no_grad():
-            mem_ids_tensor = torch.tensor(self.mem_ids).unsqueeze(0).repeat(input_ids.size(0), 1).to(self.device)
-            input_ids_ = torch.cat((input_ids,mem_ids_tensor),dim=1).to(self.device)
-            
-            attention = torch.full((input_ids_.size(0),input_ids_.size(1)),1).to(self.device)
-        with autocast('cuda', dtype=torch.bfloat16):
-            text_embedding = self.model(input_ids=input_ids_,attention_mask=attention, output_hidden_states=True)
-        embedding = text_embedding.hidden_states[-1][:,-self.embed_len:,:]
-        
-        return embedding
+        # evaluation and generation (no_grad) keep the eager forward
+        if self.compiled_forward is not None and torch.is_grad_enabled() and attention_mask is None:
+            return self.compiled_forward(input_ids)
+        return compress_segment(self.model, input_ids, self.mem_ids, self.embed_len, attention_mask)
+
+    def _forward(self, input_ids: torch.Tensor):
+        return compress_segment(self.model, input_ids, self.mem_ids, self.embed_len)
+
+
+def compress_segment(model, input_ids: torch.Tensor, mem_ids: List[int], embed_len: int,
+                     attention_mask: Optional[torch.Tensor] = None):
+    """
+    Last hidden states of the `embed_len` <mem_i> tokens appended to a segment, i.e. its memory.
+    Segments of different lengths are left-padded with `attention_mask` 0; positions then
+    start at the first real token, so every row gets the memory of its unpadded segment.
+    """
+    device = input_ids.device
+    with torch.no_grad():
+        mem_ids_tensor = torch.tensor(mem_ids).unsqueeze(0).repeat(input_ids.size(0), 1).to(device)
+        input_ids_ = torch.cat((input_ids,mem_ids_tensor),dim=1).to(device)
+        
+        position_ids = None
+        if attention_mask is None:
+            attention = torch.full((input_ids_.size(0),input_ids_.size(1)),1).to(device)
+        else:
+            attention = torch.cat((attention_mask.to(device).long(), torch.ones_like(mem_ids_tensor)), dim=1)
+            position_ids = (attention.cumsum(dim=1) - 1).masked_fill(attention == 0, 1)
+    with autocast('cuda', dtype=torch.bfloat16):
+        text_embedding = model(input_ids=input_ids_,attention_mask=attention,position_ids=position_ids,
+                               output_hidden_states=True)
+    embedding = text_embedding.hidden_states[-1][:,-embed_len:,:]
+    
+    return embedding
 
 
 
@@ -149,8 +193,13 @@ class Converter(nn.Module):
         
         self.dense_in = nn.Linear(embed_dim, llm_dim)
         self.dense_out = nn.Linear(llm_dim, llm_dim)
+        self.compiled_forward = None
         
         self.print_trainable_parameters()
+
+    def compile_forward(self, max_shapes: int = 4):
+        """torch.compile the training forward; the memory length varies with the segment count, so the graph is dynamic."""
+        self.compiled_forward = CompiledForward(self._forward, dynamic=True, max_shapes=max_shapes, name="converter")
         
     def print_trainable_parameters(self):
         trainable_param = 0
@@ -165,6 +214,11 @@ class Converter(nn.Module):
         self, 
         embeddings: torch.Tensor
     ):
+        if self.compiled_forward is not None and torch.is_grad_enabled():
+            return self.compiled_forward(embeddings)
+        return self._forward(embeddings)
+
+    def _forward(self, embeddings: torch.Tensor):
         embeddings = self.RMSNorm(embeddings)
         embeddings = embeddings.to(torch.bfloat16)  
         x = self.dense_in(embeddings)
@@ -173,6 +227,42 @@ class Converter(nn.Module):
         return x
 
  
+class ConstantEmbeddings:
+    """
+    Input embeddings of constant token sequences of the frozen decoder (special tokens and
+    registered prompts), computed once per device and dtype. `get` returns an expanded view,
+    so a batch shares one copy; the tokenizer only runs when a prompt is registered.
+    """
+    def __init__(self, embedding: nn.Embedding, tokenizer):
+        self.embedding = embedding
+        self.tokenizer = tokenizer
+        self._prompt_ids = {}
+        self._cache = {}
+
+    def register_prompt(self, text: str):
+        self._prompt_ids[text] = tuple(self.tokenizer(text, add_special_tokens=False)['input_ids'])
+
+    def is_registered(self, text: str) -> bool:
+        return text in self._prompt_ids
+
+    def get(self, key: Union[int, str], batch_size: int = 1, device=None, dtype=None) -> torch.Tensor:
+        """[batch_size, len, hidden] embedding of a token id or a registered prompt."""
+        ids = (key,) if isinstance(key, int) else self._prompt_ids[key]
+        weight = self.embedding.weight
+        device = torch.device(device) if device is not None else weight.device
+        dtype = dtype if dtype is not None else weight.dtype
+        cache_key = (ids, device, dtype)
+        if cache_key not in self._cache:
+            with torch.no_grad():
+                embedding = self.embedding(torch.tensor(ids, device=weight.device))
+            self._cache[cache_key] = embedding.to(device=device, dtype=dtype).unsqueeze(0)
+        return self._cache[cache_key].expand(batch_size, -1, -1)
+
+    def clear(self):
+        """Drop the cached embeddings, e.g. after the embedding weights were changed."""
+        self._cache.clear()
+
+
 class Decoder(nn.Module):
     def __init__(
         self, 
@@ -184,19 +274,23 @@ class Decoder(nn.Module):
         is_train: bool = False,
         embed_len: int = 64,
         gradient_checkpoint: bool = False,
+        revision: str = None,
     ):
         self.embed_len = embed_len
         super(Decoder, self).__init__()
-        self.model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.bfloat16)
+        self.model_name_or_path = model_name_or_path
+        self.model = AutoModelForCausalLM.from_pretrained(model_name_or_path, revision=revision, torch_dtype=torch.bfloat16)
         self.tokenizer = AutoTokenizer.from_pretrained(
-            model_name_or_path
+            model_name_or_path, revision=revision
         )
         
         num_added = None
+        self.patch_path = None
         if model_name_or_path == "meta-llama/Meta-Llama-3-8B-Instruct":
             self.tokenizer.eos_token_id = 128001
             self.tokenizer.pad_token_id = 128002  #<|reserved_special_token_0|>
-            patch = torch.load("model/patch/llama3_8b_special_token_patch.pt")
+            self.patch_path = "model/patch/llama3_8b_special_token_patch.pt"
+            patch = torch.load(self.patch_path)
             new_tokens = patch["tokens"]
             embed_weight = patch["embedding"].to(self.model.dtype)
             lm_head_weight = patch["lm_head"].to(self.model.dtype)
@@ -226,20 +320,25 @@ class Decoder(nn.Module):
         
             
         self.bos_token_id = self.tokenizer.bos_token_id
-        self.bos_embedding = self.model.get_input_embeddings()(torch.tensor([self.bos_token_id]).to(self.device))
-        
         self.mem_token_id = self.tokenizer.convert_tokens_to_ids('<mem>')
-        self.mem_embedding = self.model.get_input_embeddings()(torch.tensor([self.mem_token_id]).to(self.device))
         self.end_mem_token_id = self.tokenizer.convert_tokens_to_ids('</mem>')
-        self.end_mem_embedding = self.model.get_input_embeddings()(torch.tensor([self.end_mem_token_id]).to(self.device))
         self.ae_token_id = self.tokenizer.convert_tokens_to_ids('<ae>')
-        self.ae_embedding = self.model.get_input_embeddings()(torch.tensor([self.ae_token_id]).to(self.device))
+
+        self.constant_embeddings = ConstantEmbeddings(self.model.get_input_embeddings(), self.tokenizer)
+        # the prompt of every stage-1 ae example, see DataCollator
+        self.constant_embeddings.register_prompt("<ae>")
+        self.bos_embedding = self.constant_embeddings.get(self.bos_token_id)[0]
+        self.mem_embedding = self.constant_embeddings.get(self.mem_token_id)[0]
+        self.end_mem_embedding = self.constant_embeddings.get(self.end_mem_token_id)[0]
+        self.ae_embedding = self.constant_embeddings.get(self.ae_token_id)[0]
         
         console.print(f'Successful add {num_added} tokens. New vocabulary size is {len(self.tokenizer)}'
                       ,style='bold yellow')
         
         if gradient_checkpoint:
             self.model.gradient_checkpointing_enable()
+
+        self._static_runners = {}
     
     def _set_grad_mode(self, is_train):
         if not is_train:
@@ -250,10 +349,70 @@ class Decoder(nn.Module):
         for param in self.model.parameters():
             param.requires_grad = is_train
 
+    def set_recompute_policy(self, spec: str, batch_size: int = 1, seq_len: int = None, budget_gb: float = 0):
+        """
+        Selective activation recompute for the frozen decoder, see `model/recompute.py`.
+        `spec` is a per-layer-block policy, or "auto" to plan one that keeps the activations of a
+        `batch_size` x `seq_len` micro-batch within `budget_gb`.
+        """
+        config = self.model.config
+        seq_len = seq_len or self.max_length
+        if spec == "auto":
+            if budget_gb <= 0:
+                raise ValueError("decoder_recompute auto needs decoder_recompute_budget_gb > 0")
+            policies = plan_recompute(config, batch_size, seq_len, budget_gb * 2**30)
+        else:
+            policies = parse_policy(spec, config.num_hidden_layers)
+        apply_recompute_policy(self.model, policies)
+        activation_gb = estimate_activation_bytes(config, policies, batch_size, seq_len) / 2**30
+        console.print(
+            f"Decoder recompute {format_policy(policies)}: ~{activation_gb:.2f} GB activations for "
+            f"{batch_size}x{seq_len} tokens, {recompute_overhead(config, policies, seq_len):.1%} extra FLOPs",
+            style='bold yellow'
+        )
+        return policies
+
+    def reference(self):
+        """Identify the frozen decoder by model id, hub revision and special-token patch hash."""
+        patch_sha256 = None
+        if self.patch_path is not None:
+            with open(self.patch_path, "rb") as f:
+                patch_sha256 = hashlib.sha256(f.read()).hexdigest()
+        return {
+            "model_name_or_path": self.model_name_or_path,
+            "revision": getattr(self.model.config, "_commit_hash", None),
+            "patch_sha256": patch_sha256,
+        }
+
+    def _special_embeddings(self, batch_size):
+        """<|begin_of_text|>, <mem> and </mem> embeddings as [batch_size, 1, hidden] views."""
+        return (
+            self.constant_embeddings.get(self.bos_token_id, batch_size),
+            self.constant_embeddings.get(self.mem_token_id, batch_size),
+            self.constant_embeddings.get(self.end_mem_token_id, batch_size),
+        )
+
+    def _prompt_embedding(self, prompt_text, batch_size):
+        """
+        Embedding and attention mask of the prompt. A registered prompt shared by the whole batch
+        comes from `constant_embeddings`, anything else is tokenized with padding.
+        """
+        prompts = [prompt_text] if isinstance(prompt_text, str) else list(prompt_text)
+        if len(set(prompts)) == 1 and self.constant_embeddings.is_registered(prompts[0]):
+            embedding = self.constant_embeddings.get(prompts[0], batch_size)
+            attention_mask = torch.ones(embedding.shape[:2], dtype=torch.long, device=embedding.device)
+            return embedding, attention_mask
+        encoder_prompt_text = self.tokenizer(
+                prompt_text,
+                padding="longest",
+                add_special_tokens=False,
+                return_tensors='pt'
+        ).to(self.device)
+        prompt_text_embedding = self.model.get_input_embeddings()(encoder_prompt_text['input_ids']).to(self.device)
+        return prompt_text_embedding, encoder_prompt_text['attention_mask']
+
     def _get_segment_mem(self, input_embedding):
-        bos_embedding = self.bos_embedding.unsqueeze(0).repeat(input_embedding.size(0),1,1)
-        mem_embedding = self.mem_embedding.unsqueeze(0).repeat(input_embedding.size(0),1,1)
-        end_mem_embedding = self.end_mem_embedding.unsqueeze(0).repeat(input_embedding.size(0),1,1)
+        bos_embedding, mem_embedding, end_mem_embedding = self._special_embeddings(input_embedding.size(0))
 
         seg_len = math.ceil(input_embedding.size(1)/self.embed_len)
         # Adjust the shape according to your needs
@@ -268,22 +427,32 @@ class Decoder(nn.Module):
          
         return torch.cat((bos_embedding,cat_embedding),dim=1)
   
-    def generate(self,input_embedding,prompt_text,max_new_token=10):
+    def _get_static_runner(self, batch_size, cache_len, compile_decode):
+        # one runner (and one preallocated cache) per compile flag: reused while the batch size matches
+        # and the prompt fits, otherwise freed before a larger one is allocated
+        cache_len = math.ceil(cache_len / 256) * 256
+        runner = self._static_runners.get(compile_decode)
+        if runner is not None and runner.max_batch_size == batch_size and runner.max_cache_len >= cache_len:
+            return runner
+        if runner is not None:
+            if runner.max_batch_size == batch_size:
+                cache_len = max(cache_len, runner.max_cache_len)
+            del self._static_runners[compile_decode], runner
+        self._static_runners[compile_decode] = StaticDecodeRunner(self.model, batch_size, cache_len, compile=compile_decode)
+        return self._static_runners[compile_decode]
+
+    def generate(self,input_embedding,prompt_text,max_new_token=10,kv_cache_bits=None,static_cache=False,compile_decode=False,timings=None):
+        """
+        Greedy answer to `prompt_text` given the memory `input_embedding`. If `timings` is a
+        dict, prefill / decode seconds, generated and prefix token counts are added to it.
+        """
+        if static_cache and kv_cache_bits:
+            raise ValueError("kv_cache_bits can not be combined with static_cache")
         self.model.eval()
         with torch.no_grad(): 
-            encoder_prompt_text = self.tokenizer(
-                    prompt_text,
-                    padding="longest",
-                    add_special_tokens=False,
-                    return_tensors='pt'
-            ).to(self.device)
-            prompt_text_ids = encoder_prompt_text['input_ids']
-            # prompt_text_attention_mask = encoder_prompt_text['attention_mask']
-            prompt_text_embedding = self.model.get_input_embeddings()(prompt_text_ids).to(self.device)
-
-            bos_embedding = self.bos_embedding.unsqueeze(0).repeat(input_embedding.size(0),1,1)
-            mem_embedding = self.mem_embedding.unsqueeze(0).repeat(input_embedding.size(0),1,1)
-            end_mem_embedding = self.end_mem_embedding.unsqueeze(0).repeat(input_embedding.size(0),1,1)
+            prompt_text_embedding, _ = self._prompt_embedding(prompt_text, input_embedding.size(0))
+
+            bos_embedding, mem_embedding, end_mem_embedding = self._special_embeddings(input_embedding.size(0))
             seg_len = math.ceil(input_embedding.size(1)/self.embed_len)
             
             cat_embedding = torch.zeros((input_embedding.size(0),input_embedding.size(1)+seg_len*2,input_embedding.size(2))).to(self.device)
@@ -297,16 +466,136 @@ class Decoder(nn.Module):
             input_embedding = torch.cat((bos_embedding,cat_embedding),dim=1)
 
             embedding = torch.cat((input_embedding,prompt_text_embedding),dim=1).to(self.device)
-            
-            output = embedding.clone()
-            past_key_values = None
-            generate_text = []
-            terminators = [
+            return self._greedy_decode(embedding, max_new_token, kv_cache_bits, static_cache, compile_decode, timings)
+
+    def generate_uncompressed(self, context_text, prompt_text, max_new_token=10, timings=None):
+        """No-compression baseline: the decoder reads the raw context tokens instead of the memory."""
+        self.model.eval()
+        with torch.no_grad():
+            context_ids = self.tokenizer(context_text, add_special_tokens=False, return_tensors='pt')['input_ids']
+            input_ids = torch.cat((torch.tensor([[self.bos_token_id]]), context_ids), dim=1).to(self.device)
+            prompt_text_embedding, _ = self._prompt_embedding("\n\n" + prompt_text, 1)
+            embedding = torch.cat((self.model.get_input_embeddings()(input_ids), prompt_text_embedding), dim=1)
+            return self._greedy_decode(embedding, max_new_token, timings=timings)
+
+    def generate_batch(self, input_embedding, prompt_text, max_new_token=10, kv_cache_bits=None, timings=None):
+        """`generate` for a batch of memories [bsz, mem_len, dim] and one prompt per row; returns the answers."""
+        self.model.eval()
+        with torch.no_grad():
+            prefix = self._get_segment_mem(input_embedding)
+            embeddings = []
+            for row, prompt in enumerate(prompt_text):
+                prompt_embedding, _ = self._prompt_embedding(prompt, 1)
+                embeddings.append(torch.cat((prefix[row], prompt_embedding[0].to(prefix.dtype)), dim=0))
+            return self._greedy_decode_batch(embeddings, max_new_token, kv_cache_bits, timings)
+
+    def generate_uncompressed_batch(self, context_text, prompt_text, max_new_token=10, timings=None):
+        """`generate_uncompressed` for lists of contexts, as text or token ids without special tokens, and prompts."""
+        self.model.eval()
+        with torch.no_grad():
+            embeddings = []
+            for context, prompt in zip(context_text, prompt_text):
+                context_ids = self.tokenizer(context, add_special_tokens=False)['input_ids'] if isinstance(context, str) else list(context)
+                input_ids = torch.tensor([self.bos_token_id] + context_ids, device=self.device)
+                prompt_embedding, _ = self._prompt_embedding("\n\n" + prompt, 1)
+                embeddings.append(torch.cat((self.model.get_input_embeddings()(input_ids), prompt_embedding[0]), dim=0))
+            return self._greedy_decode_batch(embeddings, max_new_token, timings=timings)
+
+    def _sync(self):
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _greedy_decode_batch(self, embeddings, max_new_token, kv_cache_bits=None, timings=None):
+        """
+        Greedy decoding of input embeddings [len_i, dim] of different lengths. Rows are left-padded
+        and masked, with positions starting at their first real token, so each row decodes as it
+        would alone. A row stops at its first terminator; the batch stops when all rows have.
+        """
+        bsz, max_len = len(embeddings), max(e.size(0) for e in embeddings)
+        embedding = torch.zeros((bsz, max_len, embeddings[0].size(-1)), dtype=embeddings[0].dtype, device=self.device)
+        attention_mask = torch.zeros((bsz, max_len), dtype=torch.long, device=self.device)
+        for row, e in enumerate(embeddings):
+            embedding[row, max_len - e.size(0):] = e
+            attention_mask[row, max_len - e.size(0):] = 1
+        position_ids = (attention_mask.cumsum(dim=1) - 1).masked_fill(attention_mask == 0, 1)
+
+        past_key_values = QuantizedKVCache(kv_cache_bits) if kv_cache_bits else None
+        terminators = torch.tensor([
+            token_id for token_id in (
                 self.tokenizer.eos_token_id,
                 self.tokenizer.pad_token_id,
-                self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
-            ]
-
+                self.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
+            ) if token_id is not None
+        ], device=self.device)
+        finished = torch.zeros(bsz, dtype=torch.bool, device=self.device)
+        generate_ids = []
+        if timings is not None:
+            self._sync()
+            begin = time.perf_counter()
+
+        output = embedding
+        with autocast('cuda'):
+            for i in range(max_new_token):
+                out = self.model(inputs_embeds=output, attention_mask=attention_mask, position_ids=position_ids,
+                                 past_key_values=past_key_values, use_cache=True)
+                past_key_values = out.past_key_values
+                next_token_id = torch.argmax(out.logits[:, -1, :len(self.tokenizer)], dim=-1)
+                # finished rows keep decoding a terminator, which is cut off below
+                next_token_id = next_token_id.masked_fill(finished, terminators[0])
+                generate_ids.append(next_token_id)
+                finished |= torch.isin(next_token_id, terminators)
+                # .item() synchronizes, the first step is the prefill
+                all_finished = finished.all().item()
+                if i == 0 and timings is not None:
+                    prefill_end = time.perf_counter()
+                if all_finished:
+                    break
+                output = self.model.get_input_embeddings()(next_token_id.unsqueeze(1))
+                attention_mask = torch.cat((attention_mask, attention_mask.new_ones((bsz, 1))), dim=1)
+                position_ids = position_ids[:, -1:] + 1
+
+        generate_ids = torch.stack(generate_ids, dim=1).tolist()
+        terminator_ids = set(terminators.tolist())
+        answers, new_tokens = [], 0
+        for ids in generate_ids:
+            stop = next((i for i, token_id in enumerate(ids) if token_id in terminator_ids), len(ids) - 1)
+            new_tokens += stop + 1
+            answers.append(self.tokenizer.decode(ids[:stop + 1], skip_special_tokens=True))
+        if timings is not None:
+            end = time.perf_counter()
+            timings["prefill"] = timings.get("prefill", 0.0) + prefill_end - begin
+            timings["decode"] = timings.get("decode", 0.0) + end - prefill_end
+            timings["new_tokens"] = timings.get("new_tokens", 0) + new_tokens
+            timings["prefix_tokens"] = timings.get("prefix_tokens", 0) + sum(e.size(0) for e in embeddings)
+        return answers
+
+    def _greedy_decode(self, embedding, max_new_token, kv_cache_bits=None, static_cache=False, compile_decode=False, timings=None):
+        output = embedding.clone()
+        # optionally keep the (long) memory prefix's kv cache in int8/int4
+        past_key_values = QuantizedKVCache(kv_cache_bits) if kv_cache_bits else None
+        generate_text = []
+        terminators = [
+            self.tokenizer.eos_token_id,
+            self.tokenizer.pad_token_id,
+            self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        ]
+        if timings is not None:
+            self._sync()
+            begin = time.perf_counter()
+
+        if static_cache:
+            runner = self._get_static_runner(embedding.size(0), embedding.size(1) + max_new_token, compile_decode)
+            with autocast('cuda'):
+                logits = runner.prefill(embedding)
+                for i in range(max_new_token):
+                    next_token_id = torch.argmax(logits[:, :len(self.tokenizer)], dim=-1)
+                    generate_text.append(next_token_id.item())
+                    if i == 0 and timings is not None:
+                        prefill_end = time.perf_counter()
+                    if next_token_id.item() in terminators or i == max_new_token - 1:
+                        break
+                    logits = runner.step(next_token_id.unsqueeze(1))
+        else:
             with autocast('cuda'):
                 for i in range(max_new_token):
                     out = self.model(inputs_embeds=output, past_key_values=past_key_values, use_cache=True)
@@ -316,11 +605,20 @@ class Decoder(nn.Module):
                     next_token_id = torch.argmax(logits,dim=-1)
                     output = self.model.get_input_embeddings()(next_token_id.unsqueeze(1).to(self.device))
                     generate_text.append(next_token_id.item())
+                    # .item() has synchronized, the first step is the prefill
+                    if i == 0 and timings is not None:
+                        prefill_end = time.perf_counter()
                     if next_token_id.item() in terminators:
                         break
 
-            output_text = self.tokenizer.decode(generate_text,skip_special_tokens=True)
-            return output_text
+        if timings is not None:
+            end = time.perf_counter()
+            timings["prefill"] = timings.get("prefill", 0.0) + prefill_end - begin
+            timings["decode"] = timings.get("decode", 0.0) + end - prefill_end
+            timings["new_tokens"] = timings.get("new_tokens", 0) + len(generate_text)
+            timings["prefix_tokens"] = timings.get("prefix_tokens", 0) + embedding.size(1)
+        output_text = self.tokenizer.decode(generate_text,skip_special_tokens=True)
+        return output_text
             
 
     def forward(
@@ -330,34 +628,36 @@ class Decoder(nn.Module):
         llm_ids: Union[int,List[int]]=None,
         labels_ids: Union[int,List[int]]=None,
         next_ids: Union[int,List[int]]=None,
-        task_type: Union[str, List[str]]=None
+        task_type: Union[str, List[str]]=None,
+        target_attention_mask: Optional[torch.Tensor]=None,
+        pack_length: Optional[int]=None,
     ):
+        """
+        `pack_length` (rag only): pack the examples into shared rows of at most this many
+        positions, 0 for the padded batch length, see `model/packing.py`. None keeps one row
+        per example.
+        """
         if task_type not in ["ae","next_token","rag"]:
             raise ValueError("task_type must be 'ae' or 'next_token' or 'rag', but got {task_type}")
         
         with torch.no_grad():
-            target_text_ids = torch.tensor(llm_ids).to(self.device) if task_type in ["ae","rag"]  else torch.tensor(next_ids).to(self.device)
+            target_text_ids = to_device_ids(llm_ids if task_type in ["ae","rag"] else next_ids, self.device)
             if target_text_ids.dim() == 1:
-                target_text_ids = target_text_ids.unsqueeze(0).to(self.device)
+                target_text_ids = target_text_ids.unsqueeze(0)
 
-            target_text_attention_mask = (target_text_ids != self.tokenizer.pad_token_id).long().to(self.device)
+            if target_attention_mask is not None:
+                target_text_attention_mask = to_device_ids(target_attention_mask, self.device)
+            else:
+                target_text_attention_mask = (target_text_ids != self.tokenizer.pad_token_id).long()
             target_text_embedding = self.model.get_input_embeddings()(target_text_ids).to(self.device)
             
             if task_type == "ae":
-                encoder_prompt_text = self.tokenizer(
-                        prompt_text,
-                        padding="longest",
-                        add_special_tokens=False,
-                        return_tensors='pt'
-                ).to(self.device)
-                prompt_text_ids = encoder_prompt_text['input_ids']
-                prompt_text_attention_mask = encoder_prompt_text['attention_mask']
-                prompt_text_embedding = self.model.get_input_embeddings()(prompt_text_ids).to(self.device)
+                prompt_text_embedding, prompt_text_attention_mask = self._prompt_embedding(
+                    prompt_text, target_text_ids.size(0)
+                )
                 
         with autocast('cuda', dtype=torch.bfloat16):
-            bos_embedding = self.bos_embedding.unsqueeze(0).repeat(input_embedding.size(0),1,1)
-            mem_embedding = self.mem_embedding.unsqueeze(0).repeat(input_embedding.size(0),1,1)
-            end_mem_embedding = self.end_mem_embedding.unsqueeze(0).repeat(input_embedding.size(0),1,1)
+            bos_embedding, mem_embedding, end_mem_embedding = self._special_embeddings(input_embedding.size(0))
             seg_len = math.ceil(input_embedding.size(1)/self.embed_len)
             # Adjust the shape according to your needs
             cat_embedding = torch.zeros((input_embedding.size(0),input_embedding.size(1)+seg_len*2,input_embedding.size(2))).to(self.device)
@@ -407,10 +707,23 @@ class Decoder(nn.Module):
            empty_target.fill_(-100)
         )
         if task_type == "rag":
-            labels_ids_tensor = torch.tensor(labels_ids).to(self.device)
+            labels_ids_tensor = to_device_ids(labels_ids, self.device)
 
         targets_ = torch.cat((empty_target,targets),dim=1).to(self.device) if task_type in ["ae","next_token"] else torch.cat((empty_target,labels_ids_tensor),dim=1).to(self.device)
         
+        if task_type == "rag" and pack_length is not None:
+            packed = pack_sequences(embedding, attention_mask, targets_, capacity=pack_length, mask_dtype=self.model.dtype)
+            with autocast('cuda', dtype=torch.bfloat16):
+                output = self.model(
+                    inputs_embeds = packed["embedding"],
+                    attention_mask = packed["attention_mask"],
+                    position_ids = packed["position_ids"],
+                    return_dict=True,
+                    labels = packed["targets"],
+                )
+            return {"loss":output.loss.mean(), "logits":output.logits, "target":packed["targets"], "ppl_loss":0,
+                    "num_positions":packed["num_positions"], "num_unpacked_positions":packed["num_unpacked_positions"]}
+
         with autocast('cuda', dtype=torch.bfloat16):
             output = self.model(
                 inputs_embeds = embedding,
@@ -425,6 +738,25 @@ class Decoder(nn.Module):
 
 
 
+def to_device_ids(ids, device):
+    """Move collated id / mask tensors (pinned by the dataloader) without blocking; lists are still accepted."""
+    if isinstance(ids, torch.Tensor):
+        return ids.to(device, non_blocking=True)
+    return torch.tensor(ids).to(device)
+
+
+def load_converter_state_dict(converter_model: str):
+    """Load `memory_converter.bin` from a local file or from a HuggingFace repo."""
+    if os.path.exists(converter_model):
+        return torch.load(converter_model)
+    converter_model_path = hf_hub_download(
+        repo_id=converter_model,
+        filename='memory_converter.bin'
+    )
+    print(f"converter.bin saved to {converter_model_path}")
+    return torch.load(converter_model_path)
+
+
 class PCC(nn.Module):
     def __init__(self, args):
         super(PCC, self).__init__()
@@ -440,7 +772,7 @@ class PCC(nn.Module):
                 device=args.device,
                 embed_len=args.embed_len,
                 max_length=512,
-                is_train=True,
+                is_train=getattr(args, 'train_compressor', True),
                 gradient_checkpoint=args.compressor_gradient_checkpoint
             )
         else:
@@ -465,8 +797,19 @@ class PCC(nn.Module):
             max_length=2048,
             is_train=False,
             embed_len=args.embed_len,
-            gradient_checkpoint=args.decoder_gradient_checkpoint
+            gradient_checkpoint=args.decoder_gradient_checkpoint,
+            revision=getattr(args, 'decoder_revision', None)
         )
+        decoder_recompute = getattr(args, 'decoder_recompute', None)
+        if decoder_recompute:
+            if args.decoder_gradient_checkpoint:
+                raise ValueError("decoder_recompute replaces decoder_gradient_checkpoint, set only one of them")
+            self.decoder.set_recompute_policy(
+                decoder_recompute,
+                batch_size=getattr(args, 'per_device_train_batch_size', 1),
+                seq_len=getattr(args, 'decoder_recompute_seq_len', 0),
+                budget_gb=getattr(args, 'decoder_recompute_budget_gb', 0),
+            )
     
         self.converter = Converter(
             embed_dim=self.compressor.model.config.hidden_size,
@@ -476,32 +819,38 @@ class PCC(nn.Module):
         
         
         if args.converter_model is not None:
-            if os.path.exists(args.converter_model):    
-                self.converter.load_state_dict(torch.load(args.converter_model))
-                print(f"Load converter successfully from {args.converter_model}")
-            else:
-                converter_model_path = hf_hub_download(
-                    repo_id=args.converter_model,
-                    filename='memory_converter.bin'
-                )
-                print(f"converter.bin saved to {converter_model_path}")
-                self.converter.load_state_dict(torch.load(converter_model_path))
-                print(f"Load converter successfully from {args.converter_model}")
+            self.converter.load_state_dict(load_converter_state_dict(args.converter_model))
+            print(f"Load converter successfully from {args.converter_model}")
         else:
             console.print("No converter model loaded, the param of converter will be initialized randomly.", style="bold red")
-    
-    def generate(
-        self, 
-        compress_ids:Union[int,List[int]],
-        prompt_text: Union[str, List[str]],
-        max_new_token: int,
-    ):
-        # set model's mode to eval
-        self.decoder.model.eval()
-        self.compressor.model.eval()
-        self.converter.eval()
-        input_ids = torch.tensor(compress_ids).unsqueeze(0).to(self._device)
-        
+
+        if getattr(args, 'compile_compressor', False):
+            self.compressor.compile_forward(self.segment_length)
+            self.converter.compile_forward()
+
+        # optional out-of-process compression backend (e.g. OnnxCompressor), see `compress`
+        self.compression_backend = None
+        onnx_compressor = getattr(args, 'onnx_compressor', None)
+        if onnx_compressor is not None:
+            self.set_compression_backend(OnnxCompressor(onnx_compressor, device=args.device))
+
+    def compile_seconds(self) -> float:
+        """Time spent compiling the compressor / converter so far (first calls of every compiled shape)."""
+        return sum(
+            module.compiled_forward.compile_seconds
+            for module in (self.compressor, self.converter)
+            if module.compiled_forward is not None
+        )
+
+    def set_compression_backend(self, backend):
+        """
+        Swap the compressor + converter for a backend that maps a [bsz, seg_len] segment
+        to its converted memory [bsz, embed_len, llm_dim]. Pass None to restore PyTorch.
+        """
+        self.compression_backend = backend
+
+    def map_segments(self, input_ids: torch.Tensor, fn):
+        """Apply `fn` to every `segment_length` slice of `input_ids` and concatenate the memories."""
         bsz, input_len = input_ids.size(0), input_ids.size(1)
         
         segment = self.segment_length 
@@ -520,16 +869,84 @@ class PCC(nn.Module):
                 segment_ids = input_ids[:, segment_begin:segment_end]
                 
                 # get per segment's memory
-                memory = self.compressor(segment_ids)
-                text_embedding: Any | torch.Tensor = memory if text_embedding is None else torch.cat(
+                memory = fn(segment_ids)
+                text_embedding = memory if text_embedding is None else torch.cat(
                                                     (text_embedding,memory
                                                 ),dim=1)
-                
-
+        return text_embedding
+
+    def compress(self, input_ids: torch.Tensor, compressor_features: Optional[torch.Tensor] = None):
+        if self.compression_backend is not None:
+            return self.map_segments(input_ids, self.compression_backend)
+        # precomputed compressor memories (see utils/feature_store.py) skip the compressor
+        if compressor_features is not None:
+            text_embedding = compressor_features.to(self._device, non_blocking=True)
+        else:
+            text_embedding = self.map_segments(input_ids, self.compressor)
         # memory_embed's shape equal to [bsz,embed_len*num_segment,llm_dim]
-        memory_embed = self.converter(text_embedding)
-        del text_embedding
-        generate_text = self.decoder.generate(memory_embed, prompt_text, max_new_token)
+        return self.converter(text_embedding)
+    
+    def compress_batch(self, compress_ids: List[List[int]]) -> torch.Tensor:
+        """
+        Memories [bsz, num_segments*embed_len, llm_dim] of unpadded contexts with the same
+        number of segments, compressed together. Only the last segments differ in length;
+        they are left-padded, see `compress_segment`.
+        """
+        if self.compression_backend is not None:
+            # backends take unpadded segments only
+            self._num_segments(compress_ids)
+            return torch.cat([self.compress(torch.tensor([ids], device=self._device)) for ids in compress_ids], dim=0)
+        return self.converter(self.compressor_memory_batch(compress_ids))
+
+    def _num_segments(self, compress_ids: List[List[int]]) -> int:
+        num_segments = {math.ceil(len(ids) / self.segment_length) for ids in compress_ids}
+        if len(num_segments) != 1:
+            raise ValueError(f"contexts of one batch must have the same number of segments, got {sorted(num_segments)}")
+        return num_segments.pop()
+
+    def compressor_memory_batch(self, compress_ids: List[List[int]]) -> torch.Tensor:
+        """Compressor memories (before the converter) of `compress_batch`."""
+        segment = self.segment_length
+        num_segments = self._num_segments(compress_ids)
+        full = (num_segments - 1) * segment
+        last_len = max(len(ids) - full for ids in compress_ids)
+        pad_token_id = self.compressor.tokenizer.pad_token_id
+        input_ids = torch.full((len(compress_ids), full + last_len), pad_token_id, dtype=torch.long)
+        last_mask = torch.zeros((len(compress_ids), last_len), dtype=torch.long)
+        for row, ids in enumerate(compress_ids):
+            input_ids[row, :full] = torch.tensor(ids[:full])
+            n = len(ids) - full
+            input_ids[row, full + last_len - n:] = torch.tensor(ids[full:])
+            last_mask[row, last_len - n:] = 1
+        input_ids = input_ids.to(self._device)
+
+        memories = []
+        with autocast('cuda', dtype=torch.bfloat16):
+            for i in range(num_segments - 1):
+                memories.append(self.compressor(input_ids[:, i * segment:(i + 1) * segment]))
+            memories.append(self.compressor(input_ids[:, full:], attention_mask=last_mask))
+        return torch.cat(memories, dim=1)
+
+    def generate(
+        self, 
+        compress_ids:Union[int,List[int]],
+        prompt_text: Union[str, List[str]],
+        max_new_token: int,
+        kv_cache_bits: Optional[int] = None,
+        static_cache: bool = False,
+        compile_decode: bool = False,
+        timings: Optional[dict] = None,
+    ):
+        # set model's mode to eval
+        self.decoder.model.eval()
+        self.compressor.model.eval()
+        self.converter.eval()
+        input_ids = torch.tensor(compress_ids).unsqueeze(0).to(self._device)
+        
+        memory_embed = self.compress(input_ids)
+        generate_text = self.decoder.generate(memory_embed, prompt_text, max_new_token, kv_cache_bits=kv_cache_bits,
+                                              static_cache=static_cache, compile_decode=compile_decode,
+                                              timings=timings)
         return generate_text
     
     def forward(
@@ -540,39 +957,23 @@ class PCC(nn.Module):
         prompt_text: Union[str, List[str]]=None, 
         next_ids:Union[int,List[int]]=None,
         task_type=None,
-        get_embedding=False
+        get_embedding=False,
+        compressor_features=None,
+        llm_attention_mask=None,
+        next_attention_mask=None,
     ):
-        input_ids = torch.tensor(compress_ids).to(self._device)
+        input_ids = to_device_ids(compress_ids, self._device)
         
         if input_ids.dim() == 1:
-            input_ids = input_ids.unsqueeze(0).to(self._device)
-
-        bsz, input_len = input_ids.size(0), input_ids.size(1)
-        
-        segment = self.segment_length 
-        
-        segment_len = math.ceil(input_len / segment)
-        
-        text_embedding = None
-        
-        for i in range(segment_len):
-            with autocast('cuda', dtype=torch.bfloat16):
-                segment_begin = i * segment
-                segment_end = ((i+1)*segment) if ((i+1)*segment) < input_len else input_len
-                
-                segment_ids = input_ids[:, segment_begin:segment_end]
-                
-                model_instance = self.compressor(segment_ids)
-                text_embedding = model_instance if text_embedding is None else torch.cat(
-                                                    (text_embedding,model_instance
-                                                ),dim=1)
-                
+            input_ids = input_ids.unsqueeze(0)
 
-        embed = self.converter(text_embedding)
+        embed = self.compress(input_ids, compressor_features=compressor_features)
         if get_embedding:
             return embed
         if self.args.stage == 1:
-            if task_type is None:
+            if task_type is None and getattr(self.args, 'joint_stage1_loss', False):
+                task_type = "multi"
+            elif task_type is None:
                 thresold = random.random()
                 if thresold > self.args.next_token_ratio:
                     task_type = "ae"
@@ -583,6 +984,26 @@ class PCC(nn.Module):
         else:
             raise ValueError("stage must be 1 or 2")
 
+        if task_type == "multi":
+            # both stage-1 objectives on the same memory, the compressor runs once
+            ae_dict = self.decoder(input_embedding=embed,prompt_text=prompt_text,llm_ids=llm_ids,labels_ids=None,
+                                   next_ids=next_ids,task_type="ae",target_attention_mask=llm_attention_mask)
+            next_dict = self.decoder(input_embedding=embed,prompt_text=prompt_text,llm_ids=llm_ids,labels_ids=None,
+                                     next_ids=next_ids,task_type="next_token",target_attention_mask=next_attention_mask)
+            # same weighting as sampling the task with next_token_ratio, in expectation
+            ratio = self.args.next_token_ratio
+            return {
+                "loss": (1 - ratio) * ae_dict["loss"] + ratio * next_dict["loss"],
+                "ae": ae_dict,
+                "next_token": next_dict,
+            }
+
+        # packing changes the logits' layout, so it is only used for the training loss
+        pack_length = None
+        if task_type == "rag" and self.training and getattr(self.args, 'pack_sequences', False):
+            pack_length = getattr(self.args, 'pack_length', 0)
         loss_dict = self.decoder(input_embedding=embed,prompt_text=prompt_text,llm_ids=llm_ids,labels_ids=labels_ids,
-                             next_ids=next_ids,task_type=task_type)
+                             next_ids=next_ids,task_type=task_type,
+                             target_attention_mask=next_attention_mask if task_type == "next_token" else llm_attention_mask,
+                             pack_length=pack_length)
         return loss_dict 
\ No newline at end of file
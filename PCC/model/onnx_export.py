@@ -0,0 +1,181 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn.functional import gelu
+
+
+class CompressorConverterGraph(nn.Module):
+    """
+    `Compressor.forward` (memory-token appending, last `embed_len` hidden states) fused
+    with `Converter.forward`, in float32 and without autocast so it can be traced to ONNX.
+    """
+    def __init__(self, compressor, converter):
+        super().__init__()
+        model = copy.deepcopy(compressor.model)
+        if hasattr(model, "merge_and_unload"):
+            # fold LoRA weights into the base model for the exported graph
+            model = model.merge_and_unload()
+        self.model = model.float().cpu().eval()
+        self.converter = copy.deepcopy(converter).float().cpu().eval()
+        self.embed_len = compressor.embed_len
+        self.register_buffer("mem_ids", torch.tensor(compressor.mem_ids, dtype=torch.long).unsqueeze(0))
+
+    def forward(self, input_ids: torch.Tensor):
+        mem_ids = self.mem_ids.expand(input_ids.size(0), -1)
+        input_ids_ = torch.cat((input_ids, mem_ids), dim=1)
+        attention = torch.ones_like(input_ids_)
+        text_embedding = self.model(input_ids=input_ids_, attention_mask=attention, output_hidden_states=True)
+        embedding = text_embedding.hidden_states[-1][:, -self.embed_len:, :]
+        x = self.converter.dense_in(self.converter.RMSNorm(embedding))
+        return self.converter.dense_out(gelu(x))
+
+
+def export_onnx(
+    compressor,
+    converter,
+    output_path: str,
+    segment_length: int = 256,
+    opset: int = 17,
+    check_parity: bool = True,
+    tolerance: float = 1e-2,
+    batch_size: int = 2,
+):
+    """
+    Export the fused compressor + converter graph. Unless `check_parity` is off, the exported
+    model is then compared with the PyTorch path on a full and a ragged segment, see `verify_parity`.
+    """
+    graph = CompressorConverterGraph(compressor, converter)
+    dummy_ids = torch.randint(0, graph.mem_ids.min().item(), (1, segment_length), dtype=torch.long)
+    with torch.no_grad():
+        torch.onnx.export(
+            graph,
+            (dummy_ids,),
+            output_path,
+            input_names=["input_ids"],
+            output_names=["memory"],
+            dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "memory": {0: "batch"}},
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+    print(f"Exported compressor + converter to {output_path}")
+    if check_parity:
+        verify_parity(compressor, converter, OnnxCompressor(output_path), segment_length, tolerance, batch_size)
+    return graph
+
+
+class OnnxCompressor:
+    """
+    onnxruntime (CPU) compression backend for `PCC.set_compression_backend`.
+    Maps a [bsz, seg_len] segment to its converted float32 memory [bsz, embed_len, llm_dim].
+    """
+    def __init__(self, model_path: str, device: str = "cpu", num_threads: int = None):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("OnnxCompressor requires onnxruntime, install it with `pip install onnxruntime`.") from e
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.device = device
+
+    def __call__(self, segment_ids: torch.Tensor):
+        input_ids = segment_ids.detach().cpu().numpy().astype(np.int64)
+        memory = self.session.run(["memory"], {"input_ids": input_ids})[0]
+        return torch.from_numpy(memory).to(self.device)
+
+
+def _torch_compress(compressor, converter, segment_ids):
+    with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+        return converter(compressor(segment_ids)).float()
+
+
+def parity_shapes(batch_size: int, segment_length: int):
+    return [(batch_size, segment_length), (batch_size, segment_length // 3 + 1)]
+
+
+def verify_parity(compressor, converter, onnx_compressor, segment_length: int = 256, tolerance: float = 1e-2,
+                  batch_size: int = 2):
+    """Raise if ONNX memories differ from PyTorch by more than `tolerance` (1 - cosine similarity per slot)."""
+    vocab_size = min(compressor.mem_ids)
+    for shape in parity_shapes(batch_size, segment_length):
+        segment_ids = torch.randint(0, vocab_size, shape)
+        reference = _torch_compress(compressor, converter, segment_ids)
+        memory = onnx_compressor(segment_ids)
+        max_abs = (memory - reference).abs().max().item()
+        cosine = torch.nn.functional.cosine_similarity(memory, reference, dim=-1).min().item()
+        print(f"parity {tuple(shape)}: max abs diff {max_abs:.4e}, min cosine {cosine:.6f}")
+        if cosine < 1 - tolerance:
+            raise AssertionError(f"ONNX memories diverge from PyTorch (min cosine {cosine:.6f})")
+
+
+def run(args):
+    from transformers import AutoConfig
+
+    from .model import Compressor, Converter, load_converter_state_dict
+
+    embed_len = args.segment_length // args.ratio
+    compressor = Compressor(
+        model_name_or_path=args.compress_model,
+        device="cpu",
+        embed_len=embed_len,
+        max_length=512,
+        use_lora=args.use_lora,
+        lora_adapter_path=args.adapter_model,
+    )
+    compressor.model.eval()
+    converter = Converter(
+        embed_dim=compressor.model.config.hidden_size,
+        embed_len=embed_len,
+        llm_dim=AutoConfig.from_pretrained(args.decoder_model).hidden_size,
+    )
+    converter.load_state_dict(load_converter_state_dict(args.converter_model))
+    converter.eval()
+
+    export_onnx(compressor, converter, args.output, segment_length=args.segment_length, opset=args.opset,
+                check_parity=not args.skip_parity, tolerance=args.tolerance, batch_size=args.batch_size)
+    onnx_compressor = OnnxCompressor(args.output, num_threads=args.num_threads)
+
+    if args.benchmark:
+        vocab_size = min(compressor.mem_ids)
+        segment_ids = torch.randint(0, vocab_size, parity_shapes(args.batch_size, args.segment_length)[0])
+        for name, fn in [
+            ("pytorch", lambda: _torch_compress(compressor, converter, segment_ids)),
+            ("onnxruntime", lambda: onnx_compressor(segment_ids)),
+        ]:
+            fn()
+            begin = time.perf_counter()
+            for _ in range(args.repeats):
+                fn()
+            elapsed = (time.perf_counter() - begin) / args.repeats
+            print(f"{name:>12}: {elapsed * 1000:.2f} ms / batch, {args.batch_size / elapsed:.2f} segments/s")
+
+
+if __name__ == "__main__":
+    # python -m model.onnx_export --compress_model Stage2-PCC-Lite-4x --converter_model Stage2-PCC-Lite-4x --output pcc_compressor.onnx --benchmark
+    parser = argparse.ArgumentParser(description="Export PCC compressor + converter to ONNX")
+    parser.add_argument("--compress_model", type=str, required=True)
+    parser.add_argument("--converter_model", type=str, required=True)
+    parser.add_argument("--decoder_model", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct",
+                        help="only its config is read, to size the converter")
+    parser.add_argument("--adapter_model", type=str, default=None)
+    parser.add_argument("--use_lora", type=bool, default=False)
+    parser.add_argument("--segment_length", type=int, default=256)
+    parser.add_argument("--ratio", type=int, default=4)
+    parser.add_argument("--output", type=str, default="pcc_compressor.onnx")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--skip_parity", action="store_true", help="do not compare ONNX memories with the PyTorch path")
+    parser.add_argument("--tolerance", type=float, default=1e-2, help="allowed 1 - cosine similarity per memory slot")
+    parser.add_argument("--benchmark", action="store_true", help="compare CPU throughput of PyTorch and onnxruntime")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,80 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+from typing import Dict, List, Optional
+
+import torch
+
+
+def pack_rows(lengths: List[int], capacity: int) -> List[List[int]]:
+    """First-fit decreasing: indices of the sequences that share each row of `capacity` positions."""
+    rows, free = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for r, space in enumerate(free):
+            if lengths[i] <= space:
+                rows[r].append(i)
+                free[r] -= lengths[i]
+                break
+        else:
+            rows.append([i])
+            free.append(capacity - lengths[i])
+    return rows
+
+
+def pack_sequences(
+    embedding: torch.Tensor,
+    attention_mask: torch.Tensor,
+    targets: torch.Tensor,
+    capacity: Optional[int] = None,
+    mask_dtype: torch.dtype = torch.bfloat16,
+) -> Dict[str, torch.Tensor]:
+    """
+    Pack right-padded sequences ([bsz, seq_len, hidden] embedding, [bsz, seq_len] mask and
+    labels) into fewer rows of at most `capacity` positions (default: seq_len).
+
+    Every sequence keeps its own positions (position ids restart at 0) and only attends to
+    itself through a block-diagonal causal 4D mask, in the inverted form transformers expects
+    (0 to attend, dtype min otherwise). A sequence starts with an unsupervised position (the
+    decoder's bos / memory prefix), so no label is predicted across a sequence boundary and
+    the mean token loss over the packed rows equals the one over the padded batch.
+    """
+    bsz, seq_len, hidden = embedding.shape
+    capacity = capacity or seq_len
+    lengths = attention_mask.sum(dim=1).long().tolist()
+    if max(lengths) > capacity:
+        raise ValueError(f"a sequence of {max(lengths)} tokens does not fit into packed rows of {capacity}")
+    rows = pack_rows(lengths, capacity)
+    row_len = max(sum(lengths[i] for i in row) for row in rows)
+
+    # gather indices into the flattened batch; padding slots point at position 0 and are masked out
+    index = torch.zeros((len(rows), row_len), dtype=torch.long)
+    segment_ids = torch.zeros((len(rows), row_len), dtype=torch.long)
+    position_ids = torch.zeros((len(rows), row_len), dtype=torch.long)
+    for r, row in enumerate(rows):
+        offset = 0
+        for slot, i in enumerate(row, start=1):
+            n = lengths[i]
+            index[r, offset:offset + n] = torch.arange(n) + i * seq_len
+            segment_ids[r, offset:offset + n] = slot
+            position_ids[r, offset:offset + n] = torch.arange(n)
+            offset += n
+
+    device = embedding.device
+    index = index.to(device, non_blocking=True)
+    segment_ids = segment_ids.to(device, non_blocking=True)
+    packed_embedding = embedding.reshape(bsz * seq_len, hidden).index_select(0, index.view(-1))
+    packed_targets = targets.reshape(-1).index_select(0, index.view(-1)).view(len(rows), row_len)
+    packed_targets = packed_targets.masked_fill(segment_ids == 0, -100)
+
+    causal = torch.ones((row_len, row_len), dtype=torch.bool, device=device).tril()
+    allowed = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+    packed_mask = torch.zeros((len(rows), 1, row_len, row_len), dtype=mask_dtype, device=device)
+    packed_mask = packed_mask.masked_fill(~allowed[:, None], torch.finfo(mask_dtype).min)
+    return {
+        "embedding": packed_embedding.view(len(rows), row_len, hidden),
+        "attention_mask": packed_mask,
+        "position_ids": position_ids.to(device, non_blocking=True),
+        "targets": packed_targets,
+        "num_positions": len(rows) * row_len,
+        "num_unpacked_positions": bsz * seq_len,
+    }
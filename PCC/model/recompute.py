@@ -0,0 +1,181 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import functools
+from typing import Dict, List, Tuple
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+# what is recomputed in the backward pass of a decoder layer; only the inputs of the
+# checkpointed parts are kept
+#   none:      everything is kept
+#   attention: input norm + self-attention, keeps the attention inputs
+#   mlp:       post-attention norm + MLP
+#   full:      the whole layer, keeps the layer input
+POLICIES = ("none", "attention", "mlp", "full")
+_SUBMODULES = {
+    "attention": ("input_layernorm", "self_attn"),
+    "mlp": ("post_attention_layernorm", "mlp"),
+}
+
+
+def decoder_layers(model) -> torch.nn.ModuleList:
+    """The transformer layers of a causal LM such as `LlamaForCausalLM` (`model.model.layers`)."""
+    layers = getattr(getattr(model, "model", None), "layers", None)
+    if layers is None:
+        raise ValueError(f"can not find the decoder layers of {type(model).__name__}")
+    return layers
+
+
+def parse_policy(spec: str, num_layers: int) -> List[str]:
+    """
+    Per-layer policies from e.g. "attention" (every layer) or "0-15:full,16-23:attention,24-31:none".
+    Layers that are not listed use "none".
+    """
+    if ":" not in spec:
+        blocks = [f"0-{num_layers - 1}:{spec}"]
+    else:
+        blocks = spec.split(",")
+    policies = ["none"] * num_layers
+    for block in blocks:
+        layer_range, policy = block.strip().split(":")
+        if policy not in POLICIES:
+            raise ValueError(f"unknown recompute policy {policy}, choose from {POLICIES}")
+        first, _, last = layer_range.partition("-")
+        first, last = int(first), int(last or first)
+        if not 0 <= first <= last < num_layers:
+            raise ValueError(f"layer range {layer_range} is out of [0, {num_layers - 1}]")
+        for i in range(first, last + 1):
+            policies[i] = policy
+    return policies
+
+
+def format_policy(policies: List[str]) -> str:
+    """Inverse of `parse_policy`, with consecutive layers of one policy merged into a block."""
+    blocks, first = [], 0
+    for i in range(1, len(policies) + 1):
+        if i == len(policies) or policies[i] != policies[first]:
+            blocks.append(f"{first}-{i - 1}:{policies[first]}")
+            first = i
+    return ",".join(blocks)
+
+
+def _checkpointed(forward):
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        # generation and evaluation run under no_grad and have nothing to recompute
+        if not torch.is_grad_enabled():
+            return forward(*args, **kwargs)
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return wrapper
+
+
+def apply_recompute_policy(model, policies: List[str]):
+    """
+    Checkpoint the parts of every decoder layer given by `policies`, replacing the previous
+    policy. Unlike `gradient_checkpointing_enable` this also works with the frozen decoder in
+    eval mode. The training forward must not build a KV cache, since recomputation would
+    append to it a second time, so `use_cache` is turned off in the config; generation passes
+    `use_cache` explicitly.
+    """
+    layers = decoder_layers(model)
+    if len(policies) != len(layers):
+        raise ValueError(f"{len(policies)} recompute policies for {len(layers)} layers")
+    for layer, policy in zip(layers, policies):
+        targets = [layer] + [getattr(layer, name) for names in _SUBMODULES.values() for name in names]
+        for module in targets:
+            # drop the wrapper of a previous policy, the class forward is used again
+            module.__dict__.pop("forward", None)
+        if policy == "full":
+            layer.forward = _checkpointed(layer.forward)
+        elif policy != "none":
+            for name in _SUBMODULES[policy]:
+                module = getattr(layer, name)
+                module.forward = _checkpointed(module.forward)
+    model.config.use_cache = False
+
+
+def layer_costs(config, seq_len: int, dtype_bytes: int = 2) -> Dict[str, Tuple[float, float]]:
+    """
+    (activation bytes kept for backward, recomputed forward FLOPs) per token of one decoder
+    layer under every policy. The weights are frozen, so the linear layers keep no inputs;
+    what remains are the norms (input and its fp32 copy), SDPA (q, k, v, output), SiLU and
+    the gating product.
+    """
+    h = config.hidden_size
+    i = config.intermediate_size
+    kv = h // config.num_attention_heads * getattr(config, "num_key_value_heads", config.num_attention_heads)
+    norm = h * (dtype_bytes + 4)
+    attention_bytes = norm + (2 * h + 2 * kv) * dtype_bytes
+    mlp_bytes = norm + 3 * i * dtype_bytes
+    # projections plus causal scores / weighted sum over `seq_len` keys on average half long
+    attention_flops = 2 * (2 * h * h + 2 * h * kv) + 2 * seq_len * h
+    mlp_flops = 2 * 3 * h * i
+    return {
+        "none": (attention_bytes + mlp_bytes, 0),
+        "attention": (2 * h * dtype_bytes + mlp_bytes, attention_flops),
+        "mlp": (attention_bytes + 2 * h * dtype_bytes, mlp_flops),
+        "full": (h * dtype_bytes, attention_flops + mlp_flops),
+    }
+
+
+def estimate_activation_bytes(config, policies: List[str], batch_size: int, seq_len: int) -> float:
+    """Decoder activations kept for backward for one micro-batch, logits and loss included."""
+    costs = layer_costs(config, seq_len)
+    tokens = batch_size * seq_len
+    # bf16 logits and their fp32 upcast in the loss
+    logits = tokens * config.vocab_size * (2 + 4)
+    return tokens * sum(costs[policy][0] for policy in policies) + logits
+
+
+def plan_recompute(config, batch_size: int, seq_len: int, memory_budget_bytes: float) -> List[str]:
+    """
+    Per-layer policies that keep the decoder activations within `memory_budget_bytes` with
+    the least recomputation. All layers cost the same, so layers are moved, one at a time,
+    along the lower convex hull of the (bytes, FLOPs) points of the policies.
+    """
+    costs = layer_costs(config, seq_len)
+    # by decreasing memory; a point is dropped when it is not on the lower hull
+    hull = []
+    for policy in sorted(POLICIES, key=lambda p: (-costs[p][0], costs[p][1])):
+        memory, flops = costs[policy]
+        if hull and memory == costs[hull[-1]][0]:
+            continue
+        while hull and flops <= costs[hull[-1]][1]:
+            # saves memory for free, the previous point is dominated
+            hull.pop()
+        while len(hull) >= 2:
+            (m1, f1), (m2, f2) = costs[hull[-2]], costs[hull[-1]]
+            if (f2 - f1) * (m1 - memory) >= (flops - f1) * (m1 - m2):
+                hull.pop()
+            else:
+                break
+        hull.append(policy)
+
+    num_layers = config.num_hidden_layers
+    policies = [hull[0]] * num_layers
+    total = estimate_activation_bytes(config, policies, batch_size, seq_len)
+    tokens = batch_size * seq_len
+    for previous, policy in zip(hull, hull[1:]):
+        saved = (costs[previous][0] - costs[policy][0]) * tokens
+        for i in range(num_layers):
+            if total <= memory_budget_bytes:
+                return policies
+            policies[i] = policy
+            total -= saved
+    if total > memory_budget_bytes:
+        raise ValueError(
+            f"decoder activations need {total / 2**30:.2f} GB even with full recompute, "
+            f"over the budget of {memory_budget_bytes / 2**30:.2f} GB; lower the micro-batch size"
+        )
+    return policies
+
+
+def recompute_overhead(config, policies: List[str], seq_len: int) -> float:
+    """Recomputed FLOPs as a fraction of the decoder's forward + backward FLOPs."""
+    costs = layer_costs(config, seq_len)
+    _, layer_flops = costs["full"]
+    recomputed = sum(costs[policy][1] for policy in policies)
+    # the weights are frozen, so the backward only computes input gradients, about one forward
+    return recomputed / (2 * layer_flops * len(policies))
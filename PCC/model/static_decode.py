@@ -0,0 +1,79 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import logging
+
+import torch
+from transformers.cache_utils import StaticCache
+
+logger = logging.getLogger(__name__)
+
+
+class StaticDecodeRunner:
+    """
+    Greedy decoding on a preallocated `StaticCache` so that every decode step has the
+    same shapes. The single-token step (embedding lookup + decoder + lm_head) can be
+    wrapped with `torch.compile`; if compilation is unavailable or fails the runner
+    falls back to the eager step.
+    """
+    def __init__(self, model, max_batch_size: int, max_cache_len: int, compile: bool = False):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_cache_len = max_cache_len
+        self.cache = StaticCache(
+            config=model.config,
+            max_batch_size=max_batch_size,
+            max_cache_len=max_cache_len,
+            device=model.device,
+            dtype=model.dtype,
+        )
+        self.position = 0
+        self.compiled = False
+        self._step_fn = self._step
+        if compile:
+            if hasattr(torch, "compile"):
+                self._step_fn = torch.compile(self._step, dynamic=False)
+                self.compiled = True
+            else:
+                logger.warning("torch.compile is not available, static decode runs eagerly.")
+
+    def _step(self, token_ids: torch.Tensor, cache_position: torch.Tensor):
+        out = self.model(
+            input_ids=token_ids,
+            past_key_values=self.cache,
+            cache_position=cache_position,
+            use_cache=True,
+            return_dict=True,
+        )
+        return out.logits[:, -1, :]
+
+    def prefill(self, inputs_embeds: torch.Tensor):
+        if inputs_embeds.size(1) >= self.max_cache_len:
+            raise ValueError(f"prefix of {inputs_embeds.size(1)} tokens does not fit a cache of {self.max_cache_len}")
+        self.cache.reset()
+        cache_position = torch.arange(inputs_embeds.size(1), device=inputs_embeds.device)
+        out = self.model(
+            inputs_embeds=inputs_embeds.to(self.model.dtype),
+            past_key_values=self.cache,
+            cache_position=cache_position,
+            use_cache=True,
+            return_dict=True,
+        )
+        self.position = inputs_embeds.size(1)
+        return out.logits[:, -1, :]
+
+    def step(self, token_ids: torch.Tensor):
+        if self.position >= self.max_cache_len:
+            raise ValueError(f"static cache of {self.max_cache_len} tokens is full")
+        cache_position = torch.tensor([self.position], device=token_ids.device)
+        try:
+            logits = self._step_fn(token_ids, cache_position)
+        except Exception as e:
+            if not self.compiled:
+                raise
+            logger.warning(f"Compiled decode step failed ({e}), falling back to eager.")
+            self._step_fn = self._step
+            self.compiled = False
+            logits = self._step(token_ids, cache_position)
+        self.position += 1
+        return logits
@@ -0,0 +1,223 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+
+import pyarrow as pa
+from datasets import load_dataset
+from datasets.fingerprint import Hasher
+from transformers import AutoTokenizer
+from utils.checkpoint import atomic_write
+
+logger = logging.getLogger("preprocess.py")
+
+# hidden, so that `load_dataset(output_dir)` only sees the Arrow shards
+MANIFEST_NAME = ".manifest.json"
+# bump when the produced columns change, so that old outputs are rebuilt
+PREPROCESS_VERSION = 2
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def input_fingerprint(path: str, args: argparse.Namespace, compress_tokenizer, decoder_tokenizer) -> str:
+    """Content hash of `path` plus everything that changes the tokenized output."""
+    settings = {
+        "version": PREPROCESS_VERSION,
+        "content": file_sha256(path),
+        "stage": args.stage,
+        "segment_length": args.segment_length,
+        "segments_per_example": args.segments_per_example,
+        "columns": [args.text_column, args.context_column, args.question_column, args.answer_column],
+        # the whole tokenizer (vocab, merges, normalizer, special tokens, chat template), not only its name
+        "compress_tokenizer": Hasher.hash(compress_tokenizer),
+        "decoder_tokenizer": Hasher.hash(decoder_tokenizer),
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def tokenize_pretrain(batch, compress_tokenizer, decoder_tokenizer, text_column, segment_length, segments_per_example):
+    """
+    Split every document at `segment_length` decoder tokens. `llm_ids` holds
+    `segments_per_example` segments, `next_ids` the segment that follows them and
+    `compress_ids` the compressor tokens of the same text as `llm_ids`.
+    """
+    window = segment_length * segments_per_example
+    llm_ids, next_ids, spans = [], [], []
+    for ids in decoder_tokenizer(batch[text_column], add_special_tokens=False)["input_ids"]:
+        for begin in range(0, len(ids) - window - segment_length + 1, window):
+            llm_ids.append(ids[begin:begin + window])
+            next_ids.append(ids[begin + window:begin + window + segment_length])
+            spans.append(decoder_tokenizer.decode(llm_ids[-1]))
+    compress_ids = compress_tokenizer(spans, add_special_tokens=False)["input_ids"] if spans else []
+    return {
+        "compress_ids": compress_ids,
+        "llm_ids": llm_ids,
+        "next_ids": next_ids,
+        "compress_length": [len(ids) for ids in compress_ids],
+        # as built by DataCollator: the longer decoder target plus eos
+        "decoder_length": [max(len(l), len(n)) + 1 for l, n in zip(llm_ids, next_ids)],
+    }
+
+
+def _answer_text(answer):
+    # squad style {"text": [...]} or a plain list of answers
+    if isinstance(answer, dict):
+        answer = answer["text"]
+    if isinstance(answer, list):
+        answer = answer[0]
+    return answer
+
+
+def tokenize_finetune(batch, compress_tokenizer, decoder_tokenizer, context_column, question_column, answer_column):
+    """Context for the compressor, "Question: ...\\n\\nAnswer: <answer>" for the decoder with labels on the answer only."""
+    compress_ids = compress_tokenizer(batch[context_column], add_special_tokens=False)["input_ids"]
+    llm_ids = decoder_tokenizer(batch[context_column], add_special_tokens=False)["input_ids"]
+    prompts = [f"Question: {question}\n\nAnswer: " for question in batch[question_column]]
+    prompt_ids = decoder_tokenizer(prompts, add_special_tokens=False)["input_ids"]
+    answer_ids = decoder_tokenizer(
+        [_answer_text(answer) for answer in batch[answer_column]], add_special_tokens=False
+    )["input_ids"]
+    query_answer_ids = [p + a for p, a in zip(prompt_ids, answer_ids)]
+    labels = [[-100] * len(p) + a for p, a in zip(prompt_ids, answer_ids)]
+    return {
+        "compress_ids": compress_ids,
+        "llm_ids": llm_ids,
+        "query_answer_ids": query_answer_ids,
+        "labels": labels,
+        "compress_length": [len(ids) for ids in compress_ids],
+        "decoder_length": [len(ids) + 1 for ids in query_answer_ids],
+    }
+
+
+def write_arrow_shards(dataset, output_prefix: str, shard_size: int):
+    """Write `dataset` as Arrow stream files `<output_prefix>-XXXXX.arrow`, readable by `load_dataset`."""
+    num_shards = max(1, -(-len(dataset) // shard_size))
+    files = []
+    for index in range(num_shards):
+        shard = dataset.shard(num_shards, index, contiguous=True).flatten_indices()
+        table = shard.data.table
+        path = f"{output_prefix}-{index:05d}.arrow"
+
+        def write(tmp_path, table=table):
+            with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+
+        atomic_write(path, write)
+        files.append(os.path.basename(path))
+    return files
+
+
+def run(args: argparse.Namespace):
+    compress_tokenizer = AutoTokenizer.from_pretrained(args.compress_tokenizer)
+    decoder_tokenizer = AutoTokenizer.from_pretrained(args.decoder_tokenizer)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    new_manifest = {}
+    for split, patterns in [("train", args.train_files), ("test", args.test_files)]:
+        split_dir = os.path.join(args.output_dir, split)
+        os.makedirs(split_dir, exist_ok=True)
+        paths = sorted(path for pattern in patterns for path in glob.glob(pattern))
+        for path in paths:
+            key = f"{split}:{os.path.abspath(path)}"
+            fingerprint = input_fingerprint(path, args, compress_tokenizer, decoder_tokenizer)
+            entry = manifest.get(key)
+            if (
+                entry is not None
+                and entry["fingerprint"] == fingerprint
+                and all(os.path.exists(os.path.join(split_dir, name)) for name in entry["files"])
+            ):
+                logger.info(f"{path} is unchanged, skipping")
+                new_manifest[key] = entry
+                continue
+
+            extension = os.path.splitext(path)[1].lstrip(".")
+            builder = {"jsonl": "json", "txt": "text"}.get(extension, extension)
+            raw = load_dataset(builder, data_files=path, split="train")
+            if args.stage == 1:
+                fn = tokenize_pretrain
+                fn_kwargs = {"text_column": args.text_column, "segment_length": args.segment_length,
+                             "segments_per_example": args.segments_per_example}
+            else:
+                fn = tokenize_finetune
+                fn_kwargs = {"context_column": args.context_column, "question_column": args.question_column,
+                             "answer_column": args.answer_column}
+            fn_kwargs.update(compress_tokenizer=compress_tokenizer, decoder_tokenizer=decoder_tokenizer)
+            processed = raw.map(
+                fn,
+                batched=True,
+                num_proc=args.num_proc,
+                remove_columns=raw.column_names,
+                fn_kwargs=fn_kwargs,
+                desc=f"Tokenizing {path}",
+            )
+
+            # files of a previous version of this input are replaced
+            if entry is not None:
+                for name in entry["files"]:
+                    stale = os.path.join(split_dir, name)
+                    if os.path.exists(stale):
+                        os.remove(stale)
+            stem = os.path.splitext(os.path.basename(path))[0]
+            files = write_arrow_shards(processed, os.path.join(split_dir, f"{stem}-{fingerprint}"), args.shard_size)
+            new_manifest[key] = {"fingerprint": fingerprint, "files": files, "num_rows": len(processed)}
+            logger.info(f"{path}: {len(processed)} examples in {len(files)} shards")
+
+    # outputs of inputs that were removed
+    for key, entry in manifest.items():
+        if key not in new_manifest:
+            split_dir = os.path.join(args.output_dir, key.split(":", 1)[0])
+            for name in entry["files"]:
+                stale = os.path.join(split_dir, name)
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+    def write_manifest(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(new_manifest, f, indent=2)
+
+    atomic_write(manifest_path, write_manifest)
+    logger.info(f"Done, train with --train_data_dir {args.output_dir} --valid_data_dir {args.output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PCC data preprocessing")
+    parser.add_argument('--stage', type=int, default=1, help="1: pre-training (ae / next token), 2: fine-tuning (rag)")
+    parser.add_argument('--train_files', type=str, nargs='*', default=[], help="json(l) / parquet / csv / arrow / txt files or globs")
+    parser.add_argument('--test_files', type=str, nargs='*', default=[])
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--compress_tokenizer', type=str, default="openai-community/gpt2-large",
+                        help="use the decoder tokenizer for pcc-large")
+    parser.add_argument('--decoder_tokenizer', type=str, default="meta-llama/Meta-Llama-3-8B-Instruct")
+    parser.add_argument('--segment_length', type=int, default=256, help="decoder tokens per segment")
+    parser.add_argument('--segments_per_example', type=int, default=1, help="stage 1: segments compressed per example")
+    parser.add_argument('--text_column', type=str, default="text")
+    parser.add_argument('--context_column', type=str, default="context")
+    parser.add_argument('--question_column', type=str, default="question")
+    parser.add_argument('--answer_column', type=str, default="answers")
+    parser.add_argument('--num_proc', type=int, default=os.cpu_count())
+    parser.add_argument('--shard_size', type=int, default=100000, help="examples per Arrow file")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    run(args)
@@ -0,0 +1,21 @@
+#!/bin/bash
+# Stage 1: raw text (jsonl with a "text" field) -> compress_ids / llm_ids / next_ids
+python preprocess.py \
+    --stage 1 \
+    --train_files "data/raw/train/*.jsonl" \
+    --test_files "data/raw/test/*.jsonl" \
+    --output_dir data/pretrain-256 \
+    --compress_tokenizer openai-community/gpt2-large \
+    --decoder_tokenizer meta-llama/Meta-Llama-3-8B-Instruct \
+    --segment_length 256 \
+    --num_proc 32
+
+# Stage 2: QA data with context / question / answers -> compress_ids / query_answer_ids / labels
+python preprocess.py \
+    --stage 2 \
+    --train_files "data/raw/squad/train.jsonl" \
+    --test_files "data/raw/squad/validation.jsonl" \
+    --output_dir data/sft-squad \
+    --compress_tokenizer openai-community/gpt2-large \
+    --decoder_tokenizer meta-llama/Meta-Llama-3-8B-Instruct \
+    --num_proc 32
@@ -1,7 +1,12 @@
 export CUDA_VISIBLE_DEVICES=0
 
 python -m experience.efficiency.evaluate_efficiency  \
+    --model pcc \
+    --dataset BroAlanTaps/efficiency_samples_8k \
     --ratio 4 \
     --batch_size 8 \
     --input_length 1024 \
-    --generate_length 32
+    --generate_length 32 \
+    --warmup 2 \
+    --trials 10 \
+    --output experience/efficiency/results/input1024_generate32_batch8.json
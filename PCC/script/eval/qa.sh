@@ -13,7 +13,8 @@ python -m experience.qa.evaluate_qa  \
     --decoder_model ${LLM_MODEL_PATH} \
     --compress_ratio ${COMPRESS_RATIO} \
     --write True \
-    --segment_length 256
+    --segment_length 256 \
+    --batch_size 8
 
 
 #---------------PCC Large Configuration---------------#
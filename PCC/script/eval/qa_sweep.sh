@@ -0,0 +1,18 @@
+export CUDA_VISIBLE_DEVICES=0
+
+#---------------PCC Lite Configuration---------------#
+# {ratio} is filled in for every compression ratio
+COMPRESS_MODEL_PATH=Stage2-PCC-Lite-{ratio}x
+CONVERTER_MODEL_PATH=Stage2-PCC-Lite-{ratio}x
+LLM_MODEL_PATH=meta-llama/Meta-Llama-3-8B-Instruct
+
+python -m experience.qa.sweep_ratio \
+    --dataset nq \
+    --ratios 4 8 16 \
+    --include_uncompressed \
+    --compress_model_path ${COMPRESS_MODEL_PATH} \
+    --converter_model_path ${CONVERTER_MODEL_PATH} \
+    --decoder_model ${LLM_MODEL_PATH} \
+    --num_examples 500 \
+    --segment_length 256 \
+    --output_dir ./result/sweep
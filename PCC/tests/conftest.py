@@ -0,0 +1,8 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import os
+import sys
+
+# modules import each other from the PCC root (`from model.model import PCC`)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("deepspeed")
+
+from base_trainer import BaseTrainer
+
+
+def _trainer(zero_stage):
+    trainer = BaseTrainer.__new__(BaseTrainer)
+    trainer.is_deepspeed_enabled = True
+    trainer.accelerator = mock.MagicMock()
+    trainer.accelerator.state.deepspeed_plugin.zero_stage = zero_stage
+    trainer.args = SimpleNamespace(output_dir="out", should_save=True, push_to_hub=False)
+    trainer._save = mock.MagicMock()
+    return trainer
+
+
+@pytest.mark.parametrize("zero_stage", [1, 2])
+def test_save_model_skips_full_state_dict_under_zero(zero_stage, tmp_path):
+    trainer = _trainer(zero_stage)
+    trainer.save_model(str(tmp_path), _internal_call=True)
+    trainer.accelerator.get_state_dict.assert_not_called()
+    trainer._save.assert_called_once_with(str(tmp_path))
+
+
+def test_save_model_only_on_saving_rank(tmp_path):
+    trainer = _trainer(1)
+    trainer.args.should_save = False
+    trainer.save_model(str(tmp_path), _internal_call=True)
+    trainer.accelerator.get_state_dict.assert_not_called()
+    trainer._save.assert_not_called()
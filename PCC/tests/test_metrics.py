@@ -0,0 +1,36 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("sacrebleu")
+evaluate = pytest.importorskip("evaluate")
+
+from utils.metrics import TextStats
+
+PREDICTIONS = [
+    "The cat sat on the mat, didn't it?",
+    "Prices rose 3.5% in 2023 (after a flat year).",
+    "Hello, world! It's a \"test\" -- of tokenization.",
+    "A short one.",
+]
+REFERENCES = [
+    "The cat sat on the mat, did it not?",
+    "Prices rose 3.5% in 2023 (following a flat year).",
+    "Hello world! It is a \"test\" - of tokenization.",
+    "A rather short one.",
+]
+
+
+def test_merged_corpus_bleu_matches_evaluate():
+    # two shards, combined as the trainer all-reduces them
+    shards = [TextStats(), TextStats()]
+    for i, (prediction, reference) in enumerate(zip(PREDICTIONS, REFERENCES)):
+        shards[i % 2].add(prediction, reference)
+    merged = TextStats(shards[0].to_list()).merge(shards[1]).compute()
+
+    expected = evaluate.load("bleu").compute(predictions=PREDICTIONS, references=[[r] for r in REFERENCES])
+    assert merged["bleu"] == pytest.approx(expected["bleu"])
+    for n in range(4):
+        assert merged[f"bleu_{n + 1}gram"] == pytest.approx(expected["precisions"][n])
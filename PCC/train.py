@@ -7,11 +7,13 @@ import warnings
 
 import numpy as np
 import torch
-from base_trainer import BaseTrainer, compute_metrics
+from base_trainer import BaseTrainer, LogCallBack, is_trainable, load_decoder_reference
 from datasets import load_dataset, load_from_disk
 from model.model import PCC
 from transformers import HfArgumentParser
 from utils.argument import DataArguments, TrainArguments
+from utils.feature_store import build_feature_store
+from utils.streaming import StreamingDataset, find_shards
 from utils.utils import DataCollator
 
 
@@ -60,8 +62,19 @@ def main():
     # Set random seed
     set_seed(training_args.random_seed)
 
+    # Rebuild the frozen decoder from the reference recorded in the checkpoint
+    decoder_reference = None
+    if training_args.resume_from_checkpoint:
+        decoder_reference = load_decoder_reference(training_args.last_ckpt_dir)
+        if decoder_reference is not None:
+            training_args.decoder_model = decoder_reference["model_name_or_path"]
+            training_args.decoder_revision = decoder_reference["revision"]
+            logger.info(f"Decoder restored from checkpoint reference: {decoder_reference}")
+
     # Load and prepare model
     model = PCC(training_args)
+    if decoder_reference is not None and decoder_reference["patch_sha256"] != model.decoder.reference()["patch_sha256"]:
+        logger.warning("Decoder special token patch differs from the one the checkpoint was trained with!")
     
     # Configure data collator and trainer
     compressor_type = training_args.compressor_type
@@ -80,9 +93,36 @@ def main():
     train_dataset = None
     eval_dataset = None
     
-    train_dataset = load_dataset(data_args.train_data_dir, split='train')
+    if training_args.streaming:
+        if training_args.cache_compressor_features or training_args.max_tokens_per_batch > 0:
+            raise ValueError("streaming can not be combined with cache_compressor_features or max_tokens_per_batch")
+        train_dataset = StreamingDataset(
+            find_shards(data_args.train_data_dir, 'train'),
+            shuffle_buffer=training_args.shuffle_buffer,
+            seed=training_args.random_seed,
+            rank=training_args.process_index,
+            world_size=training_args.world_size,
+        )
+        # the stream resumes from the position saved in the checkpoint, not by skipping batches
+        training_args.ignore_data_skip = True
+    else:
+        train_dataset = load_dataset(data_args.train_data_dir, split='train')
     
     eval_dataset = load_dataset(data_args.valid_data_dir, split='test')
+
+    # Converter-only training: compress every example once, later epochs read the cached memories
+    if training_args.cache_compressor_features:
+        # cached memories are only valid while the compressor (and a LoRA adapter on it) stays frozen
+        if training_args.train_compressor or is_trainable(model.compressor.model):
+            raise ValueError("cache_compressor_features requires a frozen compressor: --train_compressor False and no LoRA")
+        ids_key = "llm_ids" if compressor_type == "large" else "compress_ids"
+        with training_args.main_process_first(local=False, desc="compressor feature store"):
+            data_collator.feature_store = build_feature_store(
+                model, [train_dataset, eval_dataset], training_args.feature_store_dir, ids_key=ids_key
+            )
+        num_train = len(train_dataset)
+        train_dataset = train_dataset.add_column("feature_idx", list(range(num_train)))
+        eval_dataset = eval_dataset.add_column("feature_idx", list(range(num_train, num_train + len(eval_dataset))))
         
     # Initialize trainer
     trainer = BaseTrainer(
@@ -91,7 +131,7 @@ def main():
         data_collator=data_collator,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
-        compute_metrics=compute_metrics,
+        callbacks=[LogCallBack()],
     )
 
     # Train or resume training
@@ -34,12 +34,21 @@ class TrainArguments(TrainingArguments):
     decoder_model: str = field(
         default="meta-llama/Llama-2-7b-chat-hf", metadata={"help": "path to the language model"},
     )
+    decoder_revision: str = field(
+        default=None, metadata={"help": "hub revision of the language model, restored from decoder_reference.json on resume"},
+    )
     train_compressor: bool = field(
         default=True, metadata={"help": "whether to train the compressor"}
     )
     train_converter: bool = field(
         default=True, metadata={"help": "whether to train the converter"}
     )
+    cache_compressor_features: bool = field(
+        default=False, metadata={"help": "compute frozen compressor memories once and train the converter from the cache, requires a frozen compressor (train_compressor=False, no LoRA)"}
+    )
+    feature_store_dir: str = field(
+        default="train/feature_store", metadata={"help": "where cached compressor memories are stored"}
+    )
     output_dir: str = field(
         default="train/save_dir", metadata={"help": "path to save the model"}
     )
@@ -58,6 +67,9 @@ class TrainArguments(TrainingArguments):
     save_total_limit: int = field(
         default=5, metadata={"help": "save total limit"}
     )
+    telemetry_dir: str = field(
+        default=None, metadata={"help": "if set, write per-step stage timings, throughput, padding and memory as jsonl and prometheus text files here"}
+    )
     logging_steps: int = field(
         default=10, metadata={"help": "logging steps"}
     )
@@ -70,6 +82,15 @@ class TrainArguments(TrainingArguments):
     save_steps: int = field(
         default=1000, metadata={"help": "save steps"}
     ) 
+    streaming: bool = field(
+        default=False, metadata={"help": "stream the train split from local parquet / arrow / jsonl shards instead of loading it, requires max_steps"}
+    )
+    shuffle_buffer: int = field(
+        default=10000, metadata={"help": "streaming: rows shuffled together"}
+    )
+    max_tokens_per_batch: int = field(
+        default=0, metadata={"help": "if > 0, batch length-bucketed examples up to this many padded (compressor + decoder) tokens instead of per_device_train_batch_size"}
+    )
     per_device_train_batch_size: int = field(
         default=1, metadata={"help": "batch size per device"}
     )
@@ -79,6 +100,12 @@ class TrainArguments(TrainingArguments):
     eval_steps: int = field(
         default=2000, metadata={"help": "evaluation steps"}
     )
+    eval_metric_workers: int = field(
+        default=0, metadata={"help": "if > 0, decode and score eval predictions on this many background processes while training continues"}
+    )
+    eval_token_budget: int = field(
+        default=0, metadata={"help": "if > 0, intermediate evaluations use a fixed length-stratified subset of about this many tokens, the full set is evaluated after training"}
+    )
     per_device_eval_batch_size: int = field(
         default=1, metadata={"help": "batch size per device"}
     )
@@ -94,6 +121,15 @@ class TrainArguments(TrainingArguments):
     next_token_ratio: float = field(
         default=0.5, metadata={"help": "ratio of Language Modeling task"}
     )
+    joint_stage1_loss: bool = field(
+        default=False, metadata={"help": "stage 1: compress once and train on (1 - next_token_ratio) * ae + next_token_ratio * next_token loss instead of sampling a task"}
+    )
+    pack_sequences: bool = field(
+        default=False, metadata={"help": "stage 2: pack the examples of a batch into shared decoder rows (block-diagonal attention, position ids restart per example)"}
+    )
+    pack_length: int = field(
+        default=0, metadata={"help": "pack_sequences: positions per packed row, 0 for the padded batch length"}
+    )
     use_mem_toekn: bool = field(
         default=True, metadata={"help": "whether use mem token"}
     )
@@ -112,6 +148,9 @@ class TrainArguments(TrainingArguments):
     random_seed: int = field(
         default=42, metadata={"help": "random seed"}
     )
+    checkpoint_sink: str = field(
+        default=None, metadata={"help": "where finished checkpoints are uploaded: 'hub', a local directory, or None (hub when HF_TOKEN is set)"}
+    )
     upload_hf: bool = field(
         default=False, metadata={"help": "whether to upload to huggingface"}
     )
@@ -130,9 +169,21 @@ class TrainArguments(TrainingArguments):
     compressor_gradient_checkpoint: bool = field(
         default=False, metadata={"help": "whether to use gradient checkpointing for compressor"}
     )
+    compile_compressor: bool = field(
+        default=False, metadata={"help": "torch.compile the compressor (full segments only, the ragged last segment runs eagerly) and converter forward for training"}
+    )
     decoder_gradient_checkpoint: bool = field(
         default=False, metadata={"help": "whether to use gradient checkpointing for decoder"}
     )
+    decoder_recompute: str = field(
+        default=None, metadata={"help": "selective recompute of decoder layers, e.g. \"0-15:full,16-31:attention\" (none / attention / mlp / full per layer block), or \"auto\" to plan it from decoder_recompute_budget_gb"}
+    )
+    decoder_recompute_budget_gb: float = field(
+        default=0, metadata={"help": "decoder_recompute auto: activation memory budget of the decoder per micro-batch"}
+    )
+    decoder_recompute_seq_len: int = field(
+        default=0, metadata={"help": "decoder_recompute auto: decoder tokens per example to plan for, 0 for the decoder max length"}
+    )
     
     
 @dataclass
@@ -0,0 +1,249 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import gc
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Dict, List
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "pcc", "batch_probe.json")
+PROBE_MODES = ["compress", "decode", "decode_uncompressed"]
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # ru_maxrss is a lifetime peak in KB on Linux, the best we can do without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemoryMonitor:
+    """
+    Peak memory of the enclosed block: allocator stats on accelerators, sampled RSS on CPU.
+    """
+    def __init__(self, device: str, interval: float = 0.005):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, current_rss_bytes())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def start(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self.peak_bytes = current_rss_bytes()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Ends the block; a no-op if it is not running."""
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            self.peak_bytes = torch.cuda.max_memory_allocated(self.device)
+        elif self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.peak_bytes = max(self.peak_bytes, current_rss_bytes())
+
+
+def model_fingerprint(model) -> str:
+    """
+    Stable id of a `PCC` instance: checkpoints, LoRA adapter (and whether it is merged), segment
+    config, parameter count, dtypes and the device, for GPUs its model and total memory.
+    """
+    device = torch.device(model._device)
+    if device.type == "cuda":
+        properties = torch.cuda.get_device_properties(device)
+        device_id = f"{properties.name}:{properties.total_memory}"
+    else:
+        device_id = device.type
+    parts = [
+        model.compressor.model.config._name_or_path,
+        model.decoder.model.config._name_or_path,
+        str(getattr(model.args, "adapter_model", None) if getattr(model.args, "use_lora", False) else None),
+        # a merged adapter leaves a plain model behind, an unmerged one a PeftModel
+        type(model.compressor.model).__name__,
+        f"segment_length={model.segment_length}",
+        f"embed_len={model.compressor.embed_len}",
+        f"compressor_max_length={model.compressor.max_length}",
+        f"decoder_max_length={model.decoder.max_length}",
+        str(sum(p.numel() for p in model.parameters())),
+        str(model.compressor.model.dtype),
+        str(model.decoder.model.dtype),
+        device_id,
+    ]
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:16]
+
+
+def _is_oom(e: BaseException) -> bool:
+    if isinstance(e, MemoryError):
+        return True
+    if hasattr(torch.cuda, "OutOfMemoryError") and isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and "out of memory" in str(e).lower()
+
+
+def _release(device):
+    gc.collect()
+    if torch.device(device).type == "cuda":
+        torch.cuda.empty_cache()
+
+
+def _run_compress(model, batch_size, length):
+    vocab_size = min(model.compressor.mem_ids)
+    input_ids = torch.randint(0, vocab_size, (batch_size, length), device=model._device)
+    model.compress(input_ids)
+
+
+def _run_decode(model, batch_size, length, max_new_token, compressed=True):
+    decoder = model.decoder
+    hidden_size = decoder.model.config.hidden_size
+    if compressed:
+        num_slots = math.ceil(length / model.segment_length) * decoder.embed_len
+        memory = torch.randn(batch_size, num_slots, hidden_size, device=model._device)
+        prefix = decoder._get_segment_mem(memory)
+    else:
+        prefix = torch.randn(batch_size, length, hidden_size, device=model._device)
+    out = decoder.model(inputs_embeds=prefix.to(decoder.model.dtype), use_cache=True)
+    past_key_values = out.past_key_values
+    next_tokens = torch.argmax(out.logits[:, -1, :], dim=-1)
+    for _ in range(1, max_new_token):
+        token_embeds = decoder.model.get_input_embeddings()(next_tokens.unsqueeze(1))
+        out = decoder.model(inputs_embeds=token_embeds, past_key_values=past_key_values, use_cache=True)
+        past_key_values = out.past_key_values
+        next_tokens = torch.argmax(out.logits[:, -1, :], dim=-1)
+
+
+def _load_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def _store_cache(cache_path, key, result):
+    if cache_path is None:
+        return
+    cache = _load_cache(cache_path)
+    cache[key] = result
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, cache_path)
+
+
+def find_max_batch_size(
+    model,
+    lengths: List[int],
+    memory_budget_bytes: int,
+    mode: str = "compress",
+    max_new_token: int = 32,
+    length_quantile: float = 1.0,
+    max_batch_size: int = 1024,
+    cache_path: str = DEFAULT_CACHE_PATH,
+) -> Dict[str, int]:
+    """
+    Binary-search the largest batch whose peak memory stays within `memory_budget_bytes`.
+
+    Args:
+    - model: a `PCC` instance
+    - lengths: input length distribution in compressor tokens
+    - memory_budget_bytes: budget for the whole process (RSS on CPU, allocator peak on accelerators)
+    - mode: "compress", "decode" (compressed prefix) or "decode_uncompressed" (raw prefix)
+    - max_new_token: decode steps to run per probe
+    - length_quantile: quantile of `lengths` used as the probe length (1.0 = longest)
+
+    Returns a dict with `batch_size`, `max_tokens` (batch_size * probe length) and `peak_bytes`;
+    raises RuntimeError if not even a batch of 1 fits.
+    Results are cached per (model fingerprint, ratio, segment_length, mode, length, budget).
+    """
+    if mode not in PROBE_MODES:
+        raise ValueError(f"mode must be one of {PROBE_MODES}, but got {mode}")
+    sorted_lengths = sorted(lengths)
+    length = sorted_lengths[min(len(sorted_lengths) - 1, int(length_quantile * len(sorted_lengths)))]
+    ratio = model.segment_length // model.decoder.embed_len
+    key = "|".join([
+        model_fingerprint(model), f"ratio={ratio}", f"segment_length={model.segment_length}",
+        mode, f"length={length}", f"new_tokens={max_new_token}", f"budget={int(memory_budget_bytes)}",
+    ])
+    cache = _load_cache(cache_path)
+    if key in cache and cache[key]["batch_size"] > 0:
+        return cache[key]
+
+    def fits(batch_size):
+        try:
+            with torch.no_grad(), PeakMemoryMonitor(model._device) as monitor:
+                if mode == "compress":
+                    _run_compress(model, batch_size, length)
+                else:
+                    _run_decode(model, batch_size, length, max_new_token, compressed=(mode == "decode"))
+            ok = monitor.peak_bytes <= memory_budget_bytes
+            logger.info(f"probe {mode} batch_size={batch_size}: peak {monitor.peak_bytes / 1024 ** 3:.2f} GB, fits={ok}")
+            return ok, monitor.peak_bytes
+        except Exception as e:
+            if not _is_oom(e):
+                raise
+            logger.info(f"probe {mode} batch_size={batch_size}: out of memory")
+            return False, None
+        finally:
+            _release(model._device)
+
+    best, best_peak = 0, 0
+    low, high = 1, None
+    # grow geometrically until the first failure, then bisect
+    while high is None and low <= max_batch_size:
+        ok, peak = fits(low)
+        if ok:
+            best, best_peak = low, peak
+            low *= 2
+        else:
+            high = low
+    high = min(high if high is not None else max_batch_size + 1, max_batch_size + 1)
+    low = best + 1
+    while low < high:
+        mid = (low + high) // 2
+        ok, peak = fits(mid)
+        if ok:
+            best, best_peak = mid, peak
+            low = mid + 1
+        else:
+            high = mid
+
+    if best == 0:
+        raise RuntimeError(
+            f"probe {mode}: even a batch of 1 with {length} tokens does not fit the memory budget of "
+            f"{memory_budget_bytes / 1024 ** 3:.2f} GB; raise the budget or shorten the inputs"
+        )
+    result = {"batch_size": best, "max_tokens": best * length, "peak_bytes": best_peak}
+    _store_cache(cache_path, key, result)
+    return result
@@ -0,0 +1,145 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import logging
+import os
+import shutil
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+import torch
+from huggingface_hub import HfApi
+from safetensors.torch import save_file
+
+logger = logging.getLogger(__name__)
+
+
+class LocalDirectorySink:
+    """Copies the files of every finished checkpoint to `root/<name>`; stands in for the hub in local runs."""
+    def __init__(self, root: str):
+        self.root = root
+
+    def upload(self, local_dir: str, name: str, file_names: List[str]):
+        target = os.path.join(self.root, name)
+        os.makedirs(target, exist_ok=True)
+        for file_name in file_names:
+            shutil.copy2(os.path.join(local_dir, file_name), os.path.join(target, file_name))
+
+
+class HubSink:
+    """Uploads every finished checkpoint to a (private) HuggingFace repo named `<name>`."""
+    def __init__(self, token: str, private: bool = True):
+        self.api = HfApi(token=token)
+        self.private = private
+
+    def upload(self, local_dir: str, name: str, file_names: List[str]):
+        repo_id = self.api.create_repo(name, private=self.private, exist_ok=True).repo_id
+        self.api.upload_folder(folder_path=local_dir, repo_id=repo_id, allow_patterns=list(file_names))
+
+
+def build_sink(checkpoint_sink: Optional[str]):
+    """`checkpoint_sink` is "hub", a local directory, or None (hub when HF_TOKEN is set)."""
+    hf_token = os.environ.get('HF_TOKEN', '')
+    if checkpoint_sink is None:
+        return HubSink(hf_token) if hf_token else None
+    if checkpoint_sink == "hub":
+        if not hf_token:
+            raise ValueError("checkpoint_sink='hub' requires the HF_TOKEN environment variable")
+        return HubSink(hf_token)
+    return LocalDirectorySink(checkpoint_sink)
+
+
+def _fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: str, write_fn: Callable[[str], None]):
+    """Write through `write_fn` to a temporary file, fsync it and rename it into place."""
+    tmp_path = f"{path}.tmp"
+    write_fn(tmp_path)
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+class AsyncCheckpointWriter:
+    """
+    Snapshots state dicts into reusable (pinned) CPU buffers and writes them on a background
+    thread. At most one save is in flight; a failure is raised at the next `submit` or `wait`.
+    """
+    def __init__(self, sink=None):
+        self.sink = sink
+        self._buffers: Dict[str, torch.Tensor] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    def snapshot(self, state_dict: Dict[str, torch.Tensor], prefix: str = ""):
+        self.wait()
+        snapshot = {}
+        seen = set()
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach()
+            # tied weights (e.g. gpt2's lm_head) are stored once, like `save_pretrained` does
+            storage_key = (tensor.device, tensor.data_ptr(), tuple(tensor.shape))
+            if storage_key in seen:
+                continue
+            seen.add(storage_key)
+            key = prefix + name
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+                buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+                self._buffers[key] = buffer
+            buffer.copy_(tensor, non_blocking=True)
+            snapshot[name] = buffer
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return snapshot
+
+    def submit(
+        self,
+        output_dir: str,
+        files: Dict[str, Dict[str, torch.Tensor]],
+        name: str = None,
+        metadata_files: Iterable[str] = (),
+    ):
+        """
+        Args:
+        - output_dir: checkpoint directory the files are written to
+        - files: file name -> snapshot from `snapshot`; `.safetensors` names are written with
+          safetensors, anything else with `torch.save`
+        - name: checkpoint name handed to the sink after all files are durable
+        - metadata_files: files the caller already wrote to `output_dir` (configs, tokenizer),
+          uploaded along with `files`. Nothing else in the directory reaches the sink, since
+          other writers (e.g. the optimizer state of HF Trainer) may still be writing to it.
+        """
+        self.wait()
+        metadata_files = list(metadata_files)
+        self._thread = threading.Thread(target=self._write, args=(output_dir, files, name, metadata_files), daemon=False)
+        self._thread.start()
+
+    def _write(self, output_dir, files, name, metadata_files):
+        try:
+            for file_name, tensors in files.items():
+                path = os.path.join(output_dir, file_name)
+                if file_name.endswith(".safetensors"):
+                    atomic_write(path, lambda p: save_file(tensors, p, metadata={"format": "pt"}))
+                else:
+                    atomic_write(path, lambda p: torch.save(tensors, p))
+            if self.sink is not None and name is not None:
+                self.sink.upload(output_dir, name, list(files) + metadata_files)
+            logger.info(f"Checkpoint written to {output_dir}")
+        except BaseException as e:
+            self._error = e
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("previous asynchronous checkpoint save failed") from error
@@ -0,0 +1,162 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import hashlib
+import json
+import logging
+import math
+import os
+from typing import List
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from .checkpoint import atomic_write
+
+logger = logging.getLogger(__name__)
+
+DATA_NAME = "features.bin"
+INDEX_NAME = "offsets.npy"
+META_NAME = "meta.json"
+
+
+class FeatureStore:
+    """
+    Per-example compressor memories [num_slots, dim] in one memory-mapped file plus an
+    index of every example's (start, end) rows. bf16 values are stored bit-exact as int16.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_NAME)) as f:
+            self.meta = json.load(f)
+        self.dim = self.meta["dim"]
+        self.offsets = np.load(os.path.join(path, INDEX_NAME))
+        self._data = None
+
+    def __getstate__(self):
+        # dataloader workers re-open the memmap instead of pickling it
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.path, DATA_NAME), dtype=np.int16, mode="r").reshape(-1, self.dim)
+        return self._data
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        start, end = self.offsets[idx]
+        rows = np.array(self.data[start:end])
+        return torch.from_numpy(rows).view(torch.bfloat16)
+
+    def batch(self, indices: List[int]) -> torch.Tensor:
+        """Stack memories, right-padding examples with fewer segments with zeros."""
+        features = [self[i] for i in indices]
+        max_slots = max(f.size(0) for f in features)
+        batch = torch.zeros((len(features), max_slots, self.dim), dtype=torch.bfloat16)
+        for i, f in enumerate(features):
+            batch[i, :f.size(0)] = f
+        return batch
+
+
+# bump when the file layout changes, so that old stores are rebuilt
+STORE_VERSION = 3
+
+
+def _weights_fingerprint(module) -> str:
+    """Hash of the LoRA adapter weights of a peft compressor, of all its weights otherwise."""
+    adapter_only = hasattr(module, "peft_config")
+    sha = hashlib.sha256()
+    for name, param in module.named_parameters():
+        if adapter_only and "lora" not in name:
+            continue
+        sha.update(name.encode())
+        sha.update(param.detach().reshape(-1).contiguous().view(torch.uint8).cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+def _store_meta(model, datasets, ids_key):
+    return {
+        "version": STORE_VERSION,
+        "compressor": model.compressor.model.config._name_or_path,
+        # the same base path may hold other weights (a fine-tuned compressor, another adapter)
+        "adapter": getattr(model.args, "adapter_model", None) if getattr(model.args, "use_lora", False) else None,
+        "weights": _weights_fingerprint(model.compressor.model),
+        "embed_len": model.compressor.embed_len,
+        "segment_length": model.segment_length,
+        "ids_key": ids_key,
+        "datasets": [getattr(ds, "_fingerprint", None) for ds in datasets],
+        "num_examples": sum(len(ds) for ds in datasets),
+        "dim": model.compressor.model.config.hidden_size,
+    }
+
+
+def _lengths(dataset, ids_key):
+    # preprocess.py stores the length, anything else is measured
+    if ids_key == "compress_ids" and "compress_length" in getattr(dataset, "column_names", []):
+        return list(dataset["compress_length"])
+    return [len(dataset[idx][ids_key]) for idx in range(len(dataset))]
+
+
+def build_feature_store(model, datasets, path: str, ids_key: str = "compress_ids", batch_size: int = 16) -> FeatureStore:
+    """
+    Run the (frozen) compressor once over `datasets` and write every example's memory to
+    `path`. An existing store built from the same inputs is reused.
+    Examples are sorted by length and batched per segment count; the ragged last segments are
+    left-padded and masked (`PCC.compressor_memory_batch`), so no padding enters the memory.
+    Memories are written in that order and the index keeps every example's (start, end) rows.
+    """
+    meta = _store_meta(model, datasets, ids_key)
+    meta_path = os.path.join(path, META_NAME)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                logger.info(f"Reusing compressor feature store at {path}")
+                return FeatureStore(path)
+        # the old store is invalid from here on, also if this rebuild is interrupted
+        os.remove(meta_path)
+
+    os.makedirs(path, exist_ok=True)
+    num_examples = meta["num_examples"]
+    offsets = np.zeros((num_examples, 2), dtype=np.int64)
+    row_count = 0
+    compressor = model.compressor
+    compressor.model.eval()
+    with open(os.path.join(path, DATA_NAME), "wb") as f, torch.no_grad():
+        base = 0
+        for dataset in datasets:
+            lengths = _lengths(dataset, ids_key)
+            order = sorted(range(len(dataset)), key=lambda i: lengths[i])
+            batches, batch = [], []
+            for idx in order:
+                if batch and (len(batch) == batch_size or
+                              math.ceil(lengths[idx] / model.segment_length) != math.ceil(lengths[batch[0]] / model.segment_length)):
+                    batches.append(batch)
+                    batch = []
+                batch.append(idx)
+            if batch:
+                batches.append(batch)
+
+            with tqdm(total=len(dataset), desc=f"Caching compressor features to {path}") as progress:
+                for batch in batches:
+                    memory = model.compressor_memory_batch([dataset[idx][ids_key] for idx in batch])
+                    for idx, row in zip(batch, memory.to(torch.bfloat16).cpu()):
+                        f.write(row.view(torch.int16).numpy().tobytes())
+                        offsets[base + idx] = (row_count, row_count + row.size(0))
+                        row_count += row.size(0)
+                    progress.update(len(batch))
+            base += len(dataset)
+    np.save(os.path.join(path, INDEX_NAME), offsets)
+
+    def write_meta(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f, indent=2)
+
+    # meta is written last, atomically, and marks the store as complete
+    atomic_write(meta_path, write_meta)
+    return FeatureStore(path)
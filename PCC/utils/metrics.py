@@ -0,0 +1,183 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import math
+import multiprocessing as mp
+import re
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import torch
+from sacrebleu.tokenizers.tokenizer_13a import Tokenizer13a
+
+MAX_ORDER = 4
+
+
+_tokenizer_13a = Tokenizer13a()
+
+
+def bleu_tokenize(text: str) -> List[str]:
+    # sacrebleu's 13a tokenizer, the default of `evaluate`'s bleu, so eval_bleu* stays comparable
+    return _tokenizer_13a(text).split()
+
+
+def rouge_tokenize(text: str) -> List[str]:
+    # rouge_score's default: lowercase alphanumeric runs
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def _ngrams(tokens: List[str], n: int) -> Counter:
+    return Counter(tuple(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+
+
+def _f1(overlap: int, pred: int, ref: int) -> float:
+    precision = overlap / pred if pred > 0 else 0.0
+    recall = overlap / ref if ref > 0 else 0.0
+    return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+
+def _lcs(a: List[str], b: List[str]) -> int:
+    if not a or not b:
+        return 0
+    previous = [0] * (len(b) + 1)
+    for x in a:
+        current = [0]
+        for j, y in enumerate(b):
+            current.append(previous[j] + 1 if x == y else max(previous[j + 1], current[j]))
+        previous = current
+    return previous[-1]
+
+
+class TextStats:
+    """
+    Additive statistics for corpus BLEU and ROUGE-1/2/L. ROUGE keeps the sum of per-example
+    F-scores and the example count, so it stays the macro average `evaluate`'s rouge reports.
+    Stats of different shards (batches, ranks, worker processes) are combined by summing `to_list()`.
+    """
+    NAMES = (
+        [f"bleu_match_{n}" for n in range(1, MAX_ORDER + 1)]
+        + [f"bleu_total_{n}" for n in range(1, MAX_ORDER + 1)]
+        + ["bleu_hyp_len", "bleu_ref_len"]
+        + [f"rouge{k}_fsum" for k in ["1", "2", "L"]]
+        + ["num_examples"]
+    )
+
+    def __init__(self, values: List[float] = None):
+        self.values = dict(zip(self.NAMES, values if values is not None else [0.0] * len(self.NAMES)))
+
+    def add(self, prediction: str, reference: str):
+        pred, ref = bleu_tokenize(prediction), bleu_tokenize(reference)
+        for n in range(1, MAX_ORDER + 1):
+            pred_ngrams, ref_ngrams = _ngrams(pred, n), _ngrams(ref, n)
+            self.values[f"bleu_match_{n}"] += sum((pred_ngrams & ref_ngrams).values())
+            self.values[f"bleu_total_{n}"] += max(len(pred) - n + 1, 0)
+        self.values["bleu_hyp_len"] += len(pred)
+        self.values["bleu_ref_len"] += len(ref)
+
+        pred, ref = rouge_tokenize(prediction), rouge_tokenize(reference)
+        for n in [1, 2]:
+            pred_ngrams, ref_ngrams = _ngrams(pred, n), _ngrams(ref, n)
+            overlap = sum((pred_ngrams & ref_ngrams).values())
+            self.values[f"rouge{n}_fsum"] += _f1(overlap, sum(pred_ngrams.values()), sum(ref_ngrams.values()))
+        self.values["rougeL_fsum"] += _f1(_lcs(pred, ref), len(pred), len(ref))
+        self.values["num_examples"] += 1
+
+    def to_list(self) -> List[float]:
+        return [self.values[name] for name in self.NAMES]
+
+    def merge(self, other: "TextStats"):
+        for name in self.NAMES:
+            self.values[name] += other.values[name]
+        return self
+
+    def compute(self) -> Dict[str, float]:
+        v = self.values
+        precisions = [
+            v[f"bleu_match_{n}"] / v[f"bleu_total_{n}"] if v[f"bleu_total_{n}"] > 0 else 0.0
+            for n in range(1, MAX_ORDER + 1)
+        ]
+        # same formula as `evaluate`'s bleu (no smoothing)
+        if min(precisions) > 0:
+            geo_mean = math.exp(sum(math.log(p) for p in precisions) / MAX_ORDER)
+        else:
+            geo_mean = 0.0
+        ratio = v["bleu_hyp_len"] / v["bleu_ref_len"] if v["bleu_ref_len"] > 0 else 0.0
+        brevity_penalty = 1.0 if ratio > 1.0 else (math.exp(1 - 1.0 / ratio) if ratio > 0 else 0.0)
+
+        def rouge(k):
+            return v[f"rouge{k}_fsum"] / v["num_examples"] if v["num_examples"] > 0 else 0.0
+
+        return {
+            "bleu": geo_mean * brevity_penalty,
+            "bleu_1gram": precisions[0],
+            "bleu_2gram": precisions[1],
+            "bleu_3gram": precisions[2],
+            "bleu_4gram": precisions[3],
+            "rouge1": rouge("1"),
+            "rouge2": rouge("2"),
+            "rougeL": rouge("L"),
+        }
+
+
+def teacher_forced_pairs(logits: torch.Tensor, targets: torch.Tensor):
+    """
+    Argmax predictions and labels of the supervised positions, per example. Logits at
+    position t predict the label at t + 1, as in the decoder's causal LM loss.
+    """
+    predictions = torch.argmax(logits[:, :-1, :], dim=-1)
+    labels = targets[:, 1:]
+    mask = labels != -100
+    return [
+        (predictions[i][mask[i]].tolist(), labels[i][mask[i]].tolist())
+        for i in range(labels.size(0))
+    ]
+
+
+def loss_stats(output: Dict[str, torch.Tensor]) -> List[float]:
+    """[summed token loss, supervised tokens] of one decoder output, exact to combine across batches."""
+    num_tokens = (output["target"][:, 1:] != -100).sum().item()
+    return [output["loss"].item() * num_tokens, num_tokens]
+
+
+def text_stats_from_pairs(tokenizer, pairs: List[Tuple[List[int], List[int]]]) -> List[float]:
+    """Decode (prediction ids, label ids) pairs and return their `TextStats` as a list."""
+    stats = TextStats()
+    for predictions, labels in pairs:
+        stats.add(
+            tokenizer.decode(predictions, skip_special_tokens=True),
+            tokenizer.decode(labels, skip_special_tokens=True),
+        )
+    return stats.to_list()
+
+
+_worker_tokenizer = None
+
+
+def _init_metric_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _text_stats_job(pairs):
+    return text_stats_from_pairs(_worker_tokenizer, pairs)
+
+
+class MetricWorkerPool:
+    """
+    Decoding and n-gram counting on `num_workers` spawned processes, fed through the
+    executor's call queue, so the training process only runs the forward passes.
+    """
+    def __init__(self, tokenizer, num_workers: int):
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_metric_worker,
+            initargs=(tokenizer,),
+        )
+
+    def submit(self, pairs) -> Future:
+        return self.executor.submit(_text_stats_job, pairs)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,143 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import random
+from typing import Iterator, List, Tuple
+
+from torch.utils.data import Sampler
+
+
+def example_lengths(dataset, stage: int, compressor_type: str) -> Tuple[List[int], List[int]]:
+    """Compressor and decoder token counts of every example, as `DataCollator` will build them."""
+    # stored by preprocess.py
+    if "compress_length" in dataset.column_names and "decoder_length" in dataset.column_names:
+        return dataset["compress_length"], dataset["decoder_length"]
+    compress_key = "llm_ids" if compressor_type == "large" else "compress_ids"
+    compress_lengths = [len(ids) for ids in dataset[compress_key]]
+    if stage == 1:
+        # the decoder sees either llm_ids (ae) or next_ids (next_token), plus eos
+        decoder_lengths = [
+            max(len(llm_ids), len(next_ids)) + 1
+            for llm_ids, next_ids in zip(dataset["llm_ids"], dataset["next_ids"])
+        ]
+    else:
+        decoder_lengths = [len(ids) + 1 for ids in dataset["query_answer_ids"]]
+    return compress_lengths, decoder_lengths
+
+
+def loss_token_counts(dataset, stage: int, next_token_ratio: float) -> List[float]:
+    """Supervised (label != -100) decoder tokens of every example, eos included; expected over the stage-1 task."""
+    if stage == 1:
+        # ae on llm_ids with probability 1 - next_token_ratio, next_token on next_ids otherwise
+        return [
+            (1 - next_token_ratio) * (len(llm_ids) + 1) + next_token_ratio * (len(next_ids) + 1)
+            for llm_ids, next_ids in zip(dataset["llm_ids"], dataset["next_ids"])
+        ]
+    return [sum(1 for t in labels if t != -100) + 1 for labels in dataset["labels"]]
+
+
+class TokenBudgetBatchSampler(Sampler[List[int]]):
+    """
+    Groups examples of similar compressor and decoder length and packs each batch up to
+    `max_tokens` padded tokens, i.e. batch_size * (max compressor len + max decoder len).
+
+    Batches are formed once (ties in length broken by `seed`) and only their order is
+    shuffled per epoch, so the number of batches, and with it the Trainer's step count,
+    is the same every epoch. The sampler shards itself over `num_replicas` processes: each
+    epoch drops the last `len(batches) % num_replicas` shuffled batches, so that every rank runs
+    the same number of steps without the duplicated batches `accelerate` would pad with.
+    """
+    def __init__(
+        self,
+        compress_lengths: List[int],
+        decoder_lengths: List[int],
+        max_tokens: int,
+        shuffle: bool = True,
+        seed: int = 42,
+        loss_tokens: List[float] = None,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ):
+        self.compress_lengths = compress_lengths
+        self.decoder_lengths = decoder_lengths
+        self.loss_tokens = loss_tokens if loss_tokens is not None else decoder_lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.batches = self._build_batches()
+        if len(self.batches) < num_replicas:
+            raise ValueError(f"{len(self.batches)} token-budget batches can not be shared by {num_replicas} processes")
+
+    def _build_batches(self) -> List[List[int]]:
+        rng = random.Random(self.seed)
+        indices = list(range(len(self.compress_lengths)))
+        rng.shuffle(indices)
+        indices.sort(key=lambda i: (self.compress_lengths[i], self.decoder_lengths[i]))
+
+        batches, batch = [], []
+        max_compress, max_decoder = 0, 0
+        for idx in indices:
+            new_compress = max(max_compress, self.compress_lengths[idx])
+            new_decoder = max(max_decoder, self.decoder_lengths[idx])
+            # a single example over budget still forms its own batch
+            if batch and (len(batch) + 1) * (new_compress + new_decoder) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                new_compress, new_decoder = self.compress_lengths[idx], self.decoder_lengths[idx]
+            batch.append(idx)
+            max_compress, max_decoder = new_compress, new_decoder
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @property
+    def mean_loss_tokens(self) -> float:
+        """Average supervised decoder tokens per batch, the loss normalizer for constant tokens per update."""
+        return sum(self.loss_tokens) / len(self.batches)
+
+    def padding_ratio(self) -> float:
+        padded, real = 0, 0
+        for batch in self.batches:
+            padded += len(batch) * (
+                max(self.compress_lengths[i] for i in batch) + max(self.decoder_lengths[i] for i in batch)
+            )
+            real += sum(self.compress_lengths[i] + self.decoder_lengths[i] for i in batch)
+        return 1 - real / padded
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        order = list(range(len(self.batches)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        # every rank shuffles alike and takes its stride of the evenly divisible part
+        order = order[:len(self) * self.num_replicas]
+        for i in order[self.rank::self.num_replicas]:
+            yield self.batches[i]
+
+    def __len__(self) -> int:
+        return len(self.batches) // self.num_replicas
+
+
+def stratified_subset(lengths: List[int], token_budget: int, num_strata: int = 10, seed: int = 42) -> List[int]:
+    """
+    Indices of a fixed subset of about `token_budget` tokens with the length distribution of
+    the full set: lengths are split into `num_strata` quantile strata and each is sampled
+    at the same rate.
+    """
+    total = sum(lengths)
+    if total <= token_budget:
+        return list(range(len(lengths)))
+    rate = token_budget / total
+    rng = random.Random(seed)
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    stratum_size = -(-len(order) // num_strata)
+    subset = []
+    for begin in range(0, len(order), stratum_size):
+        stratum = order[begin:begin + stratum_size]
+        subset.extend(rng.sample(stratum, max(1, round(rate * len(stratum)))))
+    return sorted(subset)
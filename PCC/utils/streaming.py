@@ -0,0 +1,164 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import glob
+import json
+import logging
+import os
+import random
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from torch.utils.data import IterableDataset, get_worker_info
+
+logger = logging.getLogger(__name__)
+
+SHARD_EXTENSIONS = (".parquet", ".arrow", ".jsonl", ".json")
+
+
+def find_shards(data_dir: str, split: str) -> List[str]:
+    """Shard files of `split`: `<data_dir>/<split>/**` (preprocess.py layout), else files named after the split."""
+    def collect(pattern):
+        return sorted(p for p in glob.glob(pattern, recursive=True) if p.endswith(SHARD_EXTENSIONS))
+
+    files = collect(os.path.join(data_dir, split, "**", "*"))
+    if not files:
+        files = [p for p in collect(os.path.join(data_dir, "**", "*")) if os.path.basename(p).startswith(split)]
+    if not files:
+        raise FileNotFoundError(f"no {split} shards ({', '.join(SHARD_EXTENSIONS)}) found in {data_dir}")
+    return files
+
+
+def _read_arrow(path: str, start: int) -> Iterator[Tuple[dict, int]]:
+    source = pa.memory_map(path)
+    try:
+        reader = pa.ipc.open_file(source)
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    except pa.ArrowInvalid:
+        # datasets / preprocess.py write the stream format
+        source.seek(0)
+        batches = iter(pa.ipc.open_stream(source))
+    row = 0
+    for batch in batches:
+        if row + batch.num_rows <= start:
+            row += batch.num_rows
+            continue
+        for i, example in enumerate(batch.to_pylist()):
+            if row + i >= start:
+                yield example, row + i + 1
+        row += batch.num_rows
+
+
+def _read_parquet(path: str, start: int) -> Iterator[Tuple[dict, int]]:
+    parquet_file = pq.ParquetFile(path)
+    row = 0
+    for group in range(parquet_file.num_row_groups):
+        num_rows = parquet_file.metadata.row_group(group).num_rows
+        if row + num_rows <= start:
+            row += num_rows
+            continue
+        for i, example in enumerate(parquet_file.read_row_group(group).to_pylist()):
+            if row + i >= start:
+                yield example, row + i + 1
+        row += num_rows
+
+
+def _read_jsonl(path: str, start: int) -> Iterator[Tuple[dict, int]]:
+    # positions are byte offsets, so resuming seeks instead of re-reading
+    with open(path, "rb") as f:
+        f.seek(start)
+        for line in iter(f.readline, b""):
+            if line.strip():
+                yield json.loads(line), f.tell()
+
+
+def read_shard(path: str, start: int = 0) -> Iterator[Tuple[dict, int]]:
+    """Yield (example, position after it) from `start` (a row index, or a byte offset for jsonl)."""
+    if path.endswith(".parquet"):
+        return _read_parquet(path, start)
+    if path.endswith(".arrow"):
+        return _read_arrow(path, start)
+    return _read_jsonl(path, start)
+
+
+class StreamingDataset(IterableDataset):
+    """
+    Endless stream over shard files. Every epoch the shard order is shuffled, each rank
+    takes shards[rank::world_size] and each dataloader worker a further slice of those.
+    Rows are shuffled within blocks of `shuffle_buffer` consecutive rows.
+
+    Each example carries a `stream_state` (epoch, shard, block start, index in block) that the
+    trainer records once the example is consumed. `load_state_dict` resumes right after it,
+    re-reading at most the one block that was in flight.
+    """
+    def __init__(
+        self,
+        files: List[str],
+        shuffle_buffer: int = 10000,
+        seed: int = 42,
+        rank: int = 0,
+        world_size: int = 1,
+    ):
+        if len(files) < world_size:
+            raise ValueError(f"{len(files)} shards can not be split over {world_size} ranks")
+        self.files = files
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.state: Dict[str, dict] = {}
+
+    def load_state_dict(self, state: dict, num_workers: int):
+        if state["world_size"] != self.world_size or state["num_workers"] != num_workers:
+            raise ValueError(
+                f"stream state was saved with world_size={state['world_size']}, num_workers={state['num_workers']}, "
+                f"but resuming with world_size={self.world_size}, num_workers={num_workers}"
+            )
+        self.state = state["workers"]
+
+    def worker_files(self, epoch: int, worker_id: int, num_workers: int) -> List[str]:
+        files = list(self.files)
+        random.Random(self.seed + epoch).shuffle(files)
+        return files[self.rank::self.world_size][worker_id::num_workers]
+
+    def _blocks(self, path: str, start: int) -> Iterator[Tuple[int, List[dict]]]:
+        block, block_start = [], start
+        for example, next_position in read_shard(path, start):
+            block.append(example)
+            if len(block) == self.shuffle_buffer:
+                yield block_start, block
+                block, block_start = [], next_position
+        if block:
+            yield block_start, block
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+
+        resume: Optional[dict] = self.state.get(str(worker_id))
+        epoch = resume["epoch"] if resume else 0
+        while True:
+            files = self.worker_files(epoch, worker_id, num_workers)
+            if not files:
+                logger.warning(f"rank {self.rank} worker {worker_id} has no shards, consider fewer dataloader workers")
+                return
+            first_shard = resume["shard"] if resume else 0
+            for shard in range(first_shard, len(files)):
+                start = resume["block"] if resume and shard == resume["shard"] else 0
+                for block_start, block in self._blocks(files[shard], start):
+                    order = list(range(len(block)))
+                    random.Random(f"{self.seed}-{epoch}-{shard}-{block_start}").shuffle(order)
+                    first = 0
+                    if resume and shard == resume["shard"] and block_start == resume["block"]:
+                        first = resume["index"] + 1
+                    for index in range(first, len(order)):
+                        example = dict(block[order[index]])
+                        example["stream_state"] = {
+                            "worker": worker_id, "epoch": epoch, "shard": shard, "block": block_start, "index": index,
+                        }
+                        yield example
+                    resume = None
+                resume = None
+            epoch += 1
@@ -0,0 +1,168 @@
+## Copyright (c) Microsoft Corporation.
+## Licensed under the MIT license.
+
+import json
+import os
+import time
+from typing import Dict, List
+
+import torch
+from transformers import TrainerCallback
+
+from .batch_probe import PeakMemoryMonitor
+
+STAGES = ["compressor", "converter", "decoder"]
+
+
+class StageTimer:
+    """
+    Forward-time of the compressor, converter and decoder through module hooks. On CUDA the
+    hooks only record events; they are resolved once per step in `collect`.
+    """
+    def __init__(self, model, device):
+        self.use_cuda = torch.device(device).type == "cuda"
+        self.spans: Dict[str, List] = {stage: [] for stage in STAGES}
+        self._open: Dict[str, object] = {}
+        # only training steps are timed, not evaluation
+        self.active = False
+        self.handles = []
+        for stage in STAGES:
+            module = getattr(model, stage)
+            self.handles.append(module.register_forward_pre_hook(self._start(stage)))
+            self.handles.append(module.register_forward_hook(self._stop(stage)))
+
+    def _now(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _start(self, stage):
+        def hook(module, args):
+            if self.active:
+                self._open[stage] = self._now()
+        return hook
+
+    def _stop(self, stage):
+        def hook(module, args, output):
+            if stage in self._open:
+                self.spans[stage].append((self._open.pop(stage), self._now()))
+        return hook
+
+    def collect(self) -> Dict[str, float]:
+        """Seconds spent in every stage since the last call."""
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        seconds = {}
+        for stage, spans in self.spans.items():
+            if self.use_cuda:
+                seconds[stage] = sum(start.elapsed_time(end) for start, end in spans) / 1000
+            else:
+                seconds[stage] = sum(end - start for start, end in spans)
+            spans.clear()
+        return seconds
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+class TelemetryCallBack(TrainerCallback):
+    """
+    One record per optimizer step: stage times, compile time, dataloader wait, compressor / decoder
+    tokens per second, padding ratio and peak memory. Every rank appends to
+    `telemetry_rank<r>.jsonl` and rewrites `telemetry_rank<r>.prom` (Prometheus text format,
+    e.g. for node_exporter's textfile collector).
+    """
+    def __init__(self, model, output_dir: str, rank: int, device):
+        self.timer = StageTimer(model, device)
+        self.model = model
+        self._compile_seconds = model.compile_seconds()
+        self.device = torch.device(device)
+        self.memory = PeakMemoryMonitor(device)
+        self.rank = rank
+        os.makedirs(output_dir, exist_ok=True)
+        self.jsonl_path = os.path.join(output_dir, f"telemetry_rank{rank}.jsonl")
+        self.prom_path = os.path.join(output_dir, f"telemetry_rank{rank}.prom")
+        self._reset()
+        self._last_mark = time.perf_counter()
+        self._step_start = self._last_mark
+
+    def _reset(self):
+        self.dataloader_wait = 0.0
+        self.compressor_tokens = 0
+        self.decoder_tokens = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    # called by BaseTrainer around every micro-batch
+    def batch_ready(self):
+        self.dataloader_wait += time.perf_counter() - self._last_mark
+
+    def batch_done(self, inputs):
+        self._last_mark = time.perf_counter()
+        self.decoder_tokens += inputs["num_decoder_tokens"]
+        self.compressor_tokens += inputs["num_tokens"] - inputs["num_decoder_tokens"]
+        self.tokens += inputs["num_tokens"]
+        self.padded_tokens += inputs["num_padded_tokens"]
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.timer.active = True
+        # peak of this step: allocator stats on CUDA, RSS sampled during the step on CPU
+        self.memory.start()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.timer.active = False
+        self.memory.stop()
+        stage_seconds = self.timer.collect()
+        now = time.perf_counter()
+        step_seconds = now - self._step_start
+        # first calls of newly compiled shapes, excluded from the steady-state step time
+        compile_seconds = self.model.compile_seconds() - self._compile_seconds
+        self._compile_seconds += compile_seconds
+        record = {
+            "step": state.global_step,
+            "time": time.time(),
+            "step_seconds": step_seconds,
+            "compile_seconds": compile_seconds,
+            "steady_step_seconds": step_seconds - compile_seconds,
+            **{f"{stage}_seconds": seconds for stage, seconds in stage_seconds.items()},
+            "dataloader_wait_seconds": self.dataloader_wait,
+            "compressor_tokens_per_second": self.compressor_tokens / step_seconds,
+            "decoder_tokens_per_second": self.decoder_tokens / step_seconds,
+            "padding_ratio": 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.0,
+            "peak_memory_bytes": self.memory.peak_bytes,
+        }
+        with open(self.jsonl_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self._write_prometheus(record)
+        self._reset()
+        # the optimizer step is not dataloader wait
+        self._last_mark = self._step_start = time.perf_counter()
+
+    def _write_prometheus(self, record):
+        lines = []
+        for name, value in record.items():
+            if name == "time":
+                continue
+            metric = f"pcc_train_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f'{metric}{{rank="{self.rank}"}} {value}')
+
+        # replaced atomically so a scraper never reads a partial file
+        tmp_path = f"{self.prom_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prom_path)
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        # evaluation and checkpointing run between steps and are not part of the next one
+        self._last_mark = self._step_start = time.perf_counter()
+
+    def on_save(self, args, state, control, **kwargs):
+        self._last_mark = self._step_start = time.perf_counter()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.timer.remove()
+        self.memory.stop()
@@ -8,12 +8,14 @@ from .argument import DataArguments
 from datasets import load_from_disk
 from torch.utils.data import DataLoader, Dataset
 class DataCollator(object):
-    def __init__(self, stage, compress_pad_token_id,llm_pad_token_id, llm_eos_token_id, compressor_type) -> None:
+    def __init__(self, stage, compress_pad_token_id,llm_pad_token_id, llm_eos_token_id, compressor_type, feature_store=None) -> None:
         self.compress_pad_token_id = compress_pad_token_id
         self.llm_pad_token_id = llm_pad_token_id
         self.llm_eos_token_id = llm_eos_token_id
         self.stage = stage
         self.compressor_type = compressor_type
+        # cached compressor memories, looked up by the "feature_idx" column (see utils/feature_store.py)
+        self.feature_store = feature_store
 
     @staticmethod
     def dynamicPadding(
@@ -25,8 +27,24 @@ class DataCollator(object):
             ids + [pad_token_id] * (max_list_len-len(ids)) for ids in batch
         ]
         return padded_ids
+
+    @staticmethod
+    def toTensor(
+        batch: List[List[int]],
+        pad_token_id: int,
+    ):
+        """Right-pad `batch` into an int64 tensor and build its attention mask."""
+        max_list_len = max(len(ids) for ids in batch)
+        ids_tensor = torch.full((len(batch), max_list_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), max_list_len), dtype=torch.long)
+        for i, ids in enumerate(batch):
+            ids_tensor[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, :len(ids)] = 1
+        return ids_tensor, attention_mask
     
-    def __call__(self, examples) -> Dict[str, List[str]]:
+    def __call__(self, examples) -> Dict[str, Union[torch.Tensor, List[str], int]]:
+        # tensors are built here, inside the dataloader workers, so that the main process
+        # only has to (pin and) copy them to the device
         if self.compressor_type == 'large':
             compress_ids = [text["llm_ids"] for text in examples]
         elif self.compressor_type == 'lite':
@@ -38,30 +56,51 @@ class DataCollator(object):
             llm_ids = [text["llm_ids"] + [self.llm_eos_token_id] for text in examples]
             next_ids = [text["next_ids"] + [self.llm_eos_token_id] for text in examples]
             prompt_text = ["<ae>" for _ in examples]
-            padded_llm_ids = self.dynamicPadding(llm_ids, self.llm_pad_token_id)
-            padded_next_ids = self.dynamicPadding(next_ids, self.llm_pad_token_id)
+            padded_llm_ids, llm_attention_mask = self.toTensor(llm_ids, self.llm_pad_token_id)
+            padded_next_ids, next_attention_mask = self.toTensor(next_ids, self.llm_pad_token_id)
         # rag
         else:
             query_answer_ids = [text["query_answer_ids"] + [self.llm_eos_token_id] for text in examples]
             label_ids = [text["labels"] + [self.llm_eos_token_id] for text in examples]
-            padded_query_answer_ids = self.dynamicPadding(query_answer_ids, self.llm_pad_token_id)
-            padded_label_ids = self.dynamicPadding(label_ids, -100)
+            padded_query_answer_ids, query_answer_attention_mask = self.toTensor(query_answer_ids, self.llm_pad_token_id)
+            padded_label_ids, _ = self.toTensor(label_ids, -100)
 
-        padded_compress_ids = self.dynamicPadding(compress_ids, self.compress_pad_token_id)
+        padded_compress_ids, _ = self.toTensor(compress_ids, self.compress_pad_token_id)
+
+        # real vs padded token counts, for padding-ratio / throughput logging and token-weighted loss
+        if self.stage == 1:
+            decoder_lengths = [max(len(l), len(n)) for l, n in zip(llm_ids, next_ids)]
+        else:
+            decoder_lengths = [len(ids) for ids in query_answer_ids]
+        num_decoder_tokens = sum(decoder_lengths)
+        num_tokens = sum(len(ids) for ids in compress_ids) + num_decoder_tokens
+        num_padded_tokens = len(examples) * (padded_compress_ids.size(1) + max(decoder_lengths))
 
         if self.stage == 1:
-            return {
+            batch = {
                 "compress_ids":padded_compress_ids,
                 "llm_ids":padded_llm_ids,
+                "llm_attention_mask":llm_attention_mask,
                 "next_ids":padded_next_ids,
+                "next_attention_mask":next_attention_mask,
                 "prompt_text": prompt_text,
             }
         else:
-            return {
+            batch = {
                 "compress_ids":padded_compress_ids,
                 "query_answer_ids":padded_query_answer_ids,
+                "query_answer_attention_mask":query_answer_attention_mask,
                 "label_ids":padded_label_ids,
             }
+        batch["num_tokens"] = num_tokens
+        batch["num_padded_tokens"] = num_padded_tokens
+        batch["num_decoder_tokens"] = num_decoder_tokens
+        if "stream_state" in examples[0]:
+            # a batch comes from one dataloader worker; its last example marks how far that worker was consumed
+            batch["stream_state"] = examples[-1]["stream_state"]
+        if self.feature_store is not None and "feature_idx" in examples[0]:
+            batch["compressor_features"] = self.feature_store.batch([text["feature_idx"] for text in examples])
+        return batch
             
             
  
\ No newline at end of file